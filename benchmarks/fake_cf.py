@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Stand-in for the cf cli, good enough for cg-manage-rds to run against.
+
+Configured through the environment:
+
+FAKE_CF_VERSION   7 or 8, picks the output format (default 8)
+FAKE_CF_LATENCY   json of seconds to sleep per command, e.g. {"push": 2}
+FAKE_CF_SERVICES  json of service name to {"plan", "host", "port", "db_name",
+                  "username", "password", "target"}, target is the local
+                  "host:port" that cf ssh forwards the service's host to
+
+Apps and service keys are kept in $CF_HOME/fake-cf.json.
+"""
+
+import fcntl
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+VERSIONS = {"7": "7.7.10+7a9bd8e.2024-03-18", "8": "8.7.10+5b7ce3c.2024-03-18"}
+USER = "bench@example.gov"
+
+
+def main(args: list) -> int:
+    if not args:
+        return fail("no command")
+    if args[0] == "--version":
+        print(f"cf version {VERSIONS[version()]}")
+        return 0
+    command, args = args[0], args[1:]
+    handler = COMMANDS.get(command)
+    if handler is None:
+        return fail(f"'{command}' is not a registered command")
+    time.sleep(latency(command))
+    return handler([a for a in args if a not in ["-f"]], "-f" in args)
+
+
+def version() -> str:
+    return os.environ.get("FAKE_CF_VERSION", "8")
+
+
+def latency(command: str) -> float:
+    return float(json.loads(os.environ.get("FAKE_CF_LATENCY") or "{}").get(command, 0))
+
+
+def services() -> dict:
+    return json.loads(os.environ.get("FAKE_CF_SERVICES") or "{}")
+
+
+def fail(message: str) -> int:
+    print("FAILED", file=sys.stderr)
+    print(message, file=sys.stderr)
+    return 1
+
+
+def state_file() -> str:
+    home = os.environ.get("CF_HOME") or os.path.expanduser("~")
+    return os.path.join(home, "fake-cf.json")
+
+
+def load() -> dict:
+    try:
+        with open(state_file()) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {"apps": {}, "keys": {}}
+
+
+@contextmanager
+def changing() -> Iterator[dict]:
+    # cg-manage-rds runs independent cf commands concurrently
+    with open(state_file() + ".lock", "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        state = load()
+        yield state
+        tmp = f"{state_file()}.{os.getpid()}"
+        with open(tmp, "w") as fd:
+            json.dump(state, fd)
+        os.replace(tmp, state_file())
+
+
+def push(args: list, force: bool) -> int:
+    with changing() as state:
+        state["apps"][args[0]] = {"ssh": False}
+    print(f"Pushing app {args[0]} to org bench-org / space bench as {USER}...")
+    print("\nWaiting for app to start...\n")
+    print(f"name:              {args[0]}")
+    print("requested state:   started")
+    return 0
+
+
+def delete(args: list, force: bool) -> int:
+    with changing() as state:
+        state["apps"].pop(args[0], None)
+    print(f"Deleting app {args[0]} in org bench-org / space bench as {USER}...")
+    print("OK")
+    return 0
+
+
+def app(args: list, force: bool) -> int:
+    if args[0] not in load()["apps"]:
+        return fail(f"App '{args[0]}' not found.")
+    print(f"Showing health and status for app {args[0]} as {USER}...\n")
+    print(f"name:              {args[0]}")
+    print("requested state:   started\n")
+    print("     state     since                  cpu    memory        disk")
+    print("#0   running   2024-03-18T12:00:00Z   0.2%   12M of 64M   90M of 1G")
+    return 0
+
+
+def enable_ssh(args: list, force: bool) -> int:
+    with changing() as state:
+        if args[0] not in state["apps"]:
+            return fail(f"App '{args[0]}' not found.")
+        state["apps"][args[0]]["ssh"] = True
+    print(f"Enabling ssh support for app {args[0]} as {USER}...")
+    print("OK")
+    return 0
+
+
+def credentials(service: str) -> dict:
+    svc = services()[service]
+    return {
+        "db_name": svc["db_name"],
+        "host": svc["host"],
+        "name": svc["db_name"],
+        "password": svc["password"],
+        "port": str(svc["port"]),
+        "uri": "",
+        "username": svc["username"],
+    }
+
+
+def create_service_key(args: list, force: bool) -> int:
+    service, key = args[0], args[1]
+    if service not in services():
+        return fail(f"Service instance {service} not found")
+    with changing() as state:
+        state["keys"][f"{service}/{key}"] = credentials(service)
+    print(f"Creating service key {key} for service instance {service} as {USER}...")
+    print("OK")
+    return 0
+
+
+def delete_service_key(args: list, force: bool) -> int:
+    with changing() as state:
+        state["keys"].pop(f"{args[0]}/{args[1]}", None)
+    print(f"Deleting key {args[1]} for service instance {args[0]} as {USER}...")
+    print("OK")
+    return 0
+
+
+def service_key(args: list, force: bool) -> int:
+    service, key = args[0], args[1]
+    creds = load()["keys"].get(f"{service}/{key}")
+    if creds is None:
+        return fail(f"No service key {key} found for service instance {service}")
+    print(f"Getting key {key} for service instance {service} as {USER}...\n")
+    if version() == "8":
+        creds = {"credentials": creds}
+    print(json.dumps(creds, indent=2))
+    return 0
+
+
+def service(args: list, force: bool) -> int:
+    svc = services().get(args[0])
+    if svc is None:
+        return fail(f"Service instance '{args[0]}' not found")
+    print(
+        f"Showing info of service {args[0]} in org bench-org / space bench as {USER}...\n"
+    )
+    print(f"name:             {args[0]}")
+    if version() == "7":
+        print("service:          aws-rds")
+    else:
+        print("offering:         aws-rds")
+    print(f"plan:             {svc['plan']}")
+    print("broker:           aws-broker")
+    return 0
+
+
+def list_services(args: list, force: bool) -> int:
+    print(f"Getting service instances in org bench-org / space bench as {USER}...\n")
+    header = "offering" if version() == "8" else "service"
+    print(f"name{' ' * 20}{header:<10}plan{' ' * 12}bound apps   last operation")
+    for name, svc in services().items():
+        print(f"{name:<24}aws-rds   {svc['plan']:<16}             create succeeded")
+    return 0
+
+
+def ssh(args: list, force: bool) -> int:
+    """
+    Forward each -L local:host:port to the target of the service at host:port
+    """
+    app_name = args[0]
+    if not load()["apps"].get(app_name, {}).get("ssh"):
+        return fail(f"Error opening SSH connection: ssh is disabled for {app_name}")
+    targets = {(s["host"], str(s["port"])): s["target"] for s in services().values()}
+    listeners = []
+    for i, arg in enumerate(args):
+        if arg != "-L":
+            continue
+        local, host, port = args[i + 1].rsplit(":", 2)
+        target = targets.get((host, port))
+        if target is None:
+            return fail(f"connect to {host}:{port}: no route to host")
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(("127.0.0.1", int(local)))
+        except OSError as e:
+            return fail(f"Error listening on localhost:{local}: {e}")
+        server.listen()
+        listeners.append((server, target))
+    for server, target in listeners:
+        threading.Thread(target=accept, args=(server, target), daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    while True:
+        time.sleep(3600)
+
+
+def accept(server: socket.socket, target: str) -> None:
+    host, port = target.rsplit(":", 1)
+    while True:
+        conn, _ = server.accept()
+        try:
+            upstream = socket.create_connection((host, int(port)))
+        except OSError:
+            conn.close()
+            continue
+        for src, dst in [(conn, upstream), (upstream, conn)]:
+            threading.Thread(target=pump, args=(src, dst), daemon=True).start()
+
+
+def pump(src: socket.socket, dst: socket.socket) -> None:
+    try:
+        for chunk in iter(lambda: src.recv(65536), b""):
+            dst.sendall(chunk)
+    except OSError:
+        pass
+    finally:
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+COMMANDS = {
+    "push": push,
+    "delete": delete,
+    "app": app,
+    "enable-ssh": enable_ssh,
+    "create-service-key": create_service_key,
+    "delete-service-key": delete_service_key,
+    "service-key": service_key,
+    "service": service,
+    "services": list_services,
+    "ssh": ssh,
+}
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
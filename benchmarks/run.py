@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+End to end benchmarks of cg-manage-rds against a fake cf cli and local databases.
+
+Every scenario runs the real command line in a subprocess with benchmarks/fake_cf.py
+in place of cf, and records wall time and the cpu time of the tool and its children.
+"""
+
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import click
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+CLI = os.path.join(ROOT, "cli.py")
+PASSWORD = "bench-password"
+
+ENGINES = {
+    "pgsql": {"plan": "micro-psql", "port": 5432, "image": "postgres:16"},
+    "mysql": {"plan": "micro-mysql", "port": 3306, "image": "mysql:8.0"},
+}
+SCENARIOS = ["setup", "export", "import", "clone", "stream-clone"]
+
+
+class Database:
+    """
+    A local server standing in for the aws-rds instances of the benchmark
+    """
+
+    def __init__(self, engine: str, host: str, port: int, user: str, password: str):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+
+    def run(self, sql: str, db_name: str = None) -> None:
+        if self.engine == "pgsql":
+            cmd = ["psql", "-v", "ON_ERROR_STOP=1", "-q", "-h", self.host]
+            cmd += ["-p", str(self.port), "-U", self.user]
+            cmd += ["-d", db_name or "postgres", "-c", sql]
+            env = dict(os.environ, PGPASSWORD=self.password)
+        else:
+            cmd = ["mysql", f"-h{self.host}", f"-P{self.port}", f"-u{self.user}"]
+            cmd += [f"-p{self.password}", "--protocol=TCP"]
+            cmd += ([f"-D{db_name}"] if db_name else []) + ["-e", sql]
+            env = None
+        subprocess.run(cmd, env=env, check=True, capture_output=True)
+
+    def reset(self, db_name: str) -> None:
+        self.run(f"DROP DATABASE IF EXISTS {db_name}")
+        self.run(f"CREATE DATABASE {db_name}")
+
+    def populate(self, db_name: str, rows: int) -> None:
+        """
+        A parent table with a secondary index and a child table with a foreign key
+        """
+        self.reset(db_name)
+        if self.engine == "pgsql":
+            self.run(
+                "CREATE TABLE items (id bigint PRIMARY KEY, name text, payload text);"
+                "CREATE TABLE events (id bigint PRIMARY KEY,"
+                " item_id bigint REFERENCES items (id), at timestamptz);"
+                "INSERT INTO items SELECT g, 'item ' || g, repeat(md5(g::text), 4)"
+                f" FROM generate_series(1, {rows}) g;"
+                "INSERT INTO events SELECT g, g, now()"
+                f" FROM generate_series(1, {rows}) g;"
+                "CREATE INDEX items_name ON items (name);",
+                db_name,
+            )
+            return
+        self.run(
+            "CREATE TABLE items (id bigint PRIMARY KEY, name varchar(64),"
+            " payload text, KEY items_name (name));"
+            "CREATE TABLE events (id bigint PRIMARY KEY, item_id bigint,"
+            " at datetime, CONSTRAINT events_item FOREIGN KEY (item_id)"
+            " REFERENCES items (id));"
+            f"SET SESSION cte_max_recursion_depth = {rows + 1};"
+            "INSERT INTO items WITH RECURSIVE seq (n) AS"
+            f" (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {rows})"
+            " SELECT n, CONCAT('item ', n), REPEAT(MD5(n), 4) FROM seq;"
+            "INSERT INTO events SELECT id, id, NOW() FROM items;",
+            db_name,
+        )
+
+
+class Stub:
+    """
+    Answers just the handshake of an engine, enough for setup and cleanup
+    """
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        while True:
+            conn, _ = self.server.accept()
+            with conn:
+                if self.engine == "pgsql":
+                    conn.recv(8)
+                    conn.sendall(b"N")
+                else:
+                    conn.sendall(b"\x0a\x00\x00\x00\x0a8.0.36\x00")
+
+
+def start_container(engine: str) -> Database:
+    port = free_port()
+    image = ENGINES[engine]["image"]
+    name = f"cg-manage-rds-bench-{engine}-{port}"
+    env = [
+        "-e",
+        f"POSTGRES_PASSWORD={PASSWORD}",
+        "-e",
+        f"MYSQL_ROOT_PASSWORD={PASSWORD}",
+    ]
+    inner = ENGINES[engine]["port"]
+    cmd = [
+        "docker",
+        "run",
+        "-d",
+        "--rm",
+        "--name",
+        name,
+        "-p",
+        f"127.0.0.1:{port}:{inner}",
+    ]
+    subprocess.run(cmd + env + [image], check=True, capture_output=True)
+    user = "postgres" if engine == "pgsql" else "root"
+    db = Database(engine, "127.0.0.1", port, user, PASSWORD)
+    db.container = name
+    deadline = time.monotonic() + 120
+    while True:
+        try:
+            db.run("SELECT 1")
+            return db
+        except subprocess.CalledProcessError:
+            if time.monotonic() > deadline:
+                raise click.ClickException(f"{image} did not start")
+            time.sleep(1)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_cf_env(work: str, services: dict, cf_version: str, latency: dict) -> dict:
+    bin_dir = os.path.join(work, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    shim = os.path.join(bin_dir, "cf")
+    with open(shim, "w") as fd:
+        fd.write(f'#!/bin/sh\nexec "{sys.executable}" "{HERE}/fake_cf.py" "$@"\n')
+    os.chmod(shim, 0o755)
+    return dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        CF_HOME=work,
+        CG_MANAGE_RDS_HOME=os.path.join(work, "state"),
+        FAKE_CF_VERSION=cf_version,
+        FAKE_CF_LATENCY=json.dumps(latency),
+        FAKE_CF_SERVICES=json.dumps(services),
+        PYTHONPATH=ROOT,
+    )
+
+
+def services_for(engine: str, target_port: int, db: Database = None) -> dict:
+    services = {}
+    for role in ["src", "dst"]:
+        services[f"bench-{role}"] = {
+            "plan": ENGINES[engine]["plan"],
+            "host": f"bench-{role}.rds.internal",
+            "port": ENGINES[engine]["port"],
+            "db_name": f"bench_{role}",
+            "username": db.user if db else "bench",
+            "password": db.password if db else PASSWORD,
+            "target": f"127.0.0.1:{target_port}",
+        }
+    return services
+
+
+def timed(cmds: list, env: dict) -> dict:
+    """
+    Wall and cpu seconds of running cmds in turn, cpu includes their children
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    ok = True
+    for cmd in cmds:
+        proc = subprocess.run(
+            [sys.executable, CLI, "--cache", "false"] + cmd,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            ok = False
+            click.echo(proc.stdout[-2000:] + proc.stderr[-2000:], err=True)
+            break
+    wall = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {"wall": round(wall, 3), "cpu": round(cpu, 3), "ok": ok}
+
+
+def scenario_cmds(scenario: str, engine: str, dump: str) -> list:
+    common = ["-e", engine]
+    if scenario == "setup":
+        return [["setup"] + common + ["bench-src"], ["cleanup", "bench-src"]]
+    if scenario == "export":
+        return [["export"] + common + ["-f", dump, "bench-src"]]
+    if scenario == "import":
+        return [["import"] + common + ["-f", dump, "bench-dst"]]
+    if scenario == "clone":
+        return [["clone"] + common + ["-f", dump, "bench-src", "bench-dst"]]
+    return [["clone"] + common + ["--stream", "true", "bench-src", "bench-dst"]]
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for key, result in summary.items():
+        base = baseline.get(key)
+        if base is None or base.get("wall") is None:
+            continue
+        if result["wall"] > base["wall"] * (1 + tolerance):
+            regressions.append(f"{key}: {result['wall']}s, was {base['wall']}s")
+    return regressions
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option(
+    "--engine",
+    "engines",
+    type=click.Choice(["stub", "pgsql", "mysql"]),
+    multiple=True,
+    default=["stub"],
+    help="stub benchmarks setup and cleanup only, without a database",
+    show_default=True,
+)
+@click.option("--rows", default="1000,100000", help="dataset sizes", show_default=True)
+@click.option(
+    "--cf-version",
+    "cf_versions",
+    type=click.Choice(["7", "8"]),
+    multiple=True,
+    default=["8"],
+    show_default=True,
+)
+@click.option("--rounds", type=int, default=3, show_default=True)
+@click.option(
+    "--latency",
+    default="{}",
+    help='seconds per cf command as json, e.g. {"push": 20, "create-service-key": 5}',
+)
+@click.option("--pg", help="host:port of a local postgres, user postgres")
+@click.option("--mysql", help="host:port of a local mysql, user root")
+@click.option("--password", default=PASSWORD, show_default=True)
+@click.option("--docker", is_flag=True, help="start databases in docker containers")
+@click.option("-o", "--output", help="write the results to this json file")
+@click.option("--baseline", help="fail when slower than this earlier --output")
+@click.option("--tolerance", type=float, default=0.25, show_default=True)
+def main(
+    engines,
+    rows,
+    cf_versions,
+    rounds,
+    latency,
+    pg,
+    mysql,
+    password,
+    docker,
+    output,
+    baseline,
+    tolerance,
+):
+    """
+    Benchmark export, import and clone end to end against a fake cf cli
+    """
+    sizes = [int(x) for x in rows.split(",")]
+    latency = json.loads(latency)
+    addresses = {"pgsql": pg, "mysql": mysql}
+    address_options = {"pgsql": "--pg", "mysql": "--mysql"}
+    results = []
+    containers = []
+    work = tempfile.mkdtemp(prefix="cg-manage-rds-bench-")
+    try:
+        for engine in engines:
+            if engine == "stub":
+                for real in ENGINES:
+                    stub = Stub(real)
+                    for cf_version in cf_versions:
+                        env = fake_cf_env(
+                            os.path.join(work, f"stub-{real}-{cf_version}"),
+                            services_for(real, stub.port),
+                            cf_version,
+                            latency,
+                        )
+                        for i in range(rounds):
+                            result = timed(scenario_cmds("setup", real, ""), env)
+                            key = f"stub-{real}/cf{cf_version}/setup"
+                            results.append(dict(result, key=key, round=i))
+                            click.echo(f"{key} round {i}: {result}")
+                continue
+            if docker:
+                db = start_container(engine)
+                containers.append(db.container)
+            elif addresses[engine]:
+                host, port = addresses[engine].rsplit(":", 1)
+                user = "postgres" if engine == "pgsql" else "root"
+                db = Database(engine, host, int(port), user, password)
+            else:
+                raise click.ClickException(
+                    f"{address_options[engine]} or --docker is needed"
+                )
+            for size in sizes:
+                for cf_version in cf_versions:
+                    env = fake_cf_env(
+                        os.path.join(work, f"{engine}-{size}-{cf_version}"),
+                        services_for(engine, db.port, db),
+                        cf_version,
+                        latency,
+                    )
+                    dump = os.path.join(work, f"{engine}-{size}.dump")
+                    db.populate("bench_src", size)
+                    for i in range(rounds):
+                        for scenario in SCENARIOS:
+                            if scenario in ["import", "clone", "stream-clone"]:
+                                db.reset("bench_dst")
+                            result = timed(scenario_cmds(scenario, engine, dump), env)
+                            key = f"{engine}/{size}/cf{cf_version}/{scenario}"
+                            results.append(dict(result, key=key, round=i))
+                            click.echo(f"{key} round {i}: {result}")
+    finally:
+        for name in containers:
+            subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+        shutil.rmtree(work, ignore_errors=True)
+
+    summary = {}
+    for key in dict.fromkeys(r["key"] for r in results):
+        runs = [r for r in results if r["key"] == key and r["ok"]]
+        if not runs:
+            summary[key] = {"wall": None, "cpu": None, "failed": True}
+            continue
+        summary[key] = {
+            "wall": round(statistics.median(r["wall"] for r in runs), 3),
+            "cpu": round(statistics.median(r["cpu"] for r in runs), 3),
+            "rounds": len(runs),
+        }
+    click.echo(json.dumps(summary, indent=2))
+    if output:
+        with open(output, "w") as fd:
+            json.dump({"summary": summary, "results": results}, fd, indent=2)
+    failed = [k for k, v in summary.items() if v.get("failed")]
+    if failed:
+        raise click.ClickException(f"failed: {', '.join(failed)}")
+    if baseline:
+        with open(baseline) as fd:
+            regressions = compare(summary, json.load(fd)["summary"], tolerance)
+        if regressions:
+            raise click.ClickException(
+                "slower than baseline:\n" + "\n".join(regressions)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,89 @@
 import click
 from cg_manage_rds import commands
+from cg_manage_rds.cmds.compress import Codec, CODECS
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "-?", "--help"])
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
-def main():
+@click.option(
+    "--cache",
+    "use_cache",
+    type=bool,
+    default=True,
+    help="use cached service plans and service key credentials",
+    show_default=True,
+)
+@click.option(
+    "--progress",
+    type=bool,
+    default=False,
+    help="print transfer size, rate and ETA every few seconds",
+    show_default=True,
+)
+@click.option(
+    "--progress-json",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="append progress as json lines to this file, - for stdout",
+)
+@click.option(
+    "--preflight",
+    type=bool,
+    default=True,
+    help="check local free space and destination storage before a transfer",
+    show_default=True,
+)
+@click.option(
+    "--metrics-json",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="write a json report of the time spent in each phase to this file",
+)
+@click.option(
+    "--metrics-prom",
+    type=click.Path(dir_okay=False),
+    help="write phase timings to this prometheus textfile collector file",
+)
+def main(use_cache, progress, progress_json, preflight, metrics_json, metrics_prom):
     """
     Application to export, import, or clone a rds service instance from the aws-broker on Cloud.gov
     """
+    commands.use_cache(use_cache)
+    commands.use_progress(progress, progress_json)
+    commands.use_metrics(metrics_json, metrics_prom)
+    commands.use_preflight(preflight)
+
+
+def make_codec(name: str, level: int, threads: int) -> Codec:
+    if name is None:
+        return None
+    return Codec(name.lower(), level, threads)
+
+
+## CACHE
+@main.command("cache", context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--clear",
+    type=str,
+    default=None,
+    help="drop cached entries for this service, or 'all'",
+)
+def cache_cmd(clear):
+    """
+    Show or clear cached service plans and service key credentials
+    """
+    if clear is not None:
+        count = commands.clear_cache(None if clear == "all" else clear)
+        click.echo(f"Removed {count} cached entries")
+        return
+    for key, expires in commands.cached_entries().items():
+        click.echo(f"{key} (expires {expires})")
 
 
 ## CHECK
 @click.option(
     "-e",
     "--engine",
-    type=click.Choice(["pgsql", "mysql"], case_sensitive=False),
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
     help="Database engine type",
     show_default=True,
 )
@@ -35,12 +103,26 @@ def check(engine, service):
 @click.option(
     "-e",
     "--engine",
-    type=click.Choice(["pgsql", "mysql"], case_sensitive=False),
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
     help="Database engine type",
     show_default=True,
 )
+@click.option(
+    "--session",
+    type=bool,
+    default=False,
+    help="keep the app and tunnel up and reuse them across runs",
+    show_default=True,
+)
+@click.option(
+    "--idle-timeout",
+    type=int,
+    default=30,
+    help="minutes an unused session is kept before it is torn down",
+    show_default=True,
+)
 @click.argument("service")
-def setup(service, key, app, engine):
+def setup(service, key, app, engine, session, idle_timeout):
     """
     Setup app, key, and tunnel to a aws-rds service instance
 
@@ -48,7 +130,9 @@ def setup(service, key, app, engine):
 
     """
     click.echo(f"Setting up key, app and tunnel for {service}")
-    creds, _ = commands.setup(service, engine, app, key)
+    creds, _ = commands.setup(
+        service, engine, app, key, session=session, idle_timeout=idle_timeout
+    )
     click.echo(f"key, app and tunnel for {service} setup!")
     click.echo(f"You can connect to {service} using this:")
     click.secho(creds.get("uri"), fg="yellow")
@@ -58,7 +142,13 @@ def setup(service, key, app, engine):
 @main.command(context_settings=CONTEXT_SETTINGS)
 @click.option("-k", "--key", type=str, help="service key name", default="key")
 @click.option("-a", "--app", type=str, help="app name", default="ssh-app")
-@click.option("-p", "--pid", type=int, help="pid of tunnel", default=0)
+@click.option(
+    "-p",
+    "--pid",
+    type=int,
+    help="pid of tunnel, 0 closes the tunnel recorded for the service",
+    default=0,
+)
 @click.argument("service")
 def cleanup(
     service,
@@ -76,12 +166,65 @@ def cleanup(
     click.echo("Clean up complete")
 
 
+## TUNNELS
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--stop-all",
+    type=bool,
+    default=False,
+    help="close every tunnel started by this tool",
+    show_default=True,
+)
+def tunnels(stop_all):
+    """
+    List the ssh tunnels started by this tool that are still running
+    """
+    running = commands.list_tunnels(stop_all)
+    if not running:
+        click.echo("No SSH Tunnels running")
+    for service, entry in running.items():
+        click.echo(
+            f"{service}: PID {entry['pid']} localhost:{entry['local_port']}"
+            f" -> {entry['host']}:{entry['remote_port']} via {entry['app']}"
+        )
+
+
+## SESSION
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--end",
+    "end_app",
+    type=str,
+    help="tear down the session of this app",
+)
+def session(end_app):
+    """
+    List or end sessions started with --session
+
+    A session keeps its app, service keys and tunnels up between runs.
+    Sessions idle longer than their --idle-timeout are torn down by a
+    process left running for them, without waiting for another run.
+    """
+    if end_app is not None:
+        commands.end_session(end_app)
+        click.echo(f"Session for {end_app} ended")
+        return
+    sessions = commands.list_sessions()
+    if not sessions:
+        click.echo("No sessions")
+    for app, entry in sessions.items():
+        click.echo(
+            f"{app}: {', '.join(entry['services']) or 'no services'}"
+            f" (idle timeout {entry['idle_timeout']} minutes)"
+        )
+
+
 ## Export
 @main.command("export", context_settings=CONTEXT_SETTINGS)
 @click.option(
     "-e",
     "--engine",
-    type=click.Choice(["pgsql", "mysql"], case_sensitive=False),
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
     help="Database engine type",
     show_default=True,
 )
@@ -137,6 +280,64 @@ def cleanup(
     help="override engine default options with yours",
     show_default=True,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="parallel jobs for the client, 0 sizes them from local cores and the plan",
+    show_default=True,
+)
+@click.option(
+    "--session",
+    type=bool,
+    default=False,
+    help="keep the app and tunnel up and reuse them across runs",
+    show_default=True,
+)
+@click.option(
+    "--idle-timeout",
+    type=int,
+    default=30,
+    help="minutes an unused session is kept before it is torn down",
+    show_default=True,
+)
+@click.option(
+    "-z",
+    "--compress",
+    type=click.Choice(CODECS, case_sensitive=False),
+    help="compress the output file with this codec",
+)
+@click.option(
+    "--compress-level",
+    type=int,
+    help="compression level passed to the codec",
+)
+@click.option(
+    "--compress-threads",
+    type=int,
+    help="compression threads for zstd, or pigz in place of gzip",
+)
+@click.option(
+    "--resume",
+    type=bool,
+    default=False,
+    help="dump table by table and continue an interrupted run from its checkpoint",
+    show_default=True,
+)
+@click.option(
+    "--incremental",
+    type=bool,
+    default=False,
+    help="add an export of only the tables changed since the last one",
+    show_default=True,
+)
+@click.option(
+    "--shard",
+    "shards",
+    multiple=True,
+    help="postgres table to dump in primary key ranges concurrently, repeatable",
+)
 @click.argument("source")
 def export_db(
     source,
@@ -148,6 +349,15 @@ def export_db(
     app_name,
     setup,
     cleanup,
+    jobs,
+    session,
+    idle_timeout,
+    compress,
+    compress_level,
+    compress_threads,
+    resume,
+    incremental,
+    shards,
 ):
     """
     Export data and/or schema from SOURCE aws-rds service instance
@@ -160,6 +370,25 @@ def export_db(
     You can insert additional options and flags to the clients
     using -o --options.
 
+    With --jobs greater than 1 the output is a directory, a directory
+    format dump for postgres and one file per table for mysql, written
+    by that many parallel workers.
+
+    With --compress the client output is piped through gzip, zstd
+    or lz4, import detects and decompresses such files itself.
+
+    With --resume the output is a directory with one dump per table,
+    and a rerun with the same output file skips the finished tables.
+
+    With --incremental the output is a directory of exports, each new
+    one dumps only the tables changed since the one before and refers
+    to the earlier files for the rest. Import the directory to restore
+    the newest export.
+
+    With --shard the output is a table level dump like with --resume,
+    and the named postgres tables are copied out as primary key ranges,
+    --jobs of them at a time, and loaded back the same way on import.
+
     """
     click.echo(f"Exporting {source} to file: {output_file}")
     commands.export_from_svc(
@@ -172,6 +401,13 @@ def export_db(
         app_name=app_name,
         do_setup=setup,
         do_teardown=cleanup,
+        jobs=jobs,
+        session=session,
+        idle_timeout=idle_timeout,
+        codec=make_codec(compress, compress_level, compress_threads),
+        resume=resume,
+        incremental=incremental,
+        shards=shards,
     )
 
 
@@ -180,7 +416,7 @@ def export_db(
 @click.option(
     "-e",
     "--engine",
-    type=click.Choice(["pgsql", "mysql"], case_sensitive=False),
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
     help="Database engine type",
     show_default=True,
 )
@@ -236,6 +472,42 @@ def export_db(
     help="override engine default options with yours",
     show_default=True,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="parallel jobs for the client, 0 sizes them from local cores and the plan",
+    show_default=True,
+)
+@click.option(
+    "--session",
+    type=bool,
+    default=False,
+    help="keep the app and tunnel up and reuse them across runs",
+    show_default=True,
+)
+@click.option(
+    "--idle-timeout",
+    type=int,
+    default=30,
+    help="minutes an unused session is kept before it is torn down",
+    show_default=True,
+)
+@click.option(
+    "--resume",
+    type=bool,
+    default=False,
+    help="continue an interrupted import of a table level dump from its checkpoint",
+    show_default=True,
+)
+@click.option(
+    "--split",
+    type=bool,
+    default=False,
+    help="load the schema, then the data, then build indexes and constraints",
+    show_default=True,
+)
 @click.argument("destination")
 def import_db(
     destination,
@@ -247,6 +519,11 @@ def import_db(
     app_name,
     setup,
     cleanup,
+    jobs,
+    session,
+    idle_timeout,
+    resume,
+    split,
 ):
     """
     Import data and/or schema to DESTINATION rds service instance
@@ -270,6 +547,11 @@ def import_db(
         app_name=app_name,
         do_setup=setup,
         do_cleanup=cleanup,
+        jobs=jobs,
+        session=session,
+        idle_timeout=idle_timeout,
+        resume=resume,
+        split=split,
     )
 
 
@@ -278,7 +560,7 @@ def import_db(
 @click.option(
     "-e",
     "--engine",
-    type=click.Choice(["pgsql", "mysql"], case_sensitive=False),
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
     help="Database engine type",
     show_default=True,
 )
@@ -324,6 +606,72 @@ def import_db(
     help="override engine default options with yours",
     show_default=True,
 )
+@click.option(
+    "--stream",
+    type=bool,
+    default=False,
+    help="pipe the export directly into the import without a local file",
+    show_default=True,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="parallel jobs for the client, 0 sizes them from local cores and the plan",
+    show_default=True,
+)
+@click.option(
+    "--session",
+    type=bool,
+    default=False,
+    help="keep the app and tunnel up and reuse them across runs",
+    show_default=True,
+)
+@click.option(
+    "--idle-timeout",
+    type=int,
+    default=30,
+    help="minutes an unused session is kept before it is torn down",
+    show_default=True,
+)
+@click.option(
+    "-z",
+    "--compress",
+    type=click.Choice(CODECS, case_sensitive=False),
+    help="compress the output file with this codec",
+)
+@click.option(
+    "--compress-level",
+    type=int,
+    help="compression level passed to the codec",
+)
+@click.option(
+    "--compress-threads",
+    type=int,
+    help="compression threads for zstd, or pigz in place of gzip",
+)
+@click.option(
+    "--resume",
+    type=bool,
+    default=False,
+    help="dump table by table and continue an interrupted run from its checkpoint",
+    show_default=True,
+)
+@click.option(
+    "--multiplex",
+    type=bool,
+    default=False,
+    help="forward all services through a single cf ssh session",
+    show_default=True,
+)
+@click.option(
+    "--split",
+    type=bool,
+    default=False,
+    help="load the schema, then the data, then build indexes and constraints",
+    show_default=True,
+)
 @click.argument("source")
 @click.argument("destination")
 def clone(
@@ -336,6 +684,16 @@ def clone(
     force_options,
     key_name,
     app_name,
+    stream,
+    jobs,
+    session,
+    idle_timeout,
+    compress,
+    compress_level,
+    compress_threads,
+    resume,
+    multiplex,
+    split,
 ):
     """
     Migrate data from one rds service to another rds service instance.
@@ -348,6 +706,11 @@ def clone(
     You can insert additional options and flags to the clients
     with either -b --boptions or -r --roptions.
 
+    With --stream both tunnels are opened at once and the backup
+    client is piped into the restore client, no output file is written.
+    With -e pgcopy a streamed postgres clone copies the schema with
+    pg_dump, then --jobs tables at a time in binary COPY format.
+
     """
     click.echo(f"Cloning the database: {source} to {destination}")
     commands.clone(
@@ -360,9 +723,146 @@ def clone(
         force_options,
         key_name,
         app_name,
+        stream,
+        jobs,
+        session,
+        idle_timeout,
+        make_codec(compress, compress_level, compress_threads),
+        resume,
+        multiplex,
+        split,
     )
     click.echo("Cloning complete!")
 
 
+## BATCH
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(commands.ENGINES, case_sensitive=False),
+    help="Database engine type",
+    show_default=True,
+)
+@click.option(
+    "-g",
+    "--glob",
+    "pattern",
+    type=str,
+    help="also include aws-rds services in the space matching this pattern",
+)
+@click.option(
+    "-d",
+    "--directory",
+    default=".",
+    help="directory for the <service>.sql files",
+    show_default=True,
+)
+@click.option(
+    "-o",
+    "--options",
+    type=str,
+    help="cli options for the backup or restore client",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=4,
+    help="number of services processed at the same time",
+    show_default=True,
+)
+@click.option(
+    "-k",
+    "--key-name",
+    type=str,
+    default="key",
+    help="use this service key name",
+    show_default=True,
+)
+@click.option(
+    "-a",
+    "--app-name",
+    type=str,
+    default="ssh-app",
+    help="use this app name",
+    show_default=True,
+)
+@click.option(
+    "--force-options",
+    type=bool,
+    default=False,
+    help="override engine default options with yours",
+    show_default=True,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="parallel jobs for the client, 0 sizes them from local cores and the plan",
+    show_default=True,
+)
+@click.option(
+    "--multiplex",
+    type=bool,
+    default=False,
+    help="forward all services through a single cf ssh session",
+    show_default=True,
+)
+@click.argument("action", type=click.Choice(["export", "import"]))
+@click.argument("services", nargs=-1)
+def batch(
+    action,
+    services,
+    engine,
+    pattern,
+    directory,
+    options,
+    workers,
+    key_name,
+    app_name,
+    force_options,
+    jobs,
+    multiplex,
+):
+    """
+    Export or import many aws-rds service instances at once
+
+    ACTION is export or import, SERVICES are service instance names.
+
+    A single app is pushed for all services, each service gets its own
+    tunnel and up to --workers services are processed concurrently.
+    Each service is read from or written to DIRECTORY/<service>.sql.
+    With --multiplex the tunnels share one cf ssh session instead.
+    """
+    results = commands.batch(
+        action,
+        services,
+        pattern,
+        directory,
+        engine,
+        options,
+        force_options,
+        key_name,
+        app_name,
+        workers,
+        jobs,
+        multiplex,
+    )
+    click.echo(f"Batch {action} summary:")
+    for service, result in results.items():
+        color = "bright_green" if result["status"] == "ok" else "red"
+        click.secho(
+            f"  {service}: {result['status']} in {result['seconds']}s"
+            f" ({result['file']})",
+            fg=color,
+        )
+        if "error" in result:
+            click.echo(f"    {result['error']}")
+    if any(x["status"] != "ok" for x in results.values()):
+        raise click.ClickException("Some services failed")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,51 @@
+import time
+from typing import Any
+from cg_manage_rds.cmds.utils import locked_state
+
+STATE_FILE = "cache.json"
+# seconds a service's plan and its service key credentials are trusted
+PLAN_TTL = 24 * 60 * 60
+CREDENTIALS_TTL = 60 * 60
+ENABLED = True
+
+
+def get(key: str) -> Any:
+    if not ENABLED:
+        return None
+    with locked_state(STATE_FILE) as state:
+        entry = state.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] < time.time():
+            del state[key]
+            return None
+        return entry["value"]
+
+
+def put(key: str, value: Any, ttl: int) -> None:
+    if not ENABLED:
+        return
+    with locked_state(STATE_FILE) as state:
+        # drop anything stale while the file is open anyway
+        now = time.time()
+        for stale in [k for k, e in state.items() if e["expires"] < now]:
+            del state[stale]
+        state[key] = {"value": value, "expires": now + ttl}
+
+
+def delete(key: str) -> bool:
+    with locked_state(STATE_FILE) as state:
+        return state.pop(key, None) is not None
+
+
+def invalidate(prefix: str = "") -> int:
+    with locked_state(STATE_FILE) as state:
+        keys = [k for k in state if k.startswith(prefix)]
+        for key in keys:
+            del state[key]
+        return len(keys)
+
+
+def entries() -> dict:
+    with locked_state(STATE_FILE) as state:
+        return dict(state)
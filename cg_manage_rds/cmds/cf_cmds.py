@@ -1,28 +1,34 @@
 import time
 import os
-import sys
-import signal
+import socket
+import subprocess
 import click
 import json
 import re
 import importlib.resources as ir
 import semver
 import cg_manage_rds
-from cg_manage_rds.cmds.utils import run_sync, run_async
+from typing import Callable, Optional
+from cg_manage_rds.cmds.utils import run_sync
+from cg_manage_rds.cmds import tunnels
+from cg_manage_rds.cmds import cache
+from cg_manage_rds.cmds import metrics
+from cg_manage_rds.cmds import tools
 
 ALLOWED_CF_VERSIONS = [7, 8]
 CF_VERSION = 7
 CF_VERSION_PASSED = False
+TUNNEL_TIMEOUT = 60.0
 
 
+@metrics.timed("push_app")
 def push_app(app_name: str, manifest: str = "manifest.yml") -> None:
     click.echo("Pushing App to space")
-    orig_wd = getattr(sys, "_MEIPASS", os.getcwd())
     app_dir = ir.files(cg_manage_rds).joinpath("cf-app").as_posix()
-    os.chdir(app_dir)
     cmd = ["cf", "push", app_name, "-f", manifest]
-    code, result, status = run_sync(cmd)
-    os.chdir(orig_wd)
+    # cf push reads the app from the working directory, set only for the child
+    # since other steps may be running in threads
+    code, result, status = run_sync(cmd, cwd=app_dir)
     if code != 0:
         click.echo(status)
         raise click.ClickException(result)
@@ -30,6 +36,7 @@ def push_app(app_name: str, manifest: str = "manifest.yml") -> None:
     click.echo("App Running\n")
 
 
+@metrics.timed("cleanup")
 def delete_app(app_name: str) -> None:
     click.echo("Deleting app to space")
     cmd = ["cf", "delete", "-f", app_name]
@@ -41,6 +48,13 @@ def delete_app(app_name: str) -> None:
     click.echo("App Deleted\n")
 
 
+def app_running(app_name: str) -> bool:
+    cmd = ["cf", "app", app_name]
+    code, result, _ = run_sync(cmd)
+    return code == 0 and re.search(r"#\d+\s+running", result) is not None
+
+
+@metrics.timed("enable_ssh")
 def enable_ssh(app_name: str) -> None:
     click.echo("Enabling SSH on App")
     cmd = ["cf", "enable-ssh", app_name]
@@ -63,6 +77,7 @@ def create_service_key(key_name: str, service_name: str) -> None:
     click.echo("Service Key Created\n")
 
 
+@metrics.timed("cleanup")
 def delete_service_key(key_name: str, service_name: str) -> None:
     click.echo("Deleting Service Key...")
     cmd = ["cf", "delete-service-key", "-f", service_name, key_name]
@@ -71,6 +86,8 @@ def delete_service_key(key_name: str, service_name: str) -> None:
         click.echo(status)
         raise click.ClickException(result)
     click.echo(status)
+    # only this key, others of the service may start with its name
+    cache.delete(cache_key("key", service_name, key_name))
     click.echo("Service Key Deleted\n")
 
 
@@ -83,6 +100,23 @@ def get_service_key(key_name: str, service_name: str) -> dict:
         raise click.ClickException(result)
     click.echo(status)
     click.echo("Service Key Created.\n")
+    return parse_service_key(result)
+
+
+def find_service_key(key_name: str, service_name: str) -> Optional[dict]:
+    click.echo("Looking for existing Service Key...")
+    cmd = ["cf", "service-key", service_name, key_name]
+    code, result, status = run_sync(cmd)
+    click.echo(status)
+    if code != 0:
+        return None
+    try:
+        return parse_service_key(result)
+    except (ValueError, KeyError):
+        return None
+
+
+def parse_service_key(result: str) -> dict:
     cred_str = "\n".join(result.split("\n")[2:])
     credentials = json.loads(cred_str)
     if CF_VERSION == 8:
@@ -90,32 +124,216 @@ def get_service_key(key_name: str, service_name: str) -> dict:
     return credentials
 
 
-def create_ssh_tunnel(app_name: str, src_port: int, dst_port: int, host: str) -> int:
+@metrics.timed("service_key")
+def service_key_credentials(key_name: str, service_name: str) -> dict:
+    """
+    Credentials of a service key, from the cache, an existing key or a new one
+    """
+    key = cache_key("key", service_name, key_name)
+    creds = cache.get(key) if key else None
+    if creds is not None:
+        click.echo("Using cached Service Key\n")
+        return dict(creds)
+    creds = find_service_key(key_name, service_name)
+    if creds is None:
+        create_service_key(key_name, service_name)
+        creds = get_service_key(key_name, service_name)
+    else:
+        click.echo("Reusing existing Service Key\n")
+    if key:
+        cache.put(key, creds, cache.CREDENTIALS_TTL)
+    return dict(creds)
+
+
+def cache_key(kind: str, service_name: str, *extra: str) -> str:
+    # service names are only unique within a space
+    space = target()
+    if not space:
+        return ""
+    return ":".join([kind, space, service_name, *extra])
+
+
+def target() -> str:
+    """
+    api and space guid targeted by the cf cli, read from its config file
+    """
+    home = os.environ.get("CF_HOME") or os.path.expanduser("~")
+    try:
+        with open(os.path.join(home, ".cf", "config.json")) as fd:
+            config = json.load(fd)
+    except (OSError, ValueError):
+        return ""
+    space = config.get("SpaceFields", {}).get("GUID", "")
+    if not space:
+        return ""
+    return f"{config.get('Target', '')}/{space}"
+
+
+@metrics.timed("tunnel")
+def create_ssh_tunnel(
+    app_name: str,
+    src_port: int,
+    dst_port: int,
+    host: str,
+    probe: Callable[[socket.socket], bool] = None,
+    service_name: str = None,
+) -> int:
     click.echo("Starting SSH Tunnel via App")
     click.echo("Processing... ", nl=False)
-    tunnel = f"{src_port}:{host}:{dst_port}"
-    # cmd = ["cf", "ssh", app_name ,"-T","-L", tunnel ]
-    cmd = f"cf ssh {app_name} -N -T -L {tunnel} &"
-    proc = run_async(cmd, shell=True)
-    time.sleep(6)  # wait for tunnel to stabilize
-    if proc.poll() == 0:
+    service_name = service_name or f"{host}:{dst_port}"
+    proc = tunnels.start(service_name, app_name, src_port, host, dst_port)
+    elapsed = wait_for_tunnel(src_port, probe, proc=proc)
+    if elapsed is not None:
         click.secho("Command Succeeded!", fg="bright_green")
-        click.echo(f"SSH Tunnel Running with PID {proc.pid+1}\n")
+        click.echo(f"SSH Tunnel ready after {elapsed:.1f}s")
+        click.echo(f"SSH Tunnel Running with PID {proc.pid}\n")
     else:
         click.secho("Command Failed!\n", fg="red")
-        raise click.ClickException(proc.stderr.read())
-    return proc.pid + 1
+        entry = tunnels.find(service_name)
+        if entry is not None:
+            tunnels.stop(entry)
+            tunnels.forget(service_name)
+        err = tunnels.last_error(service_name)
+        raise click.ClickException(
+            err or f"SSH Tunnel on port {src_port} never came up"
+        )
+    return proc.pid
+
+
+@metrics.timed("tunnel")
+def create_ssh_tunnels(
+    app_name: str, forwards: dict, probes: Optional[dict] = None
+) -> int:
+    """
+    Forward every service in forwards, given as (local_port, host, remote_port),
+    through a single cf ssh so they share one ssh handshake and session.
+    Services already multiplexed through the app are carried over, since
+    cf ssh has to be restarted to change its set of forwards.
+    """
+    click.echo(f"Starting SSH Tunnel via App for {', '.join(forwards)}")
+    click.echo("Processing... ", nl=False)
+    forwards = dict(forwards)
+    current = {
+        svc: e
+        for svc, e in tunnels.list_all().items()
+        if e["app"] == app_name
+        and e.get("multiplex")
+        and svc not in forwards
+        and tunnels.is_running(e)
+    }
+    for entry in {e["pid"]: e for e in current.values()}.values():
+        tunnels.stop(entry)
+    for svc, e in current.items():
+        forwards[svc] = (e["local_port"], e["host"], e["remote_port"])
+    return _start_forwards(app_name, forwards, probes or {})
+
+
+def _start_forwards(app_name: str, forwards: dict, probes: dict) -> int:
+    log_name = f"{app_name}-forwards"
+    start = time.monotonic()
+    proc = tunnels.start_forwards(app_name, forwards, log_name, multiplex=True)
+    for svc, (local_port, _, _) in forwards.items():
+        # the forwards share one process, so after the first they come quickly
+        if wait_for_tunnel(local_port, probes.get(svc), proc=proc) is None:
+            click.secho("Command Failed!\n", fg="red")
+            tunnels.stop({"pid": proc.pid, "pgid": proc.pid})
+            for name in forwards:
+                tunnels.forget(name)
+            err = tunnels.last_error(log_name)
+            raise click.ClickException(
+                err or f"SSH Tunnel on port {local_port} for {svc} never came up"
+            )
+    click.secho("Command Succeeded!", fg="bright_green")
+    click.echo(f"SSH Tunnel ready after {time.monotonic() - start:.1f}s")
+    click.echo(f"SSH Tunnel Running with PID {proc.pid}\n")
+    return proc.pid
+
+
+def wait_for_tunnel(
+    port: int,
+    probe: Callable[[socket.socket], bool] = None,
+    timeout: float = TUNNEL_TIMEOUT,
+    proc: subprocess.Popen = None,
+) -> float:
+    """
+    Poll the local end of a tunnel until a connection through it is answered,
+    returns the seconds it took or None if the timeout passed first.
+    """
+    start = time.monotonic()
+    delay = 0.1
+    while True:
+        if proc is not None and proc.poll() is not None:
+            return None
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+                # the listener is up as soon as cf ssh starts, the probe
+                # makes sure the far side of the forward answers as well
+                if probe is None or probe(sock):
+                    return time.monotonic() - start
+        except OSError:
+            pass
+        elapsed = time.monotonic() - start
+        if elapsed + delay > timeout:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+
+
+@metrics.timed("cleanup")
+def delete_ssh_tunnel(pid: int = 0, service_name: str = None) -> None:
+    entry = tunnels.find(service_name, pid)
+    if entry is None:
+        if pid:
+            click.echo(f"No SSH Tunnel with PID of {pid} was started by this tool")
+        return
+    _close_tunnel(entry, [entry["service"]])
+
+
+@metrics.timed("cleanup")
+def delete_ssh_tunnels(service_names: list) -> None:
+    """
+    Close the tunnels of several services, restarting a multiplexed cf ssh
+    at most once for the forwards of other services it carries
+    """
+    closing = {}
+    for service_name in service_names:
+        entry = tunnels.find(service_name)
+        if entry is not None:
+            closing.setdefault(entry["pid"], (entry, []))[1].append(service_name)
+    for entry, names in closing.values():
+        _close_tunnel(entry, names)
 
 
-def delete_ssh_tunnel(pid: int) -> None:
+def _close_tunnel(entry: dict, service_names: list) -> None:
+    pid = entry["pid"]
+    others = {
+        svc: e for svc, e in tunnels.sharing(entry).items() if svc not in service_names
+    }
     click.echo(f"Closing SSH Tunnel with PID of {pid}")
     click.echo("Processing.... ", nl=False)
-    os.kill(pid, signal.SIGKILL)
+    stopped = tunnels.stop(entry)
+    for service_name in service_names:
+        tunnels.forget(service_name)
     click.secho("Command Succeeded!", fg="bright_green")
-    click.echo(f"SSH Tunnel with PID of {pid} closed\n")
+    if stopped:
+        click.echo(f"SSH Tunnel with PID of {pid} closed\n")
+    else:
+        click.echo(f"SSH Tunnel with PID of {pid} had already exited\n")
+    if stopped and others:
+        click.echo(f"Restarting SSH Tunnel for {', '.join(others)}")
+        forwards = {
+            svc: (e["local_port"], e["host"], e["remote_port"])
+            for svc, e in others.items()
+        }
+        _start_forwards(entry["app"], forwards, {})
 
 
+@metrics.timed("plan")
 def get_service_plan(service: str) -> str:
+    key = cache_key("plan", service)
+    plan = cache.get(key) if key else None
+    if plan is not None:
+        return plan
     click.echo("Retrieving Service Info...")
     cmd = ["cf", "service", service]
     code, result, status = run_sync(cmd)
@@ -124,17 +342,45 @@ def get_service_plan(service: str) -> str:
         click.echo(status)
         raise click.ClickException(result)
     planline = planmatch.group()
-    return planline.split()[-1]
+    plan = planline.split()[-1]
+    if key:
+        cache.put(key, plan, cache.PLAN_TTL)
+    return plan
+
+
+def list_services(offering: str = "aws-rds") -> list:
+    click.echo("Retrieving Services in space...")
+    cmd = ["cf", "services"]
+    code, result, status = run_sync(cmd)
+    if code != 0:
+        click.echo(status)
+        raise click.ClickException(result)
+    click.echo(status)
+    return parse_services(result, offering)
+
+
+def parse_services(result: str, offering: str = "aws-rds") -> list:
+    services = []
+    lines = result.split("\n")
+    header = next((i for i, x in enumerate(lines) if x.startswith("name ")), None)
+    if header is None:
+        return services
+    for line in lines[header + 1 :]:
+        # name, offering and plan are always set, later columns may be blank
+        fields = line.split()
+        if len(fields) >= 3 and fields[1] == offering:
+            services.append(fields[0])
+    return services
 
 
+@metrics.timed("cf_version")
 def check_cf_cli() -> None:
     global CF_VERSION_PASSED
     global CF_VERSION
     if not CF_VERSION_PASSED:
         click.echo("Checking for CF version")
-        cmd = ["cf", "--version"]
-        code, result, _ = run_sync(cmd)
-        if code != 0:
+        result = tools.version("cf")
+        if result is None:
             errstr = click.style(
                 "\ncf versions {} are supported, but none was found".format(
                     ALLOWED_CF_VERSIONS
@@ -0,0 +1,127 @@
+import shutil
+import subprocess
+from typing import Optional
+import click
+from cg_manage_rds.cmds.utils import READ_SIZE, run_pipeline
+from cg_manage_rds.cmds import progress
+
+# leading bytes of each supported compressed stream
+MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "lz4": b"\x04\x22\x4d\x18",
+}
+CODECS = list(MAGIC)
+
+
+class Codec:
+    """
+    An external compressor used to write and read export files
+    """
+
+    def __init__(self, name: str, level: int = None, threads: int = None):
+        if name not in MAGIC:
+            raise click.ClickException(f"Unsupported compression: {name}")
+        self.name = name
+        self.level = level
+        self.threads = threads
+
+    def binary(self) -> str:
+        # pigz is a drop in parallel gzip
+        if self.name == "gzip" and (self.threads or 1) > 1 and shutil.which("pigz"):
+            return "pigz"
+        return self.name
+
+    def check(self) -> None:
+        if shutil.which(self.binary()) is None:
+            errstr = click.style(
+                f"\n{self.binary()} application is required but not found", fg="red"
+            )
+            raise click.ClickException(errstr)
+
+    def compress_cmd(self) -> list:
+        cmd = [self.binary(), "-q", "-c"]
+        if self.level is not None:
+            cmd.append(f"-{self.level}")
+        if self.threads and self.binary() == "pigz":
+            cmd.extend(["-p", str(self.threads)])
+        elif self.threads and self.name == "zstd":
+            cmd.append(f"-T{self.threads}")
+        return cmd
+
+    def decompress_cmd(self, file_name: str = None) -> list:
+        # without a file name the compressed stream is read from stdin
+        cmd = [self.binary(), "-q", "-d", "-c"]
+        return cmd + [file_name] if file_name else cmd
+
+
+def detect(file_name: str) -> Optional[Codec]:
+    with open(file_name, "rb") as fd:
+        head = fd.read(4)
+    for name, magic in MAGIC.items():
+        if head.startswith(magic):
+            return Codec(name)
+    return None
+
+
+def peek(codec: Codec, file_name: str, size: int) -> bytes:
+    """
+    First size bytes of the decompressed contents of file_name
+    """
+    proc = subprocess.Popen(
+        codec.decompress_cmd(file_name),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        head = proc.stdout.read(size)
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    return head
+
+
+def export_to(cmd: list, codec: Codec, backup_file: str) -> None:
+    """
+    Pipe an export client writing to stdout through the codec into backup_file
+    """
+    cmds = [cmd, codec.compress_cmd()]
+    click.echo("Exporting with:")
+    click.echo(
+        click.style(
+            "\t" + " | ".join(" ".join(c) for c in cmds) + f" > {backup_file}",
+            fg="yellow",
+        )
+    )
+    code, result, status = run_pipeline(cmds, backup_file, progress.counter())
+    if code != 0:
+        click.echo(status)
+        raise click.ClickException(result)
+    click.echo(status)
+    click.echo("Export complete\n")
+
+
+def import_from(codec: Codec, backup_file: str, cmd: list) -> None:
+    """
+    Decompress backup_file into an import client reading stdin, the file
+    is fed to the codec so progress counts compressed bytes like the total
+    """
+    cmds = [codec.decompress_cmd(), cmd]
+    click.echo("Importing with:")
+    click.echo(
+        click.style(
+            "\t" + " | ".join(" ".join(c) for c in cmds) + f" < {backup_file}",
+            fg="yellow",
+        )
+    )
+    with open(backup_file, "rb") as fd:
+        chunks = iter(lambda: fd.read(READ_SIZE), b"")
+        code, result, status = run_pipeline(
+            cmds, counter=progress.counter(), chunks=chunks
+        )
+    if code != 0:
+        click.echo(status)
+        raise click.ClickException(result)
+    click.echo(status)
+    click.echo("Import complete\n")
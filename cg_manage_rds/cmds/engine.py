@@ -1,4 +1,9 @@
+import socket
 from abc import ABC, abstractmethod
+from typing import Callable
+import click
+from cg_manage_rds.cmds.compress import Codec
+from cg_manage_rds.cmds.utils import run_pipeline, run_sync
 
 
 class Engine(ABC):
@@ -10,6 +15,11 @@ class Engine(ABC):
         backup_file: str,
         options: str = None,
         ignore: bool = False,
+        jobs: int = 1,
+        codec: Codec = None,
+        resume: bool = False,
+        incremental: bool = False,
+        shards: tuple = (),
     ) -> None:
         pass
 
@@ -21,6 +31,9 @@ class Engine(ABC):
         backup_file: str,
         options: str = None,
         ignore: bool = False,
+        jobs: int = 1,
+        resume: bool = False,
+        split: bool = False,
     ) -> None:
         pass
 
@@ -29,7 +42,21 @@ class Engine(ABC):
         pass
 
     @abstractmethod
-    def credentials(self, service_name: str, key_name: str = "key") -> dict:
+    def credentials(
+        self, service_name: str, key_name: str = "key", local_port: int = None
+    ) -> dict:
+        pass
+
+    @abstractmethod
+    def stream_export_cmd(
+        self, creds: dict, options: str = None, ignore: bool = False
+    ) -> list:
+        pass
+
+    @abstractmethod
+    def stream_import_cmd(
+        self, creds: dict, options: str = None, ignore: bool = False
+    ) -> list:
         pass
 
     @abstractmethod
@@ -39,3 +66,88 @@ class Engine(ABC):
     @abstractmethod
     def default_import_options(self, options: str, ignore: bool = False) -> list:
         pass
+
+    @abstractmethod
+    def handshake(self, sock: socket.socket) -> bool:
+        pass
+
+    def stream(
+        self,
+        src_creds: dict,
+        dst_creds: dict,
+        backup_options: str = None,
+        restore_options: str = None,
+        ignore: bool = False,
+        jobs: int = 1,
+        counter: Callable[[int], None] = None,
+    ) -> None:
+        """
+        Move a database between two services without a local file, by
+        default the export client is piped into the import client
+        """
+        if jobs > 1:
+            click.echo("A streamed clone is a single pipe, --jobs is ignored")
+        cmds = [
+            self.stream_export_cmd(src_creds, backup_options, ignore),
+            self.stream_import_cmd(dst_creds, restore_options, ignore),
+        ]
+        click.echo("Streaming with:")
+        click.echo(
+            click.style("\t" + " | ".join(" ".join(c) for c in cmds), fg="yellow")
+        )
+        code, result, status = run_pipeline(cmds, counter=counter)
+        click.echo(status)
+        if code != 0:
+            raise click.ClickException(result)
+
+    def table_sizes(self, creds: dict) -> dict:
+        """
+        Estimated bytes of each table, used to report progress
+        """
+        return {}
+
+    def database_size(self, creds: dict) -> int:
+        """
+        Bytes the database takes up, with its indexes
+        """
+        return sum(self.table_sizes(creds).values())
+
+    def dump_compressed(
+        self, options: str, ignore: bool = False, jobs: int = 1, tables: bool = False
+    ) -> bool:
+        """
+        Whether the client compresses an export with these options itself,
+        tables is true for table level dumps
+        """
+        return False
+
+    def file_compressed(self, backup_file: str) -> bool:
+        """
+        Whether the client compressed this dump itself
+        """
+        return False
+
+    def table_fingerprints(self, creds: dict) -> dict:
+        """
+        A value per table that changes whenever its rows do, incremental
+        exports dump only the tables whose value has changed
+        """
+        return {}
+
+    def _run(self, cmd: list, env: dict = None) -> str:
+        """
+        Output of a client command, raising its error output when it fails
+        """
+        code, result, status = run_sync(cmd, env=env)
+        if code != 0:
+            click.echo(status)
+            raise click.ClickException(result)
+        return result
+
+    def _raise_failures(self, failures: list) -> None:
+        if not failures:
+            return
+        for item, err in failures:
+            msg = err.format_message() if isinstance(err, click.ClickException) else err
+            click.secho(f"{item}: {msg}", fg="red")
+        raise click.ClickException(f"{len(failures)} parallel steps failed")
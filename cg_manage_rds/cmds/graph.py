@@ -0,0 +1,78 @@
+import inspect
+from typing import Any, Awaitable, Callable, Iterable
+
+# asyncio is slow to import and only the commands that set up tunnels need
+# it, so it is imported on first use by the functions below
+
+
+def run(main: Awaitable) -> Any:
+    """
+    Run a coroutine on a new event loop, like asyncio.run
+    """
+    import asyncio
+
+    return asyncio.run(main)
+
+
+async def to_thread(fn: Callable, *args) -> Any:
+    """
+    Run a blocking function in a worker thread, like asyncio.to_thread
+    """
+    import asyncio
+
+    return await asyncio.to_thread(fn, *args)
+
+
+class Graph:
+    """
+    Steps with dependencies, each started as soon as the steps it depends on
+    have finished. Blocking steps run in worker threads so independent cf
+    calls overlap; coroutine functions are awaited on the loop.
+    """
+
+    def __init__(self):
+        self.steps = {}
+        self.results = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.steps
+
+    def add(self, name: str, fn: Callable, after: Iterable[str] = ()) -> None:
+        after = list(after)
+        missing = [x for x in after if x not in self.steps]
+        if missing:
+            # steps are added after their dependencies, so there are no cycles
+            raise ValueError(f"{name} depends on unknown steps {missing}")
+        self.steps[name] = (fn, after)
+
+    async def run(self) -> dict:
+        """
+        Run every step and return their results by name. When a step fails
+        the steps not yet started are cancelled, and the failure is raised
+        once the running ones have finished.
+        """
+        import asyncio
+
+        tasks = {}
+
+        async def run_step(name: str):
+            fn, after = self.steps[name]
+            for dep in after:
+                await tasks[dep]
+            if inspect.iscoroutinefunction(fn):
+                result = await fn()
+            else:
+                result = await to_thread(fn)
+            self.results[name] = result
+            return result
+
+        for name in self.steps:
+            tasks[name] = asyncio.ensure_future(run_step(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return self.results
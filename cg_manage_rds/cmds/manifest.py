@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+from typing import Callable, Optional, Tuple
+import click
+
+MANIFEST_FILE = "manifest.json"
+# manifest format of a directory of incremental exports
+CHAIN_FORMAT = "cg-manage-rds/chain"
+
+
+def write(directory: str, manifest: dict) -> None:
+    tmp = os.path.join(directory, MANIFEST_FILE + ".tmp")
+    with open(tmp, "w") as fd:
+        json.dump(manifest, fd, indent=2)
+    os.replace(tmp, os.path.join(directory, MANIFEST_FILE))
+
+
+def read(directory: str) -> Optional[dict]:
+    """
+    The manifest of a dump directory written by this tool, if there is one
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def resolve(directory: str) -> Tuple[str, Optional[dict]]:
+    """
+    Directory and manifest of the dump to import, for a chain of incremental
+    exports that is its newest link, which refers to the unchanged tables
+    of the links before it
+    """
+    dump = read(directory)
+    if dump is None or dump.get("format") != CHAIN_FORMAT:
+        return directory, dump
+    if not dump["links"]:
+        raise click.ClickException(f"{directory} holds no finished export yet")
+    link = os.path.join(directory, dump["links"][-1])
+    return link, read(link)
+
+
+def next_link(directory: str) -> Tuple[str, Optional[Tuple[str, dict]]]:
+    """
+    Directory for the next incremental export into a chain, and the
+    directory and manifest of the export before it if there is one
+    """
+    chain = read(directory)
+    if chain is None:
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise click.ClickException(f"{directory} is not an incremental export")
+        os.makedirs(directory, exist_ok=True)
+        chain = {"format": CHAIN_FORMAT, "version": 1, "links": []}
+        write(directory, chain)
+    elif chain.get("format") != CHAIN_FORMAT:
+        raise click.ClickException(f"{directory} is not an incremental export")
+    # a link is only added to the chain once it is complete
+    link = os.path.join(directory, f"{len(chain['links']):04d}")
+    previous = None
+    if chain["links"]:
+        last = os.path.join(directory, chain["links"][-1])
+        previous = (last, read(last))
+    return link, previous
+
+
+def add_link(directory: str, link: str) -> None:
+    chain = read(directory)
+    chain["links"].append(os.path.basename(link))
+    write(directory, chain)
+
+
+def unchanged(
+    link: str, previous: Optional[Tuple[str, dict]], fingerprints: dict
+) -> dict:
+    """
+    Data files of the previous export, relative to link, for the tables
+    whose fingerprint is the same as it was then
+    """
+    if previous is None:
+        return {}
+    last, dump = previous
+    before = dump.get("fingerprints", {})
+    return {
+        table: os.path.relpath(os.path.join(last, dump["data"][table]), link)
+        for table, fingerprint in fingerprints.items()
+        if fingerprint is not None
+        and before.get(table) == fingerprint
+        and table in dump["data"]
+    }
+
+
+class Checkpoint:
+    """
+    Units of work finished in one phase of a dump, recorded next to the dump
+    so an interrupted run can be resumed
+    """
+
+    def __init__(self, backup_file: str, phase: str, resume: bool = False):
+        self.path = backup_file.rstrip("/\\") + ".checkpoint.json"
+        self.phase = phase
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path) as fd:
+                self.state = json.load(fd)
+        if not resume or phase not in self.state:
+            self.state[phase] = []
+            self._save()
+
+    def __contains__(self, unit: str) -> bool:
+        with self.lock:
+            return unit in self.state[self.phase]
+
+    def done(self, unit: str) -> None:
+        with self.lock:
+            self.state[self.phase].append(unit)
+            self._save()
+
+    def run(self, unit: str, fn: Callable, *args) -> None:
+        if unit in self:
+            click.echo(f"Skipping {unit}, already done")
+            return
+        fn(*args)
+        self.done(unit)
+
+    def _save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fd:
+            json.dump(self.state, fd, indent=2)
+        os.replace(tmp, self.path)
@@ -0,0 +1,280 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import click
+
+# where the report of each run is written, nothing is recorded when both are unset
+JSON_FILE = None
+PROMETHEUS_FILE = None
+PREFIX = "cg_manage_rds"
+
+_current = contextvars.ContextVar("metrics", default=None)
+
+
+class Phase:
+    def __init__(self, name: str, service: str = None):
+        self.name = name
+        self.service = service
+        self.bytes = None
+        self.status = "ok"
+        self.error = None
+        self.started = time.time()
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def counter(self, forward: Callable[[int], None] = None) -> Callable[[int], None]:
+        """
+        Byte counter for a pipe, passing the counts on to forward as well
+        """
+
+        def count(nbytes: int) -> None:
+            # pipes of concurrent tables may count at the same time
+            with self.lock:
+                self.bytes = (self.bytes or 0) + nbytes
+            if forward is not None:
+                forward(nbytes)
+
+        return count
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "service": self.service,
+            "started": round(self.started, 3),
+            "seconds": round(self.seconds, 3),
+            "status": self.status,
+            "error": self.error,
+            "bytes": self.bytes,
+        }
+
+
+class Run:
+    """
+    Timings of the phases of one command, in the order they finished
+    """
+
+    def __init__(self, command: str, labels: dict):
+        self.command = command
+        self.labels = labels
+        self.phases = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.seconds = 0.0
+        self.status = "ok"
+        self.error = None
+
+    def add(self, phase: Phase) -> None:
+        with self.lock:
+            self.phases.append(phase)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            phases = [p.to_dict() for p in self.phases]
+        return {
+            "command": self.command,
+            "labels": self.labels,
+            "started": round(self.started, 3),
+            "seconds": round(self.seconds, 3),
+            "status": self.status,
+            "error": self.error,
+            "phases": phases,
+        }
+
+    def prometheus(self) -> str:
+        """
+        Textfile collector format, phases that ran more than once are summed
+        """
+        base = dict(self.labels, command=self.command)
+        totals = {}
+        with self.lock:
+            for p in self.phases:
+                key = (p.name, p.service or "")
+                total = totals.setdefault(
+                    key, {"seconds": 0.0, "bytes": None, "failed": 0, "count": 0}
+                )
+                total["seconds"] += p.seconds
+                total["count"] += 1
+                total["failed"] += p.status != "ok"
+                if p.bytes is not None:
+                    total["bytes"] = (total["bytes"] or 0) + p.bytes
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples: list) -> None:
+            lines.append(f"# HELP {PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{PREFIX}_{name}{{{_labels(labels)}}} {value}")
+
+        def phase(name, service):
+            return dict(base, phase=name, **({"service": service} if service else {}))
+
+        metric(
+            "phase_seconds",
+            "gauge",
+            "Wall time spent in a phase of the last run",
+            [(phase(*k), round(t["seconds"], 3)) for k, t in totals.items()],
+        )
+        metric(
+            "phase_runs",
+            "gauge",
+            "Times a phase ran during the last run",
+            [(phase(*k), t["count"]) for k, t in totals.items()],
+        )
+        metric(
+            "phase_failures",
+            "gauge",
+            "Times a phase failed during the last run",
+            [(phase(*k), t["failed"]) for k, t in totals.items()],
+        )
+        metric(
+            "phase_bytes",
+            "gauge",
+            "Bytes moved by a phase of the last run",
+            [(phase(*k), t["bytes"]) for k, t in totals.items() if t["bytes"]],
+        )
+        metric(
+            "run_seconds",
+            "gauge",
+            "Wall time of the last run",
+            [(base, round(self.seconds, 3))],
+        )
+        metric(
+            "run_success",
+            "gauge",
+            "1 when the last run succeeded",
+            [(base, int(self.status == "ok"))],
+        )
+        metric(
+            "run_timestamp_seconds",
+            "gauge",
+            "Unix time the last run finished",
+            [(base, round(self.started + self.seconds, 3))],
+        )
+        return "\n".join(lines) + "\n"
+
+
+def enabled() -> bool:
+    return JSON_FILE is not None or PROMETHEUS_FILE is not None
+
+
+@contextmanager
+def phase(name: str, service: str = None) -> Iterator[Phase]:
+    """
+    Time the enclosed block as a phase of the current run, if one is recorded
+    """
+    run = _current.get()
+    p = Phase(name, service)
+    if run is None:
+        yield p
+        return
+    start = time.monotonic()
+    try:
+        yield p
+    except BaseException as e:
+        p.status = "failed"
+        p.error = e.format_message() if isinstance(e, click.ClickException) else str(e)
+        raise
+    finally:
+        p.seconds = time.monotonic() - start
+        run.add(p)
+
+
+def timed(name: str) -> Callable:
+    """
+    Record every call of the decorated function as a phase
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        sig = inspect.signature(fn)
+        service_arg = next(
+            (a for a in ["service_name", "service"] if a in sig.parameters), None
+        )
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            service = None
+            if service_arg is not None:
+                bound = sig.bind_partial(*args, **kwargs)
+                service = bound.arguments.get(service_arg)
+            with phase(name, service):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def recorded(command: str, **label_args: str) -> Callable:
+    """
+    Record the decorated command as a run, labelled with the values of the
+    arguments named by label_args, and write its report when it finishes
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # a command called by another is part of the outer run
+            if not enabled() or _current.get() is not None:
+                return fn(*args, **kwargs)
+            bound = sig.bind_partial(*args, **kwargs)
+            labels = {}
+            for label, arg in label_args.items():
+                value = bound.arguments.get(arg)
+                if value is not None:
+                    labels[label] = str(value)
+            run = Run(command, labels)
+            token = _current.set(run)
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:
+                run.status = "failed"
+                run.error = (
+                    e.format_message()
+                    if isinstance(e, click.ClickException)
+                    else str(e)
+                )
+                raise
+            finally:
+                run.seconds = time.monotonic() - start
+                _current.reset(token)
+                write(run)
+
+        return wrapper
+
+    return decorator
+
+
+def write(run: Run) -> None:
+    if JSON_FILE is not None:
+        _write_atomic(JSON_FILE, json.dumps(run.to_dict(), indent=2) + "\n")
+    if PROMETHEUS_FILE is not None:
+        # the textfile collector may read at any time, so never a partial file
+        _write_atomic(PROMETHEUS_FILE, run.prometheus())
+
+
+def _write_atomic(path: str, text: str) -> None:
+    if path == "-":
+        click.echo(text, nl=False)
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fd:
+        fd.write(text)
+    os.replace(tmp, path)
+
+
+def _labels(labels: dict) -> str:
+    def escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
@@ -1,30 +1,37 @@
+import os
+import re
+import socket
+from typing import Iterable, Iterator, Tuple
 import click
-from cg_manage_rds.cmds.utils import run_sync
+from cg_manage_rds.cmds.utils import run_sync, run_feed, run_parallel
+from cg_manage_rds.cmds import manifest
+from cg_manage_rds.cmds import progress
+from cg_manage_rds.cmds import tools
 from cg_manage_rds.cmds.engine import Engine
 from cg_manage_rds.cmds import cf_cmds as cf
+from cg_manage_rds.cmds import compress
+from cg_manage_rds.cmds.compress import Codec
+
+# manifest format of a table level dump directory
+TABLES_FORMAT = "cg-manage-rds/mysql-tables"
+# secondary keys and foreign keys are added after the data is loaded
+DEFERRED_KEY = re.compile(r"^\s*(UNIQUE |FULLTEXT |SPATIAL )?KEY ")
+DEFERRED_FK = re.compile(r"^\s*CONSTRAINT .* FOREIGN KEY ")
+# rows are loaded before any key exists to check them against
+NO_CHECKS = "--init-command=SET SESSION foreign_key_checks=0, SESSION unique_checks=0"
+# a dump fed to stdin is committed every COMMIT_BYTES rather than after
+# each statement, commits are added to the stream so none are left open
+BULK_LOAD = NO_CHECKS + ", SESSION autocommit=0"
+COMMIT_BYTES = 64 * 1024 * 1024
+# the client's limit on one statement, extended inserts can be long
+MAX_PACKET = "--max-allowed-packet=1G"
 
 
 class MySql(Engine):
     def prerequisites(self) -> None:
         cf.check_cf_cli()
         click.echo("Checking for locally installed mysql utilities")
-        cmd = ["which", "mysql"]
-        code, _, _ = run_sync(cmd)
-        if code != 0:
-            errstr = click.style(
-                "\nmysql application is required but not found", fg="red"
-            )
-            raise click.ClickException(errstr)
-        click.echo(click.style("\nmysql found!", fg="bright_green"))
-
-        cmd = ["which", "mysqldump"]
-        code, _, _ = run_sync(cmd)
-        if code != 0:
-            errstr = click.style(
-                "\nmysqldump application is required but not found", fg="red"
-            )
-            raise click.ClickException(errstr)
-        click.echo(click.style("\nmysqldump found!", fg="bright_green"))
+        tools.require("mysql", "mysqldump")
 
     def export_svc(
         self,
@@ -33,8 +40,32 @@ class MySql(Engine):
         backup_file: str,
         options: str = "",
         ignore: bool = False,
+        jobs: int = 1,
+        codec: Codec = None,
+        resume: bool = False,
+        incremental: bool = False,
+        shards: tuple = (),
     ) -> None:
         click.echo(f"Exporting from MySql DB: {svc_name}")
+        if shards:
+            click.echo("Only postgres tables can be sharded, they are dumped whole")
+        if (jobs > 1 or resume or incremental) and codec is not None:
+            raise click.ClickException("Table level dumps can not be compressed")
+        if incremental:
+            link, previous = manifest.next_link(backup_file)
+            fingerprints = self.table_fingerprints(creds)
+            self._export_tables(
+                creds, link, options, ignore, jobs, resume, previous, fingerprints
+            )
+            manifest.add_link(backup_file, link)
+            return
+        if jobs > 1 or resume:
+            self._export_tables(creds, backup_file, options, ignore, jobs, resume)
+            return
+        if codec is not None:
+            cmd = self.stream_export_cmd(creds, options, ignore)
+            compress.export_to(cmd, codec, backup_file)
+            return
         opts = self.default_export_options(options, ignore)
         base_opts = self._creds_to_opts(creds)
         cmd = ["mysqldump"]
@@ -58,34 +89,99 @@ class MySql(Engine):
         backup_file: str,
         options: str = "",
         ignore: bool = False,
+        jobs: int = 1,
+        resume: bool = False,
+        split: bool = False,
     ) -> None:
-        # mysql -u"user" -p"passwd" -h"127.0.0.1" -P"33306" -D"databasename" -e"source backup_file"
+        # mysql -u"user" -p"passwd" -h"127.0.0.1" -P"33306" -D"databasename" < backup_file
         click.echo(f"Importing to MySql DB: {svc_name}")
-        opts = self.default_import_options(options, ignore)
-        base_opts = self._creds_to_opts(creds)
+        dump = None
+        if os.path.isdir(backup_file):
+            backup_file, dump = manifest.resolve(backup_file)
+        if dump is not None and dump.get("format") == TABLES_FORMAT:
+            # table level dumps always defer their keys
+            self._import_tables(creds, backup_file, dump, options, ignore, jobs, resume)
+            return
+        if dump is None and self.tab_tables(backup_file):
+            self._import_tab(creds, backup_file, options, ignore, jobs)
+            return
+        if os.path.isdir(backup_file):
+            raise click.ClickException(
+                f"{backup_file} is a directory but not a mysql dump, expected a "
+                "table level export with a manifest.json or the .sql and .txt "
+                "files of mysqldump --tab"
+            )
+        if resume:
+            click.echo("Only table level dumps can be resumed")
+        codec = compress.detect(backup_file)
+        if codec is not None:
+            click.echo(f"{backup_file} is {codec.name} compressed")
+            codec.check()
+            cmd = self.stream_import_cmd(creds, options, ignore)
+            if split:
+                click.echo("Keys of compressed dumps are created with the tables")
+                cmd.insert(-1, NO_CHECKS)
+            compress.import_from(codec, backup_file, cmd)
+            return
+        if split:
+            self._import_split(creds, backup_file, options, ignore, jobs)
+            return
+        if jobs > 1:
+            click.echo("Only table level dumps can be imported in parallel")
         cmd = ["mysql"]
-        cmd.extend(base_opts)
-        cmd.extend(opts)
-        cmd.extend([f"-D{creds['db_name']}", f"-e source {backup_file};"])
+        cmd.extend(self._creds_to_opts(creds))
+        # the user's options come after, so their own init command wins
+        cmd.extend([MAX_PACKET, BULK_LOAD])
+        cmd.extend(self.default_import_options(options, ignore))
+        cmd.append(f"-D{creds['db_name']}")
         click.echo("Importing with:")
-        click.echo(click.style("\t" + " ".join(cmd), fg="yellow"))
-        code, result, status = run_sync(cmd)
+        click.echo(click.style("\t" + " ".join(cmd) + f" < {backup_file}", fg="yellow"))
+        with open(backup_file, "rb") as fd:
+            chunks = self.batch_commits(fd)
+            code, result, status = run_feed(cmd, chunks, progress.counter())
         if code != 0:
             click.echo(status)
             raise click.ClickException(result)
         click.echo(status)
         click.echo("Import complete\n")
 
-    def credentials(self, service_name: str, key_name: str = "key") -> dict:
-        cf.create_service_key(key_name, service_name)
-        creds = cf.get_service_key(key_name, service_name)
-        creds["local_port"] = int(creds.get("port")) + 30000
+    def credentials(
+        self, service_name: str, key_name: str = "key", local_port: int = None
+    ) -> dict:
+        creds = cf.service_key_credentials(key_name, service_name)
+        if local_port is None:
+            local_port = int(creds.get("port")) + 30000
+        creds["local_port"] = local_port
         creds["local_host"] = "127.0.0.1"
         creds["uri"] = (
             f"mysql -u\"{creds['username']}\" -p\"{creds['password']}\" -h\"{creds['local_host']}\" -P\"{creds['local_port']}\" -D\"{creds['db_name']}\""
         )
         return creds
 
+    def stream_export_cmd(
+        self, creds: dict, options: str = None, ignore: bool = False
+    ) -> list:
+        cmd = ["mysqldump"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.extend(self.default_export_options(options, ignore))
+        cmd.append(creds["db_name"])
+        return cmd
+
+    def stream_import_cmd(
+        self, creds: dict, options: str = None, ignore: bool = False
+    ) -> list:
+        cmd = ["mysql"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.append(MAX_PACKET)
+        cmd.extend(self.default_import_options(options, ignore))
+        cmd.append(f"-D{creds['db_name']}")
+        return cmd
+
+    def handshake(self, sock: socket.socket) -> bool:
+        # the server speaks first, protocol v10 greeting or an error packet
+        head = sock.recv(5, socket.MSG_WAITALL)
+        return len(head) == 5 and head[4] in (0x0A, 0xFF)
+
     def default_export_options(self, options: str, ignore: bool = False) -> list:
         if options is not None:
             opts = options.split()
@@ -121,3 +217,400 @@ class MySql(Engine):
         opts += f"-P{creds['local_port']} "
         opts += f"-h{creds['local_host']} "
         return opts.split()
+
+    def tables(self, creds: dict) -> list:
+        cmd = ["mysql"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.extend(["-N", "-B", f"-D{creds['db_name']}"])
+        cmd.append("-e SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+        result = self._run(cmd)
+        return [x.split("\t")[0] for x in result.split("\n") if x.strip()]
+
+    def table_sizes(self, creds: dict) -> dict:
+        cmd = ["mysql"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.extend(["-N", "-B", f"-D{creds['db_name']}"])
+        cmd.append(
+            "-e SELECT table_name, data_length FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE'"
+        )
+        sizes = {}
+        for line in self._run(cmd).split("\n"):
+            if "\t" in line:
+                table, size = line.rsplit("\t", 1)
+                sizes[table] = int(size) if size.isdigit() else 0
+        return sizes
+
+    def database_size(self, creds: dict) -> int:
+        cmd = ["mysql"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.extend(["-N", "-B", f"-D{creds['db_name']}"])
+        cmd.append(
+            "-e SELECT COALESCE(SUM(data_length + index_length), 0) "
+            "FROM information_schema.tables WHERE table_schema = DATABASE()"
+        )
+        return int(self._run(cmd))
+
+    def table_fingerprints(self, creds: dict) -> dict:
+        # the change times of innodb tables do not survive a restart,
+        # so the rows themselves are checksummed
+        tables = self.tables(creds)
+        cmd = ["mysql"]
+        cmd.extend(self._creds_to_opts(creds))
+        cmd.extend(["-N", "-B", f"-D{creds['db_name']}"])
+        prefix = f"{creds['db_name']}."
+        fingerprints = {}
+        for i in range(0, len(tables), 100):
+            names = ", ".join(
+                "`" + t.replace("`", "``") + "`" for t in tables[i : i + 100]
+            )
+            for line in self._run(cmd + [f"-e CHECKSUM TABLE {names}"]).split("\n"):
+                if "\t" in line:
+                    table, checksum = line.rsplit("\t", 1)
+                    if table.startswith(prefix):
+                        table = table[len(prefix) :]
+                    fingerprints[table] = None if checksum == "NULL" else checksum
+        return fingerprints
+
+    def _export_tables(
+        self,
+        creds: dict,
+        directory: str,
+        options: str,
+        ignore: bool,
+        jobs: int,
+        resume: bool = False,
+        previous: Tuple[str, dict] = None,
+        fingerprints: dict = None,
+    ) -> None:
+        """
+        Dump the schema once and each table's data to its own file concurrently.
+        Tables unchanged since the previous export refer to its data files.
+        """
+        checkpoint = manifest.Checkpoint(directory, "export", resume)
+        dump = manifest.read(directory) if resume else None
+        if dump is None or dump.get("format") != TABLES_FORMAT:
+            os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+            tables = self.tables(creds)
+            fingerprints = fingerprints or {}
+            reused = manifest.unchanged(directory, previous, fingerprints)
+            dump = {
+                "format": TABLES_FORMAT,
+                "version": 1,
+                "db_name": creds["db_name"],
+                "pre_data": "pre-data.sql",
+                # file names are by position so any table name is safe on disk
+                "data": {
+                    t: reused.get(t, f"data/{i:05d}.sql") for i, t in enumerate(tables)
+                },
+                "post_data": {"keys": {}, "fks": {}},
+                "triggers": "triggers.sql",
+                "fingerprints": {t: fingerprints.get(t) for t in tables},
+                "reused": sorted(t for t in tables if t in reused),
+            }
+            manifest.write(directory, dump)
+        base = ["mysqldump"]
+        base.extend(self._creds_to_opts(creds))
+        base.extend(self.default_export_options(options, ignore))
+
+        click.echo("Exporting schema")
+        checkpoint.run("schema", self._export_schema, base, creds, directory, dump)
+
+        # one consistent read per table, mysqldump can not share a snapshot
+        # between its processes so the tables are read at different moments
+        locks = ["-l", "--lock-tables", "-x", "--lock-all-tables"]
+        if not any(o in locks + ["--single-transaction"] for o in base):
+            base.append("--single-transaction")
+        click.secho(
+            "Each table is read in its own transaction, stop writes to "
+            f"{creds['db_name']} for a consistent export across tables",
+            fg="yellow",
+        )
+
+        def dump_table(table: str) -> None:
+            out = os.path.join(directory, dump["data"][table])
+            cmd = base + ["--no-create-info", "--skip-triggers", "-r", out]
+            self._run(cmd + [creds["db_name"], table])
+            progress.table_done(table, out)
+            click.echo(f"Exported table {table}")
+
+        reused = dump.get("reused", [])
+        if reused:
+            click.echo(f"{len(reused)} tables are unchanged since the last export")
+        changed = [t for t in dump["data"] if t not in reused]
+        click.echo(f"Exporting {len(changed)} tables with {jobs} jobs")
+        failures = run_parallel(
+            lambda t: checkpoint.run(f"data:{t}", dump_table, t), changed, jobs
+        )
+        self._raise_failures(failures)
+        click.echo("Export complete\n")
+
+    def _export_schema(self, base: list, creds: dict, directory: str, dump: dict):
+        schema = os.path.join(directory, "schema.sql")
+        self._run(
+            base + ["--no-data", "--skip-triggers", "-r", schema, creds["db_name"]]
+        )
+        with open(schema) as fd:
+            pre, keys, fks = self.split_schema(fd.read())
+        os.remove(schema)
+        with open(os.path.join(directory, dump["pre_data"]), "w") as fd:
+            fd.write(pre)
+        os.makedirs(os.path.join(directory, "post"), exist_ok=True)
+        for kind, stmts in [("keys", keys), ("fks", fks)]:
+            for i, (table, stmt) in enumerate(sorted(stmts.items())):
+                name = f"post/{kind}-{i:05d}.sql"
+                dump["post_data"][kind][table] = name
+                with open(os.path.join(directory, name), "w") as fd:
+                    fd.write(stmt + "\n")
+        triggers = os.path.join(directory, dump["triggers"])
+        self._run(
+            base
+            + ["--no-data", "--no-create-info", "--triggers"]
+            + ["-r", triggers, creds["db_name"]]
+        )
+        manifest.write(directory, dump)
+
+    def _import_tables(
+        self,
+        creds: dict,
+        directory: str,
+        dump: dict,
+        options: str,
+        ignore: bool,
+        jobs: int,
+        resume: bool = False,
+    ) -> None:
+        """
+        Restore a table level dump: schema, data concurrently, then keys
+        and foreign keys concurrently, then triggers
+        """
+        checkpoint = manifest.Checkpoint(directory, "import", resume)
+        base = ["mysql"]
+        base.extend(self._creds_to_opts(creds))
+        base.extend(self.default_import_options(options, ignore))
+        base.append(f"-D{creds['db_name']}")
+
+        def source(name: str, cmd: list = base) -> None:
+            self._run(cmd + [f"-e source {os.path.join(directory, name)};"])
+
+        click.echo("Importing schema")
+        checkpoint.run("schema", source, dump["pre_data"])
+
+        # the data files carry no keys to check against yet
+        load = base[:1] + [MAX_PACKET, BULK_LOAD] + base[1:]
+
+        def load_table(table: str) -> None:
+            if resume:
+                # drop rows left by an interrupted load of this table
+                name = table.replace("`", "``")
+                self._run(base + [f"-e TRUNCATE TABLE `{name}`"])
+            data = os.path.join(directory, dump["data"][table])
+            with open(data, "rb") as fd:
+                self._feed(load, self.batch_commits(fd))
+            progress.table_done(table, data)
+            click.echo(f"Imported table {table}")
+
+        click.echo(f"Importing {len(dump['data'])} tables with {jobs} jobs")
+        failures = run_parallel(
+            lambda t: checkpoint.run(f"data:{t}", load_table, t), dump["data"], jobs
+        )
+        self._raise_failures(failures)
+
+        # foreign keys may reference unique keys, so all keys go first
+        for kind in ["keys", "fks"]:
+            click.echo(f"Creating {'indexes' if kind == 'keys' else 'foreign keys'}")
+            stmts = dump["post_data"][kind]
+            failures = run_parallel(
+                lambda t: checkpoint.run(f"{kind}:{t}", source, stmts[t]), stmts, jobs
+            )
+            self._raise_failures(failures)
+        checkpoint.run("triggers", source, dump["triggers"])
+        click.echo("Import complete\n")
+
+    def tab_tables(self, directory: str) -> list:
+        """
+        Tables of a directory written by mysqldump --tab, each has its
+        CREATE TABLE in a .sql file and its rows in a tab separated .txt
+        """
+        if not os.path.isdir(directory):
+            return []
+        names = set(os.listdir(directory))
+        return sorted(
+            x[:-4] for x in names if x.endswith(".txt") and f"{x[:-4]}.sql" in names
+        )
+
+    def _import_tab(
+        self, creds: dict, directory: str, options: str, ignore: bool, jobs: int
+    ) -> None:
+        """
+        Create the tables of a mysqldump --tab directory, then load their
+        rows with LOAD DATA LOCAL INFILE, which sends each file as one
+        stream instead of a statement at a time
+        """
+        base = ["mysql"]
+        base.extend(self._creds_to_opts(creds))
+        base.extend(self.default_import_options(options, ignore))
+        base.append(f"-D{creds['db_name']}")
+        tables = self.tab_tables(directory)
+        # views only have a .sql file, they go after the tables they select from
+        schemas = [f"{t}.sql" for t in tables] + sorted(
+            x
+            for x in os.listdir(directory)
+            if x.endswith(".sql") and x[:-4] not in tables
+        )
+
+        def schema() -> Iterator[bytes]:
+            for name in schemas:
+                with open(os.path.join(directory, name), "rb") as fd:
+                    yield from fd
+                yield b"\n"
+
+        click.echo(f"Importing schema of {len(schemas)} tables and views")
+        self._feed(base[:1] + [NO_CHECKS] + base[1:], schema())
+        load = base[:1] + ["--local-infile=1", NO_CHECKS] + base[1:]
+
+        def load_table(table: str) -> None:
+            data = os.path.abspath(os.path.join(directory, f"{table}.txt"))
+            literal = data.replace("\\", "\\\\").replace("'", "\\'")
+            name = table.replace("`", "``")
+            # mysqldump --tab writes utf8mb4 unless told otherwise
+            query = (
+                f"LOAD DATA LOCAL INFILE '{literal}' INTO TABLE `{name}` "
+                "CHARACTER SET utf8mb4"
+            )
+            self._run(load + [f"-e {query}"])
+            progress.table_done(table, data)
+            click.echo(f"Imported table {table}")
+
+        click.echo(f"Loading {len(tables)} tables with {jobs} jobs")
+        failures = run_parallel(load_table, tables, jobs)
+        # the errors of a server that refuses to read files from the client
+        if any(x in str(e) for _, e in failures for x in ["ERROR 3948", "ERROR 1148"]):
+            click.echo(
+                "The server may need local_infile enabled in its parameter group"
+            )
+        self._raise_failures(failures)
+        click.echo("Import complete\n")
+
+    def _import_split(
+        self, creds: dict, backup_file: str, options: str, ignore: bool, jobs: int
+    ) -> None:
+        """
+        Load a dump with its secondary keys and foreign keys taken out of the
+        CREATE TABLE statements, then add them to the filled tables
+        """
+        base = ["mysql"]
+        base.extend(self._creds_to_opts(creds))
+        base.extend(self.default_import_options(options, ignore))
+        keys, fks = {}, {}
+        click.echo("Importing schema and data")
+        cmd = base + [MAX_PACKET, BULK_LOAD, f"-D{creds['db_name']}"]
+        chunks = self.batch_commits(self.defer_keys(backup_file, keys, fks))
+        self._feed(cmd, chunks)
+        base.append(f"-D{creds['db_name']}")
+        # foreign keys may reference unique keys, so all keys go first
+        for kind, stmts in [("indexes", keys), ("foreign keys", fks)]:
+            click.echo(f"Creating {kind} on {len(stmts)} tables with {jobs} jobs")
+            failures = run_parallel(
+                lambda t: self._run(base + [f"-e {stmts[t]}"]), stmts, jobs
+            )
+            self._raise_failures(failures)
+        click.echo("Import complete\n")
+
+    def batch_commits(
+        self, lines: Iterable[bytes], size: int = COMMIT_BYTES
+    ) -> Iterator[bytes]:
+        """
+        Lines of a dump with a COMMIT after the first INSERT that ends once
+        size bytes have passed since the last one, and at the end. Bodies
+        of triggers and routines are read with another delimiter and are
+        left alone.
+        """
+        pending = 0
+        delimiter = b";"
+        for line in lines:
+            yield line
+            pending += len(line)
+            if line.startswith(b"DELIMITER "):
+                delimiter = line.split()[1]
+            elif (
+                pending >= size
+                and delimiter == b";"
+                and line.startswith(b"INSERT INTO ")
+                and line.rstrip().endswith(b";")
+            ):
+                yield b"COMMIT;\n"
+                pending = 0
+        yield b"COMMIT;\n"
+
+    def _feed(self, cmd: list, chunks: Iterable[bytes]) -> None:
+        code, result, status = run_feed(cmd, chunks, progress.counter())
+        if code != 0:
+            click.echo(status)
+            raise click.ClickException(result)
+
+    def defer_keys(self, backup_file: str, keys: dict, fks: dict) -> Iterator[bytes]:
+        """
+        Lines of a dump with each CREATE TABLE split by split_schema, the
+        statements to add the keys back are collected in keys and fks
+        """
+        with open(backup_file, "rb") as fd:
+            for line in fd:
+                if not line.startswith(b"CREATE TABLE `"):
+                    yield line
+                    continue
+                block = [line]
+                for line in fd:
+                    block.append(line)
+                    if line.startswith(b")"):
+                        break
+                ddl = b"".join(block).decode("utf-8", "surrogateescape")
+                pre, table_keys, table_fks = self.split_schema(ddl)
+                keys.update(table_keys)
+                fks.update(table_fks)
+                yield pre.encode("utf-8", "surrogateescape")
+
+    def split_schema(self, ddl: str) -> Tuple[str, dict, dict]:
+        """
+        Split a mysqldump schema into the DDL without secondary keys and
+        foreign keys, plus ALTER TABLE statements per table to add them back
+        """
+        pre = []
+        keys = {}
+        fks = {}
+        lines = ddl.split("\n")
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            i += 1
+            match = re.match(r"^CREATE TABLE `((?:[^`]|``)+)` \($", line)
+            if match is None:
+                pre.append(line)
+                continue
+            table = match.group(1)
+            body = []
+            while i < len(lines) and not lines[i].startswith(")"):
+                body.append(lines[i].rstrip().rstrip(","))
+                i += 1
+            # an auto increment column must stay the first column of some key
+            auto = {
+                m.group(1)
+                for m in (re.match(r"^\s*`([^`]+)` .*AUTO_INCREMENT", x) for x in body)
+                if m
+            }
+            kept, key_defs, fk_defs = [], [], []
+            for entry in body:
+                first = re.search(r"\(`([^`]+)`", entry)
+                if DEFERRED_KEY.match(entry) and not (first and first.group(1) in auto):
+                    key_defs.append("ADD " + entry.strip())
+                elif DEFERRED_FK.match(entry):
+                    fk_defs.append("ADD " + entry.strip())
+                else:
+                    kept.append(entry)
+            pre.append(line)
+            pre.append(",\n".join(kept))
+            if key_defs:
+                keys[table] = f"ALTER TABLE `{table}` " + ", ".join(key_defs) + ";"
+            if fk_defs:
+                fks[table] = f"ALTER TABLE `{table}` " + ", ".join(fk_defs) + ";"
+        return "\n".join(pre), keys, fks
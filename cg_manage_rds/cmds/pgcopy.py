@@ -0,0 +1,224 @@
+from typing import Callable
+import click
+
+from cg_manage_rds.cmds import progress
+from cg_manage_rds.cmds.pgsql import PgSql, DATA_SETTINGS, INDEX_SETTINGS
+from cg_manage_rds.cmds.utils import run_pipeline, run_parallel
+
+# oids below this are of the built in objects, the same on every server
+FIRST_USER_OID = 16384
+
+# ordinary tables outside of the system schemas, the biggest first so they
+# are not left for last, leaving out the partitioned tables that hold no
+# rows of their own and the tables filled by creating an extension, with
+# the columns a COPY can write to in the order they are in at the source.
+# Binary arrays and composites carry the oids of their element types, which
+# differ at the destination for types of the database's own, so tables with
+# such columns are copied as text
+COPY_TABLES = (
+    "SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname), "
+    "n.nspname, c.relname, (SELECT string_agg(quote_ident(a.attname), ', ' "
+    "ORDER BY a.attnum) FROM pg_attribute a WHERE a.attrelid = c.oid "
+    "AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''), "
+    "NOT EXISTS (SELECT 1 FROM pg_attribute a "
+    "JOIN pg_type t ON t.oid = a.atttypid "
+    "JOIN pg_type b ON b.oid = CASE WHEN t.typtype = 'd' "
+    "THEN t.typbasetype ELSE t.oid END "
+    "WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped "
+    f"AND (b.typelem >= {FIRST_USER_OID} OR b.typrelid <> 0)) "
+    "FROM pg_class c "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind = 'r' "
+    "AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+    "AND n.nspname NOT LIKE 'pg\\_%' "
+    "AND NOT EXISTS (SELECT 1 FROM pg_depend d "
+    "WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid "
+    "AND d.deptype = 'e') "
+    "ORDER BY pg_table_size(c.oid) DESC"
+)
+# tables an extension marks as configuration, whose rows pg_dump copies
+# with the extension's own filter, as (table, columns, WHERE condition)
+EXTENSION_TABLES = (
+    "SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname), "
+    "(SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum) "
+    "FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 "
+    "AND NOT a.attisdropped AND a.attgenerated = ''), "
+    "coalesce(e.extcondition[array_position(e.extconfig, c.oid)], '') "
+    "FROM pg_extension e CROSS JOIN unnest(e.extconfig) AS x(oid) "
+    "JOIN pg_class c ON c.oid = x.oid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('r', 'p') ORDER BY 1"
+)
+SEQUENCES = (
+    "SELECT quote_ident(schemaname) || '.' || quote_ident(sequencename), "
+    "coalesce(last_value, start_value), last_value IS NOT NULL "
+    "FROM pg_sequences"
+)
+
+
+class PgCopy(PgSql):
+    """
+    Postgres engine that streams a clone table by table with binary COPY,
+    so rows are never written out as SQL text and parsed again. Exports
+    to and imports from files are the same as PgSql's.
+    """
+
+    def stream(
+        self,
+        src_creds: dict,
+        dst_creds: dict,
+        backup_options: str = None,
+        restore_options: str = None,
+        ignore: bool = False,
+        jobs: int = 1,
+        counter: Callable[[int], None] = None,
+    ) -> None:
+        """
+        Pipe the schema through pg_dump and pg_restore, then each table
+        from a COPY TO STDOUT into a COPY FROM STDIN, jobs tables at a time,
+        then set the sequences and build the indexes and constraints
+        """
+        src, dst = src_creds.get("uri"), dst_creds.get("uri")
+        tables = self.copy_tables(src_creds)
+        restore = ["pg_restore", "-d", dst]
+        restore.extend(self.default_import_options(restore_options, ignore))
+        adds = []
+        if any(o in ["-c", "--clean"] for o in restore):
+            # the tables are dropped by the schema pass, which fails while
+            # foreign keys from an earlier clone still point at them
+            pairs = [(schema, name) for schema, name, _, _ in tables.values()]
+            adds = self._drop_foreign_keys(dst_creds, pairs)
+        # the schema, every table and the sequences are read as of one moment
+        with self.snapshot(src_creds) as snapshot:
+            dump = ["pg_dump", "-d", src, "-Fc", f"--snapshot={snapshot}"]
+            opts = self.default_export_options(backup_options, ignore)
+            dump.extend(self._strip_format(opts))
+            click.echo("Copying schema with:")
+            click.echo(
+                click.style(f"\t{' '.join(dump)} --section=pre-data |", fg="yellow")
+            )
+            click.echo(click.style(f"\t{' '.join(restore)}", fg="yellow"))
+            self._pipe([dump + ["--section=pre-data"], restore])
+
+            # options such as -n or -t leave tables out of the schema pass
+            present = self.copy_tables(dst_creds)
+            copied = [t for t in tables if t in present]
+
+            def copy_rows(source: str, target: str, fmt: str) -> None:
+                query = f"COPY {source} TO STDOUT (FORMAT {fmt})"
+                out = ["psql", "-d", src, "-q", "-v", "ON_ERROR_STOP=1"]
+                out.extend(self._in_snapshot(snapshot, query))
+                query = f"COPY {target} FROM STDIN (FORMAT {fmt})"
+                load = ["psql", "-d", dst, "-c", query]
+                self._pipe([out, load], counter, self._pgoptions(DATA_SETTINGS))
+
+            def copy_table(table: str) -> None:
+                # the source's column order on both sides, which the
+                # destination may not share when the table was there before
+                _, _, columns, binary = tables[table]
+                target = f"{table} ({columns})" if columns else table
+                copy_rows(target, target, "binary" if binary else "text")
+                progress.table_done(table)
+                click.echo(f"Copied table {table}")
+
+            click.echo(f"Copying {len(copied)} tables with {jobs} jobs")
+            failures = run_parallel(copy_table, copied, jobs)
+            self._raise_failures(failures)
+
+            # the rows an extension does not create itself, where the
+            # extension is also at the destination
+            config = self.extension_tables(src_creds)
+            present = self.extension_tables(dst_creds)
+            for table, (columns, condition) in config.items():
+                if table not in present or not columns:
+                    continue
+                source = f"(SELECT {columns} FROM {table} {condition})"
+                copy_rows(source, f"{table} ({columns})", "text")
+                click.echo(f"Copied extension table {table}")
+
+            if self.has_large_objects(src_creds):
+                # leaving out every table and sequence leaves the large objects,
+                # created empty by the schema pass
+                click.echo("Copying large objects")
+                data = [o for o in restore if o not in ["-c", "--clean", "--if-exists"]]
+                blobs = dump + ["--section=data", "-b", "-T", "*.*"]
+                self._pipe([blobs, data], counter, self._pgoptions(DATA_SETTINGS))
+            self.copy_sequences(src_creds, dst_creds, snapshot)
+            click.echo("Creating indexes and constraints")
+            post = [dump + ["--section=post-data"], restore]
+            self._pipe(post, env=self._pgoptions(INDEX_SETTINGS))
+        self._add_foreign_keys(dst_creds, adds, jobs)
+        click.echo("Copy complete\n")
+
+    def copy_tables(self, creds: dict) -> dict:
+        """
+        (schema, table, columns, binary) of each table whose rows are
+        copied, by quoted name, binary is false when it is copied as text
+        """
+        cmd = ["psql", "-d", creds.get("uri"), "-At", "-F", "\t", "-c", COPY_TABLES]
+        tables = {}
+        for line in self._run(cmd).split("\n"):
+            if line.count("\t") == 4:
+                table, schema, name, columns, binary = line.split("\t")
+                tables[table] = (schema, name, columns, binary == "t")
+        return tables
+
+    def extension_tables(self, creds: dict) -> dict:
+        """
+        (columns, condition) of each extension configuration table, by
+        quoted name
+        """
+        uri = creds.get("uri")
+        cmd = ["psql", "-d", uri, "-At", "-F", "\t", "-c", EXTENSION_TABLES]
+        tables = {}
+        for line in self._run(cmd).split("\n"):
+            if line.count("\t") == 2:
+                table, columns, condition = line.split("\t")
+                tables[table] = (columns, condition)
+        return tables
+
+    def copy_sequences(
+        self, src_creds: dict, dst_creds: dict, snapshot: str = None
+    ) -> None:
+        """
+        Set the sequences of the destination to where they are at the
+        source, pg_dump would do this in its data section
+        """
+        cmd = ["psql", "-d", src_creds.get("uri"), "-q", "-At", "-F", "\t"]
+        if snapshot:
+            cmd.extend(self._in_snapshot(snapshot, SEQUENCES))
+        else:
+            cmd.extend(["-c", SEQUENCES])
+        values = self._sequence_values(self._run(cmd))
+        cmd = ["psql", "-d", dst_creds.get("uri"), "-At", "-F", "\t", "-c", SEQUENCES]
+        present = self._sequence_values(self._run(cmd))
+        setvals = [
+            self.setval(name, value, called)
+            for name, (value, called) in values.items()
+            if name in present
+        ]
+        if setvals:
+            click.echo(f"Setting {len(setvals)} sequences")
+            uri = dst_creds.get("uri")
+            cmd = ["psql", "-d", uri, "-v", "ON_ERROR_STOP=1", "-c", "".join(setvals)]
+            self._run(cmd)
+
+    def setval(self, sequence: str, value: str, called: bool) -> str:
+        literal = "'" + sequence.replace("'", "''") + "'"
+        return f"SELECT pg_catalog.setval({literal}, {value}, {str(called).lower()});"
+
+    def _sequence_values(self, result: str) -> dict:
+        values = {}
+        for line in result.split("\n"):
+            if line.count("\t") == 2:
+                name, value, called = line.split("\t")
+                values[name] = (value, called == "t")
+        return values
+
+    def _pipe(
+        self, cmds: list, counter: Callable[[int], None] = None, env: dict = None
+    ) -> None:
+        code, result, status = run_pipeline(cmds, counter=counter, env=env)
+        if code != 0:
+            click.echo(status)
+            raise click.ClickException(result)
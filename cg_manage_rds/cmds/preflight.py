@@ -0,0 +1,114 @@
+import os
+import re
+import shutil
+from typing import Optional
+import click
+from cg_manage_rds.cmds import compress
+from cg_manage_rds.cmds.compress import Codec
+from cg_manage_rds.cmds.progress import human, path_size
+
+# off with --preflight false, the checks are estimates and may be too strict
+ENABLED = True
+# bytes of dump per byte of table on disk, for a dump the client compresses
+# itself and for each codec, rough averages for typical row data
+CLIENT_RATIO = 0.35
+CODEC_RATIOS = {"gzip": 0.3, "zstd": 0.25, "lz4": 0.45}
+# share of the free space or storage an estimate may take without a warning
+WARN_SHARE = 0.8
+# GiB of storage of each aws-rds plan size when created without a storage
+# parameter, a service created with one can have more
+PLAN_STORAGE = {
+    "micro": 20,
+    "small": 20,
+    "medium": 100,
+    "large": 500,
+    "xlarge": 1024,
+    "2xlarge": 2048,
+}
+
+
+def dump_estimate(sizes: dict, compressed: bool, codec: Codec = None) -> int:
+    """
+    Bytes a dump of tables of the given sizes is expected to take
+    """
+    if codec is not None:
+        ratio = CODEC_RATIOS.get(codec.name, 1.0)
+    else:
+        ratio = CLIENT_RATIO if compressed else 1.0
+    return int(sum(sizes.values()) * ratio)
+
+
+def restore_estimate(backup_file: str, compressed: bool) -> int:
+    """
+    Bytes the tables in a dump are expected to take once loaded, indexes
+    are not in a dump so the database grows by more than this
+    """
+    codec = None if os.path.isdir(backup_file) else compress.detect(backup_file)
+    if codec is not None:
+        ratio = CODEC_RATIOS.get(codec.name, 1.0)
+    else:
+        ratio = CLIENT_RATIO if compressed else 1.0
+    return int(path_size(backup_file) / ratio)
+
+
+def free_space(file_name: str) -> int:
+    directory = os.path.dirname(os.path.abspath(file_name))
+    # the output may go to directories that are yet to be created
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return shutil.disk_usage(directory).free
+
+
+def plan_storage(plan: str) -> Optional[int]:
+    size = re.search(r"(micro|small|medium|2xlarge|xlarge|large)", plan)
+    return PLAN_STORAGE[size.group(1)] * 1024**3 if size else None
+
+
+def summary(service_name: str, sizes: dict) -> None:
+    total = sum(sizes.values())
+    click.echo(f"{service_name} has {human(total)} in {len(sizes)} tables")
+    for table in sorted(sizes, key=sizes.get, reverse=True)[:3]:
+        click.echo(f"\t{table}: {human(sizes[table])}")
+
+
+def check_local(
+    backup_file: str, needed: int, reclaimed: int = 0, reserved: int = 0
+) -> None:
+    """
+    Refuse an export that will not fit on the local disk, reclaimed is
+    what an existing output that is replaced frees up and reserved what
+    exports running alongside it are expected to take
+    """
+    free = max(0, free_space(backup_file) + reclaimed - reserved)
+    left = " after the running exports" if reserved else ""
+    click.echo(f"The export needs about {human(needed)}, {human(free)} is free{left}")
+    if needed > free:
+        raise click.ClickException(
+            f"Not enough free space for {backup_file}, about {human(needed)} "
+            f"is needed and {human(free)} is free. Free up space, compress "
+            "the export or pass --preflight false to export anyway"
+        )
+    if needed > free * WARN_SHARE:
+        click.secho("The export will leave little free space", fg="yellow")
+
+
+def check_destination(service_name: str, plan: str, needed: int) -> None:
+    """
+    Warn when the data is close to or over the storage of the plan, the
+    service may have been created with more so this never refuses
+    """
+    storage = plan_storage(plan)
+    if storage is None:
+        click.echo(f"Storage of plan {plan} is unknown, {service_name} not checked")
+        return
+    click.echo(
+        f"{service_name} needs at least {human(needed)}, "
+        f"plan {plan} has {human(storage)} unless created with more"
+    )
+    if needed > storage:
+        click.secho(
+            f"{service_name} will likely run out of storage during the import",
+            fg="red",
+        )
+    elif needed > storage * WARN_SHARE:
+        click.secho(f"{service_name} will be close to full", fg="yellow")
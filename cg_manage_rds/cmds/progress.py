@@ -0,0 +1,240 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+import click
+
+# seconds between progress reports
+INTERVAL = 5.0
+# print progress lines, and where to append json lines ("-" for stdout)
+ENABLED = False
+JSON_FILE = None
+
+_current = contextvars.ContextVar("progress", default=None)
+_json_lock = threading.Lock()
+
+
+class Progress:
+    """
+    Bytes moved by one export, import or stream against an estimated total,
+    reported every interval seconds with rate and ETA
+    """
+
+    def __init__(
+        self,
+        label: str,
+        path: str = None,
+        sizes: dict = None,
+        total: int = None,
+        interval: float = INTERVAL,
+    ):
+        self.label = label
+        # the file or directory being written, its size is the bytes done
+        self.path = path
+        self.sizes = dict(sizes or {})
+        self.total = total if total is not None else sum(self.sizes.values()) or None
+        self.interval = interval
+        self.piped = 0
+        self.completed = 0
+        self.tables_done = 0
+        self.rate = 0.0
+        self.started = time.monotonic()
+        self.last = (self.started, 0)
+        self.stalled_since = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self) -> None:
+        self._emit({"event": "start", "total": self.total, "tables": len(self.sizes)})
+        if self.total is not None:
+            self._echo(f"{self.label}: about {human(self.total)} to transfer")
+        self.thread.start()
+
+    def stop(self, ok: bool = True) -> None:
+        self.stopped.set()
+        self.thread.join()
+        elapsed = time.monotonic() - self.started
+        done = self.bytes()
+        self._emit(
+            {
+                "event": "done" if ok else "failed",
+                "bytes": done,
+                "elapsed": round(elapsed, 3),
+                "rate": round(done / elapsed) if elapsed else None,
+            }
+        )
+        self._echo(
+            f"{self.label}: {human(done)} in {duration(elapsed)}"
+            f" ({human(done / elapsed if elapsed else 0)}/s)"
+        )
+
+    def add(self, nbytes: int) -> None:
+        with self.lock:
+            self.piped += nbytes
+
+    def table_done(self, table: str, nbytes: int = 0) -> None:
+        with self.lock:
+            self.completed += nbytes
+            self.tables_done += 1
+            count = self.tables_done
+        self._emit(
+            {
+                "event": "table",
+                "table": table,
+                "bytes": nbytes,
+                "estimate": self.sizes.get(table),
+                "done": count,
+                "tables": len(self.sizes) or None,
+            }
+        )
+
+    def bytes(self) -> int:
+        # bytes through a pipe are uncompressed, so they are preferred
+        with self.lock:
+            if self.piped:
+                return self.piped
+            completed = self.completed
+        if self.path is not None:
+            return max(path_size(self.path), completed)
+        return completed
+
+    def sample(self, now: float = None) -> dict:
+        now = time.monotonic() if now is None else now
+        done = self.bytes()
+        then, before = self.last
+        if now > then:
+            recent = (done - before) / (now - then)
+            # smoothed, so one slow table does not swing the ETA wildly
+            self.rate = recent if not self.rate else 0.3 * recent + 0.7 * self.rate
+        self.last = (now, done)
+        if done == before:
+            self.stalled_since = self.stalled_since or then
+        else:
+            self.stalled_since = None
+        eta = None
+        if self.total and self.rate > 0:
+            eta = max(0.0, (self.total - done) / self.rate)
+        return {
+            "event": "progress",
+            "bytes": done,
+            "total": self.total,
+            "percent": round(100.0 * done / self.total, 1) if self.total else None,
+            "rate": round(self.rate),
+            "eta": round(eta) if eta is not None else None,
+            "stalled": round(now - self.stalled_since) if self.stalled_since else 0,
+            "elapsed": round(now - self.started, 3),
+            "tables_done": self.tables_done,
+        }
+
+    def _loop(self) -> None:
+        while not self.stopped.wait(self.interval):
+            sample = self.sample()
+            self._emit(sample)
+            self._echo(f"{self.label}: {describe(sample)}")
+
+    def _echo(self, line: str) -> None:
+        if ENABLED:
+            click.echo(line)
+
+    def _emit(self, record: dict) -> None:
+        if JSON_FILE is None:
+            return
+        record = dict(record, label=self.label, time=round(time.time(), 3))
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with _json_lock:
+            if JSON_FILE == "-":
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                return
+            with open(JSON_FILE, "a") as fd:
+                fd.write(line)
+
+
+def wanted() -> bool:
+    return ENABLED or JSON_FILE is not None
+
+
+@contextmanager
+def track(
+    label: str, path: str = None, sizes: dict = None, total: int = None
+) -> Iterator[Optional[Progress]]:
+    """
+    Report progress of the enclosed transfer when reporting is turned on
+    """
+    if not wanted():
+        yield None
+        return
+    progress = Progress(label, path, sizes, total)
+    token = _current.set(progress)
+    progress.start()
+    ok = False
+    try:
+        yield progress
+        ok = True
+    finally:
+        _current.reset(token)
+        progress.stop(ok)
+
+
+def counter() -> Optional[Callable[[int], None]]:
+    """
+    Byte counter of the transfer being tracked, for pipes that can report it
+    """
+    progress = _current.get()
+    return progress.add if progress is not None else None
+
+
+def table_done(table: str, file_name: str = None) -> None:
+    progress = _current.get()
+    if progress is not None:
+        size = path_size(file_name) if file_name is not None else 0
+        progress.table_done(table, size)
+
+
+def path_size(path: str) -> int:
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def human(nbytes: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TiB"
+
+
+def duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def describe(sample: dict) -> str:
+    line = human(sample["bytes"])
+    if sample["total"]:
+        line += f" of ~{human(sample['total'])} ({sample['percent']}%)"
+    line += f" at {human(sample['rate'])}/s"
+    if sample["eta"] is not None:
+        line += f", ETA {duration(sample['eta'])}"
+    if sample["tables_done"]:
+        line += f", {sample['tables_done']} tables done"
+    if sample["stalled"]:
+        line += f", no progress for {sample['stalled']}s"
+    return line
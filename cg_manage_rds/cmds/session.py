@@ -0,0 +1,107 @@
+import os
+import time
+from typing import Optional
+from cg_manage_rds.cmds.utils import locked_state, pid_alive, state_dir
+
+STATE_FILE = "sessions.json"
+# minutes a session may sit unused before it is torn down
+IDLE_TIMEOUT = 30
+# seconds between checks by the reaper while a run is using the session
+POLL = 60
+
+
+def find(app_name: str) -> Optional[dict]:
+    with locked_state(STATE_FILE) as state:
+        entry = state.get(app_name)
+        return dict(entry) if entry is not None else None
+
+
+def remaining(entry: dict, now: float = None) -> float:
+    """
+    Seconds until the session has been idle for its timeout
+    """
+    now = time.time() if now is None else now
+    return entry["last_used"] + entry["idle_timeout"] * 60 - now
+
+
+def is_expired(entry: dict, now: float = None) -> bool:
+    return remaining(entry, now) < 0
+
+
+def in_use(entry: dict) -> bool:
+    return any(pid_alive(pid) for pid in entry.get("users", []))
+
+
+def touch(
+    app_name: str,
+    service_name: str = None,
+    key_name: str = None,
+    idle_timeout: int = IDLE_TIMEOUT,
+) -> dict:
+    """
+    Record use of the session's app, and of a service through it
+    """
+    now = time.time()
+    with locked_state(STATE_FILE) as state:
+        entry = state.setdefault(
+            app_name, {"created": now, "services": {}, "idle_timeout": idle_timeout}
+        )
+        entry["last_used"] = now
+        entry["idle_timeout"] = idle_timeout
+        if service_name is not None:
+            entry["services"][service_name] = {"key": key_name}
+        return dict(entry)
+
+
+def hold(app_name: str) -> None:
+    """
+    Record that this process is using the session, so it is not torn down
+    under a run that takes longer than the idle timeout
+    """
+    with locked_state(STATE_FILE) as state:
+        entry = state.get(app_name)
+        if entry is not None:
+            users = [pid for pid in entry.get("users", []) if pid_alive(pid)]
+            entry["users"] = users + [os.getpid()]
+
+
+def release(app_name: str) -> None:
+    """
+    Record the end of this process's use, the session is idle from now on
+    """
+    with locked_state(STATE_FILE) as state:
+        entry = state.get(app_name)
+        if entry is not None:
+            users = entry.get("users", [])
+            entry["users"] = [pid for pid in users if pid != os.getpid()]
+            entry["last_used"] = time.time()
+
+
+def claim(app_name: str, token: str) -> None:
+    """
+    Hand the teardown of the session to the reaper with the token, any
+    earlier reaper exits when it next wakes up
+    """
+    with locked_state(STATE_FILE) as state:
+        entry = state.get(app_name)
+        if entry is not None:
+            entry["reaper"] = token
+
+
+def log_file(app_name: str) -> str:
+    return os.path.join(state_dir(), f"session-{app_name}.log")
+
+
+def expired() -> dict:
+    with locked_state(STATE_FILE) as state:
+        return {app: e for app, e in state.items() if is_expired(e) and not in_use(e)}
+
+
+def list_all() -> dict:
+    with locked_state(STATE_FILE) as state:
+        return dict(state)
+
+
+def forget(app_name: str) -> None:
+    with locked_state(STATE_FILE) as state:
+        state.pop(app_name, None)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import socket
+from typing import Optional
+import click
+from cg_manage_rds.cmds import cache
+from cg_manage_rds.cmds.utils import locked_state, run_sync
+
+STATE_FILE = "tools.json"
+
+
+def find(name: str) -> Optional[str]:
+    """
+    Full path of a program on PATH, looked up in process rather than by
+    spawning which
+    """
+    return shutil.which(name)
+
+
+def require(*names: str) -> None:
+    for name in names:
+        if find(name) is None:
+            errstr = click.style(
+                f"\n{name} application is required but not found", fg="red"
+            )
+            raise click.ClickException(errstr)
+        click.echo(click.style(f"\n{name} found!", fg="bright_green"))
+
+
+def version(name: str) -> Optional[str]:
+    """
+    Output of the program's --version, remembered per host until the
+    program's file is replaced or modified
+    """
+    path = find(name)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    stamp = [st.st_mtime_ns, st.st_size]
+    # the state directory may be on a home directory shared between hosts
+    key = f"{socket.gethostname()}:{path}"
+    if cache.ENABLED:
+        with locked_state(STATE_FILE) as state:
+            entry = state.get(key)
+            if entry is not None and entry["stamp"] == stamp:
+                return entry["version"]
+    code, result, _ = run_sync([path, "--version"])
+    if code != 0:
+        return None
+    if cache.ENABLED:
+        with locked_state(STATE_FILE) as state:
+            state[key] = {"stamp": stamp, "version": result}
+    return result
+
+
+def forget() -> int:
+    with locked_state(STATE_FILE) as state:
+        count = len(state)
+        state.clear()
+        return count
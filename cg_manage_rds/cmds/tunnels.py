@@ -0,0 +1,221 @@
+import os
+import signal
+import socket
+import subprocess
+import time
+from typing import Optional
+import click
+from cg_manage_rds.cmds.utils import run_async, state_dir, locked_state, pid_alive
+
+STATE_FILE = "tunnels.json"
+PORTS_FILE = "ports.json"
+STOP_GRACE = 5.0
+# a reservation outlives its owner only this long, in case the pid is reused
+RESERVE_TTL = 600.0
+
+
+def start(
+    service_name: str, app_name: str, local_port: int, host: str, remote_port: int
+) -> subprocess.Popen:
+    """
+    Spawn cf ssh for a single forward and record it against the service
+    """
+    return start_forwards(
+        app_name, {service_name: (local_port, host, remote_port)}, service_name
+    )
+
+
+def start_forwards(
+    app_name: str, forwards: dict, log_name: str, multiplex: bool = False
+) -> subprocess.Popen:
+    """
+    Spawn one cf ssh with a -L for each service in forwards, given as
+    (local_port, host, remote_port), and record them all against its pid.
+    A multiplexed cf ssh takes in the forwards of later multiplexed setups.
+    """
+    cmd = ["cf", "ssh", app_name, "-N", "-T"]
+    for local_port, host, remote_port in forwards.values():
+        cmd.extend(["-L", f"{local_port}:{host}:{remote_port}"])
+    with open(log_file(log_name), "w") as log:
+        proc = run_async(cmd, new_session=True, stdout=subprocess.DEVNULL, stderr=log)
+    with locked_state(STATE_FILE) as state:
+        for service_name, (local_port, host, remote_port) in forwards.items():
+            state[service_name] = {
+                "pid": proc.pid,
+                "pgid": proc.pid,
+                "app": app_name,
+                "local_port": local_port,
+                "host": host,
+                "remote_port": remote_port,
+                "started": time.time(),
+                "multiplex": multiplex,
+            }
+    return proc
+
+
+def sharing(entry: dict) -> dict:
+    """
+    Entries of the other services forwarded by the same cf ssh as entry
+    """
+    with locked_state(STATE_FILE) as state:
+        return {
+            svc: dict(e)
+            for svc, e in state.items()
+            if e["pid"] == entry["pid"] and svc != entry["service"]
+        }
+
+
+def reserve_port(service_name: str, preferred: int, exclude: list = None) -> int:
+    """
+    Pick a free local port for a service's tunnel, starting from preferred.
+    The port is held in a registry shared by concurrent invocations until
+    release_port, by which time the tunnel itself is recorded.
+    """
+    exclude = {int(x) for x in exclude or []}
+    with locked_state(PORTS_FILE) as reserved:
+        now = time.time()
+        for port, entry in list(reserved.items()):
+            if not _alive(entry["pid"]) or now - entry["time"] > RESERVE_TTL:
+                del reserved[port]
+        exclude.update(int(x) for x in reserved)
+        exclude.update(
+            int(e["local_port"]) for e in list_all().values() if is_running(e)
+        )
+        ports = list(range(preferred, 65536)) + list(range(1024, preferred))
+        for port in ports:
+            # a port bound by anyone else, e.g. another user's tunnel, is taken too
+            if port not in exclude and _bindable(port):
+                reserved[str(port)] = {
+                    "service": service_name,
+                    "pid": os.getpid(),
+                    "time": now,
+                }
+                return port
+    raise click.ClickException(f"No free local port for the tunnel to {service_name}")
+
+
+def release_port(port: int) -> None:
+    with locked_state(PORTS_FILE) as reserved:
+        reserved.pop(str(port), None)
+
+
+def log_file(service_name: str) -> str:
+    return os.path.join(state_dir(), f"tunnel-{service_name}.log")
+
+
+def last_error(service_name: str) -> str:
+    try:
+        with open(log_file(service_name)) as fd:
+            return fd.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def find(service_name: str = None, pid: int = None) -> Optional[dict]:
+    with locked_state(STATE_FILE) as state:
+        # by name first, since services forwarded by one cf ssh share its pid
+        if service_name in state:
+            return dict(state[service_name], service=service_name)
+        for svc, entry in state.items():
+            if pid and entry["pid"] == pid:
+                return dict(entry, service=svc)
+    return None
+
+
+def list_all() -> dict:
+    with locked_state(STATE_FILE) as state:
+        return dict(state)
+
+
+def forget(service_name: str) -> None:
+    with locked_state(STATE_FILE) as state:
+        state.pop(service_name, None)
+
+
+def prune() -> None:
+    """
+    Drop state for tunnels whose process is already gone
+    """
+    with locked_state(STATE_FILE) as state:
+        for svc in [s for s, e in state.items() if not is_running(e)]:
+            del state[svc]
+
+
+def is_running(entry: dict) -> bool:
+    """
+    True when the recorded pid is alive and still looks like our cf ssh
+    """
+    pid = entry["pid"]
+    if not _alive(pid):
+        return False
+    if os.name != "posix":
+        return True
+    try:
+        if os.getpgid(pid) != entry["pgid"]:
+            return False
+    except ProcessLookupError:
+        return False
+    try:
+        # -ww so a long command line is not cut off before "ssh"
+        out = subprocess.run(
+            ["ps", "-ww", "-o", "command=", "-p", str(pid)],
+            capture_output=True,
+            text=True,
+        ).stdout
+    except FileNotFoundError:
+        return True
+    return "ssh" in out
+
+
+def stop(entry: dict, grace: float = STOP_GRACE) -> bool:
+    """
+    Terminate a tunnel's process group, escalating to a kill after grace seconds.
+    Returns False when there was nothing of ours left to stop.
+    """
+    if not is_running(entry):
+        return False
+    _signal(entry, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if not _alive(entry["pid"]):
+            return True
+        time.sleep(0.1)
+    _signal(entry, getattr(signal, "SIGKILL", signal.SIGTERM))
+    return True
+
+
+def _signal(entry: dict, sig: int) -> None:
+    try:
+        if os.name == "posix":
+            os.killpg(entry["pgid"], sig)
+        else:
+            os.kill(entry["pid"], sig)
+    except ProcessLookupError:
+        pass
+
+
+def _alive(pid: int) -> bool:
+    _reap(pid)
+    return pid_alive(pid)
+
+
+def _bindable(port: int) -> bool:
+    with socket.socket() as sock:
+        if os.name == "posix":
+            # ignore connections lingering in TIME_WAIT, a listener still fails
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def _reap(pid: int) -> None:
+    # collect the exit status when the tunnel is our own child
+    if os.name != "posix":
+        return
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        pass
@@ -1,42 +1,455 @@
+import os
+import re
+import json
+import contextvars
 import subprocess
 import itertools
 import sys
-from typing import Tuple, Union
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Tuple, Union
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
 
-def run_sync(cmd: Union[str, list[str]]) -> Tuple[int, str, str]:
-    spinner = itertools.cycle(["-", "/", "|", "\\"])
+SPIN_INTERVAL = 0.1
+# off while progress lines are printed, they would garble each other
+SPINNER = True
+READ_SIZE = 64 * 1024
+# output kept from a command, older output is dropped first
+OUTPUT_LIMIT = 8 * 1024 * 1024
+
+# vCPUs of the instance class behind each aws-rds plan size
+PLAN_VCPUS = {
+    "micro": 2,
+    "small": 2,
+    "medium": 2,
+    "large": 4,
+    "xlarge": 8,
+    "2xlarge": 16,
+}
+
+
+class Spinner:
+    """
+    Progress indicator that redraws at most every interval seconds
+    """
+
+    def __init__(self, interval: float = SPIN_INTERVAL):
+        self.interval = interval
+        self.chars = itertools.cycle(["-", "/", "|", "\\"])
+        self.last = 0.0
+        # concurrent workers would garble each other's spinners
+        self.enabled = SPINNER and threading.current_thread() is threading.main_thread()
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        sys.stdout.write("Processing.... ")
+        sys.stdout.flush()
+
+    def tick(self) -> None:
+        now = time.monotonic()
+        if not self.enabled or now - self.last < self.interval:
+            return
+        self.last = now
+        sys.stdout.write(next(self.chars))  # write the next character
+        sys.stdout.flush()  # flush stdout buffer (actual character display)
+        sys.stdout.write("\b")  # erase the last written char
+
+    def stop(self) -> None:
+        sys.stdout.flush()
+
+
+class OutputBuffer:
+    """
+    Keeps the most recent limit bytes written to it
+    """
+
+    def __init__(self, limit: int = OUTPUT_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self.chunks = deque()
+
+    def feed(self, data: bytes) -> None:
+        self.chunks.append(data)
+        self.size += len(data)
+        # drop whole chunks that are entirely outside of the window
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+
+    def text(self) -> str:
+        data = b"".join(self.chunks)[-self.limit :]
+        return data.decode(errors="replace").replace("\r\n", "\n")
+
+
+def _drain(pipe, buf: OutputBuffer) -> None:
+    # blocking reads in a thread, so waiting costs no cpu
+    for chunk in iter(lambda: pipe.read1(READ_SIZE), b""):
+        buf.feed(chunk)
+    pipe.close()
+
+
+def _pump(src, dst, counter: Callable[[int], None]) -> None:
+    # copy one stage's output to the next, counting the bytes as they pass
+    try:
+        for chunk in iter(lambda: src.read1(READ_SIZE), b""):
+            dst.write(chunk)
+            counter(len(chunk))
+    except OSError:  # the downstream stage is gone
+        pass
+    finally:
+        src.close()
+        try:
+            dst.close()
+        except OSError:
+            pass
+
+
+def _feed(
+    stdin, chunks: Iterable[bytes], counter: Callable[[int], None], failed: list
+) -> None:
+    # write chunks to a command's stdin, an error reading them goes to failed
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+            if counter is not None:
+                counter(len(chunk))
+    except OSError:  # the command is gone, its exit code tells why
+        pass
+    except Exception as e:
+        failed.append(e)
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def run_sync(
+    cmd: Union[str, list[str]], cwd: str = None, env: dict = None
+) -> Tuple[int, str, str]:
     OKGREEN = "\033[92m"
     FAIL = "\033[91m"
     ENDC = "\033[0m"
     status = None
     result = None
     code = 0
+    spinner = Spinner()
+    out, err = OutputBuffer(), OutputBuffer()
+    # env adds to the environment rather than replacing it
+    full_env = dict(os.environ, **env) if env else None
     with subprocess.Popen(
-        cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True
+        cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, env=full_env
     ) as proc:
-        sys.stdout.write("Processing.... ")
-        sys.stdout.flush()
-        while proc.poll() is None:
-            sys.stdout.write(next(spinner))  # write the next character
-            sys.stdout.flush()  # flush stdout buffer (actual character display)
-            sys.stdout.write("\b")  # erase the last written char
-        sys.stdout.flush()
+        # both pipes are read while the command runs so neither can fill up
+        readers = [
+            threading.Thread(target=_drain, args=(proc.stdout, out), daemon=True),
+            threading.Thread(target=_drain, args=(proc.stderr, err), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+        spinner.start()
+        while True:
+            try:
+                proc.wait(timeout=spinner.interval)
+                break
+            except subprocess.TimeoutExpired:
+                spinner.tick()
+        for reader in readers:
+            reader.join()
+        spinner.stop()
         code = proc.returncode
         if code != 0:
             status = f"{FAIL}Command Failed!{ENDC}"
-            result = proc.stderr.read().strip()
+            result = err.text().strip()
         else:
             status = f"{OKGREEN}Command Succeeded!{ENDC}"
-            result = proc.stdout.read().strip()
+            result = out.text().strip()
         return code, result, status
 
 
-def run_async(cmd: str, shell: bool = False) -> subprocess.Popen:
+def run_feed(
+    cmd: list[str],
+    chunks: Iterable[bytes],
+    counter: Callable[[int], None] = None,
+    env: dict = None,
+) -> Tuple[int, str, str]:
+    """
+    Run a command with chunks written to its stdin as they are produced,
+    counter is called with the bytes written and env adds to the environment
+    """
+    OKGREEN = "\033[92m"
+    FAIL = "\033[91m"
+    ENDC = "\033[0m"
+    spinner = Spinner()
+    out, err = OutputBuffer(), OutputBuffer()
+    failed = []
+    full_env = dict(os.environ, **env) if env else None
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=full_env,
+    ) as proc:
+        threads = [
+            threading.Thread(
+                target=_feed,
+                args=(proc.stdin, chunks, counter, failed),
+                daemon=True,
+            ),
+            threading.Thread(target=_drain, args=(proc.stdout, out), daemon=True),
+            threading.Thread(target=_drain, args=(proc.stderr, err), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        spinner.start()
+        while True:
+            try:
+                proc.wait(timeout=spinner.interval)
+                break
+            except subprocess.TimeoutExpired:
+                spinner.tick()
+            if failed:
+                proc.kill()
+        for thread in threads:
+            thread.join()
+        spinner.stop()
+    if failed:
+        raise failed[0]
+    if proc.returncode != 0:
+        return proc.returncode, err.text().strip(), f"{FAIL}Command Failed!{ENDC}"
+    return 0, out.text().strip(), f"{OKGREEN}Command Succeeded!{ENDC}"
+
+
+def run_async(
+    cmd: Union[str, list[str]],
+    shell: bool = False,
+    new_session: bool = False,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+) -> subprocess.Popen:
+    kwargs = {}
+    if new_session and os.name == "posix":
+        # own process group so the whole tree can be signalled later
+        kwargs["start_new_session"] = True
+    elif new_session:
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
     return subprocess.Popen(
         cmd,
         shell=shell,
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
+        stderr=stderr,
+        stdout=stdout,
         stdin=subprocess.PIPE,
+        **kwargs,
     )
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    True when a process of the same user has the pid
+    """
+    if os.name != "posix":
+        # signal 0 would terminate the process on windows
+        out = subprocess.run(
+            ["tasklist", "/FI", f"PID eq {pid}", "/NH"],
+            capture_output=True,
+            text=True,
+        ).stdout
+        return str(pid) in out
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        # alive, but owned by someone else so the pid was reused
+        return False
+    except OSError:
+        return False
+    return True
+
+
+def state_dir() -> str:
+    """
+    Directory for state shared between invocations, created private to the user
+    """
+    path = os.environ.get("CG_MANAGE_RDS_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cg-manage-rds"
+    )
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+@contextmanager
+def locked_state(name: str) -> Iterator[dict]:
+    """
+    Load a json state file under an exclusive lock and write back any changes
+    """
+    path = os.path.join(state_dir(), name)
+    with open(path + ".lock", "a+") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        else:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            try:
+                with open(path) as fd:
+                    state = json.load(fd)
+            except (FileNotFoundError, ValueError):
+                state = {}
+            before = json.dumps(state, sort_keys=True)
+            yield state
+            if json.dumps(state, sort_keys=True) != before:
+                tmp = f"{path}.{os.getpid()}.tmp"
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as out:
+                    json.dump(state, out, indent=2, sort_keys=True)
+                os.replace(tmp, path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def run_pipeline(
+    cmds: list[list[str]],
+    output_file: str = None,
+    counter: Callable[[int], None] = None,
+    env: dict = None,
+    chunks: Iterable[bytes] = None,
+) -> Tuple[int, str, str]:
+    """
+    Run commands with each stdout connected to the next stdin,
+    if any stage fails the remaining stages are killed.
+    The last stage writes to output_file when one is given,
+    and counter is called with the bytes passed out of the first stage.
+    env adds to the environment of every stage.
+    chunks are written to the stdin of the first stage when given,
+    and counter is then called with their bytes instead.
+    """
+    spinner = Spinner()
+    OKGREEN = "\033[92m"
+    FAIL = "\033[91m"
+    ENDC = "\033[0m"
+    procs = []
+    pumps = []
+    feed_errors = []
+    # stderr and the final stdout are spooled to files so no stage can block
+    errs = [tempfile.TemporaryFile(mode="w+") for _ in cmds]
+    if output_file is not None:
+        out = open(output_file, "w+b")
+    else:
+        out = tempfile.TemporaryFile(mode="w+")
+    full_env = dict(os.environ, **env) if env else None
+    try:
+        prev_stdout = None
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            feed = chunks is not None and i == 0
+            pump = counter is not None and chunks is None and i == 1
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE if pump or feed else prev_stdout,
+                stdout=out if last else subprocess.PIPE,
+                stderr=errs[i],
+                env=full_env,
+            )
+            if feed:
+                thread = threading.Thread(
+                    target=_feed,
+                    args=(proc.stdin, chunks, counter, feed_errors),
+                    daemon=True,
+                )
+                thread.start()
+                pumps.append(thread)
+            elif pump:
+                thread = threading.Thread(
+                    target=_pump, args=(prev_stdout, proc.stdin, counter), daemon=True
+                )
+                thread.start()
+                pumps.append(thread)
+            # only the downstream stage should hold the read end
+            elif prev_stdout is not None:
+                prev_stdout.close()
+            prev_stdout = proc.stdout
+            procs.append(proc)
+
+        spinner.start()
+        while True:
+            codes = [p.poll() for p in procs]
+            if None not in codes or any(c not in (None, 0) for c in codes):
+                break
+            if feed_errors:
+                break
+            spinner.tick()
+            time.sleep(spinner.interval)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+        for thread in pumps:
+            thread.join()
+    spinner.stop()
+    if feed_errors:
+        for fd in errs + [out]:
+            fd.close()
+        raise feed_errors[0]
+    failed = [i for i, p in enumerate(procs) if p.returncode != 0]
+    if failed:
+        # a stage killed by us or by a broken pipe is not the root cause
+        root = [i for i in failed if procs[i].returncode > 0] or failed
+        idx = root[0]
+        errs[idx].seek(0)
+        code = procs[idx].returncode
+        status = f"{FAIL}Command Failed!{ENDC}"
+        result = f"{cmds[idx][0]}: {errs[idx].read().strip()}"
+    else:
+        code = 0
+        status = f"{OKGREEN}Command Succeeded!{ENDC}"
+        result = ""
+        if output_file is None:
+            out.seek(0)
+            result = out.read().strip()
+    for fd in errs + [out]:
+        fd.close()
+    return code, result, status
+
+
+def auto_jobs(plan: str) -> int:
+    """
+    Size parallel jobs to the smaller of the local cores and the plan's vCPUs
+    """
+    local = os.cpu_count() or 1
+    size = re.search(r"(micro|small|medium|2xlarge|xlarge|large)", plan)
+    remote = PLAN_VCPUS[size.group(1)] if size else 2
+    return max(1, min(local, remote))
+
+
+def run_parallel(fn: Callable, items: Iterable, workers: int) -> list:
+    """
+    Call fn on every item with up to workers threads,
+    returns (item, exception) for each call that raised.
+    """
+
+    def call(item):
+        try:
+            fn(item)
+        except Exception as e:
+            return (item, e)
+        return None
+
+    # workers see the caller's context, e.g. the progress being tracked
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = pool.map(lambda item: context.copy().run(call, item), items)
+        return [x for x in results if x is not None]
@@ -1,10 +1,34 @@
-from typing import Tuple
+from fnmatch import fnmatch
+from os import path
+from typing import Callable, Optional, Tuple
+import sys
+import threading
+import time
+import uuid
 import click
 import re
 from cg_manage_rds.cmds import cf_cmds as cf
+from cg_manage_rds.cmds import tunnels
+from cg_manage_rds.cmds import session as sess
+from cg_manage_rds.cmds import cache
+from cg_manage_rds.cmds import metrics
+from cg_manage_rds.cmds import preflight
+from cg_manage_rds.cmds import progress
+from cg_manage_rds.cmds import tools
+from cg_manage_rds.cmds import utils
 from cg_manage_rds.cmds.engine import Engine
-from cg_manage_rds.cmds.pgsql import PgSql
-from cg_manage_rds.cmds.mysql import MySql
+from cg_manage_rds.cmds import graph as steps
+from cg_manage_rds.cmds.graph import Graph
+from cg_manage_rds.cmds.compress import Codec
+from cg_manage_rds.cmds.utils import run_parallel, auto_jobs
+
+# names of the engines, pgcopy is a postgres engine that clones with binary COPY
+ENGINES = ["pgsql", "pgcopy", "mysql"]
+# run detached by a session's reaper, with the app name and reaper token
+REAPER = (
+    "import sys; from cg_manage_rds import commands; "
+    "commands.reap_session(*sys.argv[1:])"
+)
 
 
 def find_engine_type(service_name: str) -> str:
@@ -18,14 +42,163 @@ def find_engine_type(service_name: str) -> str:
 
 
 def get_engine_handler(engine_type: str) -> Engine:
+    # engines are imported when first used, most commands need only one
     if engine_type == "pgsql":
+        from cg_manage_rds.cmds.pgsql import PgSql
+
         return PgSql()
+    elif engine_type == "pgcopy":
+        from cg_manage_rds.cmds.pgcopy import PgCopy
+
+        return PgCopy()
     elif engine_type == "mysql":
+        from cg_manage_rds.cmds.mysql import MySql
+
         return MySql()
     else:
         raise click.ClickException(f"Unsupported Database Engine: {engine_type}")
 
 
+def resolve_jobs(service_name: str, jobs: int = 1) -> int:
+    if jobs > 0:
+        return jobs
+    jobs = auto_jobs(cf.get_service_plan(service_name))
+    click.echo(f"Using {jobs} parallel jobs for {service_name}")
+    return jobs
+
+
+def use_cache(enabled: bool = True) -> None:
+    cache.ENABLED = enabled
+
+
+def use_metrics(json_file: str = None, prometheus_file: str = None) -> None:
+    metrics.JSON_FILE = json_file
+    metrics.PROMETHEUS_FILE = prometheus_file
+
+
+def use_progress(enabled: bool = False, json_file: str = None) -> None:
+    progress.ENABLED = enabled
+    progress.JSON_FILE = json_file
+    # progress lines take the place of the spinner
+    utils.SPINNER = not enabled
+
+
+def use_preflight(enabled: bool = True) -> None:
+    preflight.ENABLED = enabled
+
+
+def table_sizes(engine: Engine, creds: dict) -> dict:
+    # only worth a query when progress is reported or checked up front
+    if not progress.wanted() and not preflight.ENABLED:
+        return {}
+    try:
+        return engine.table_sizes(creds)
+    except click.ClickException as e:
+        click.echo(f"Could not estimate the database size: {e.format_message()}")
+        return {}
+
+
+def export_total(
+    engine: Engine,
+    sizes: dict,
+    options: str,
+    ignore: bool,
+    jobs: int,
+    codec: Codec = None,
+    tables: bool = False,
+) -> Optional[int]:
+    """
+    Bytes an export is expected to write, in the units progress is counted
+    in, compressed when the dump is
+    """
+    if not sizes:
+        return None
+    compressed = engine.dump_compressed(options, ignore, jobs, tables)
+    return preflight.dump_estimate(sizes, compressed, codec)
+
+
+def preflight_export(
+    engine: Engine,
+    service_name: str,
+    sizes: dict,
+    backup_file: str,
+    options: str,
+    ignore: bool,
+    jobs: int,
+    codec: Codec = None,
+    tables: bool = False,
+    keep: bool = False,
+    reserved: int = 0,
+) -> int:
+    """
+    Refuse an export that will not fit on the local disk before it starts,
+    keep is true when the export adds to an existing output and reserved
+    is the estimate of other exports running at the same time. Returns
+    the estimate of this export, 0 when it is not checked.
+    """
+    if not preflight.ENABLED or not sizes:
+        return 0
+    with metrics.phase("preflight", service_name):
+        preflight.summary(service_name, sizes)
+        compressed = engine.dump_compressed(options, ignore, jobs, tables)
+        needed = preflight.dump_estimate(sizes, compressed, codec)
+        reclaimed = 0 if keep else progress.path_size(backup_file)
+        preflight.check_local(backup_file, needed, reclaimed, reserved)
+    return needed
+
+
+def preflight_import(engine: Engine, service_name: str, backup_file: str) -> None:
+    """
+    Warn when the tables of a dump are close to the storage of the plan
+    """
+    if not preflight.ENABLED or not path.exists(backup_file):
+        return
+    with metrics.phase("preflight", service_name):
+        needed = preflight.restore_estimate(
+            backup_file, engine.file_compressed(backup_file)
+        )
+        plan = cf.get_service_plan(service_name)
+        preflight.check_destination(service_name, plan, needed)
+
+
+def preflight_clone(
+    engine: Engine, src_service: str, src_creds: dict, dst_service: str
+) -> None:
+    """
+    Warn when the source database is close to the storage of the
+    destination's plan
+    """
+    if not preflight.ENABLED:
+        return
+    with metrics.phase("preflight", dst_service):
+        try:
+            needed = engine.database_size(src_creds)
+        except click.ClickException as e:
+            click.echo(f"Could not size {src_service}: {e.format_message()}")
+            return
+        plan = cf.get_service_plan(dst_service)
+        preflight.check_destination(dst_service, plan, needed)
+
+
+def clear_cache(service_name: str = None) -> int:
+    if service_name is None:
+        return cache.invalidate() + tools.forget()
+    plan_key = cf.cache_key("plan", service_name)
+    if not plan_key:
+        return 0
+    # key entries carry the key name after the service name
+    count = cache.invalidate(cf.cache_key("key", service_name) + ":")
+    return count + cache.delete(plan_key)
+
+
+def cached_entries() -> dict:
+    # only names and expiry, never the cached credentials
+    return {
+        key: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["expires"]))
+        for key, entry in cache.entries().items()
+    }
+
+
 def check(service: str, engine_name: str = None) -> None:
     if engine_name is None:
         engine_name = find_engine_type(service)
@@ -39,34 +212,312 @@ def setup(
     app_name: str = "ssh-app",
     key_name: str = "key",
     engine: Engine = None,
+    push_app: bool = True,
+    exclude_ports: list = None,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+) -> Tuple[dict, int]:
+    return steps.run(
+        setup_async(
+            service_name,
+            engine_type,
+            app_name,
+            key_name,
+            engine,
+            push_app,
+            exclude_ports,
+            session,
+            idle_timeout,
+        )
+    )
+
+
+async def setup_async(
+    service_name: str,
+    engine_type: str = None,
+    app_name: str = "ssh-app",
+    key_name: str = "key",
+    engine: Engine = None,
+    push_app: bool = True,
+    exclude_ports: list = None,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
 ) -> Tuple[dict, int]:
+    results = await setup_services_async(
+        [(service_name, engine_type, engine)],
+        app_name,
+        key_name,
+        push_app,
+        exclude_ports,
+        session,
+        idle_timeout,
+    )
+    return results[service_name]
 
-    if engine_type is None:
-        engine_type = find_engine_type(service_name)
 
-    if engine is None:
-        engine = get_engine_handler(engine_type)
+async def setup_services_async(
+    services: list,
+    app_name: str = "ssh-app",
+    key_name: str = "key",
+    push_app: bool = True,
+    exclude_ports: list = None,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+    multiplex: bool = False,
+) -> dict:
+    """
+    Tunnels to each (service_name, engine_type, engine) through one app.
+    The app push, engine lookups and service keys run concurrently,
+    and each tunnel opens once the app and its own key are ready.
+    With multiplex all services are forwarded by a single cf ssh instead.
+    Returns (creds, pid) by service name.
+    """
+    # the service key output format depends on the cf version
+    await steps.to_thread(cf.check_cf_cli)
+    setups = {}
+    if session:
+        await steps.to_thread(end_expired_sessions)
+        pending = []
+        for service_name, engine_type, engine in services:
+            if engine is None:
+                engine_type = engine_type or find_engine_type(service_name)
+                engine = get_engine_handler(engine_type)
+            reused = await steps.to_thread(
+                reuse_tunnel, service_name, app_name, key_name, engine
+            )
+            if reused is None:
+                pending.append((service_name, engine_type, engine))
+                continue
+            sess.touch(app_name, service_name, key_name, idle_timeout)
+            setups[service_name] = reused
+        services = pending
+        if not services:
+            start_session_use(app_name)
+            return setups
+        if push_app and sess.find(app_name) is not None:
+            push_app = not await steps.to_thread(cf.app_running, app_name)
+
+    graph = Graph()
+    ready = []
+    if push_app:
+        graph.add("push_app", lambda: cf.push_app(app_name))
+        graph.add("enable_ssh", lambda: cf.enable_ssh(app_name), after=["push_app"])
+        ready.append("enable_ssh")
+    for service_name, engine_type, engine in services:
+        add_credential_steps(graph, service_name, engine_type, engine, key_name)
+    names = [x[0] for x in services]
+    for service_name in names:
+        add_port_step(graph, service_name, exclude_ports)
+        if not multiplex:
+            add_tunnel_step(graph, service_name, app_name, key_name, ready)
+    if multiplex:
+        add_multiplex_step(graph, names, app_name, key_name, ready)
+    try:
+        results = await graph.run()
+    except BaseException:
+        # tunnels that came up before the failure would otherwise keep running
+        if "tunnels" in graph.results:
+            opened = names
+        else:
+            opened = [x for x in names if f"tunnel:{x}" in graph.results]
+        if opened:
+            try:
+                await steps.to_thread(cf.delete_ssh_tunnels, opened)
+            except click.ClickException as e:
+                click.echo(f"Closing the tunnels failed: {e.format_message()}")
+        raise
+    finally:
+        # the tunnels that came up are recorded by now and keep their ports
+        for port in [graph.results.get(f"port:{x}") for x in names]:
+            if port is not None:
+                tunnels.release_port(port)
+    for service_name in names:
+        if multiplex:
+            setups[service_name] = results["tunnels"][service_name]
+        else:
+            setups[service_name] = results[f"tunnel:{service_name}"]
+        if session:
+            sess.touch(app_name, service_name, key_name, idle_timeout)
+    # reused forwards carried over into a new multiplexed cf ssh have its pid
+    for service_name, (creds, pid) in list(setups.items()):
+        entry = tunnels.find(service_name)
+        if entry is not None:
+            setups[service_name] = (creds, entry["pid"])
+    if session:
+        start_session_use(app_name)
+    return setups
 
-    cf.push_app(app_name)
-    cf.enable_ssh(app_name)
-    creds = engine.credentials(service_name, key_name)
-    local_port = int(creds.get("local_port"))
-    host = creds.get("host")
-    remote_port = int(creds.get("port"))
-    pid = cf.create_ssh_tunnel(app_name, local_port, remote_port, host)
-    return (creds, pid)
+
+def add_credential_steps(
+    graph: Graph, service_name: str, engine_type: str, engine: Engine, key_name: str
+) -> None:
+    lookup = f"engine:{service_name}"
+    if engine is not None:
+        graph.add(lookup, lambda: engine)
+    else:
+        graph.add(
+            lookup,
+            lambda: get_engine_handler(engine_type or find_engine_type(service_name)),
+        )
+    graph.add(
+        f"creds:{service_name}",
+        lambda: graph.results[lookup].credentials(service_name, key_name),
+        after=[lookup],
+    )
+
+
+def add_port_step(graph: Graph, service_name: str, exclude_ports: list) -> None:
+    # the engine's default port is used when no other tunnel has it
+    graph.add(
+        f"port:{service_name}",
+        lambda: tunnels.reserve_port(
+            service_name,
+            int(graph.results[f"creds:{service_name}"]["local_port"]),
+            exclude_ports,
+        ),
+        after=[f"creds:{service_name}"],
+    )
+
+
+def tunnel_credentials(graph: Graph, service_name: str, key_name: str) -> dict:
+    creds = graph.results[f"creds:{service_name}"]
+    local_port = graph.results[f"port:{service_name}"]
+    if local_port != int(creds["local_port"]):
+        engine = graph.results[f"engine:{service_name}"]
+        creds = engine.credentials(service_name, key_name, local_port)
+    return creds
+
+
+def add_tunnel_step(
+    graph: Graph, service_name: str, app_name: str, key_name: str, ready: list
+) -> None:
+    def tunnel() -> Tuple[dict, int]:
+        creds = tunnel_credentials(graph, service_name, key_name)
+        pid = cf.create_ssh_tunnel(
+            app_name,
+            int(creds["local_port"]),
+            int(creds.get("port")),
+            creds.get("host"),
+            probe=graph.results[f"engine:{service_name}"].handshake,
+            service_name=service_name,
+        )
+        return (creds, pid)
+
+    graph.add(f"tunnel:{service_name}", tunnel, after=[f"port:{service_name}"] + ready)
+
+
+def add_multiplex_step(
+    graph: Graph, names: list, app_name: str, key_name: str, ready: list
+) -> None:
+    def tunnel() -> dict:
+        creds = {x: tunnel_credentials(graph, x, key_name) for x in names}
+        forwards = {
+            x: (int(c["local_port"]), c.get("host"), int(c.get("port")))
+            for x, c in creds.items()
+        }
+        probes = {x: graph.results[f"engine:{x}"].handshake for x in names}
+        pid = cf.create_ssh_tunnels(app_name, forwards, probes)
+        return {x: (c, pid) for x, c in creds.items()}
+
+    graph.add("tunnels", tunnel, after=[f"port:{x}" for x in names] + ready)
+
+
+def reuse_tunnel(
+    service_name: str, app_name: str, key_name: str, engine: Engine
+) -> Tuple[dict, int]:
+    """
+    Return credentials and pid of a healthy tunnel left by an earlier session
+    """
+    entry = tunnels.find(service_name)
+    if entry is None or entry["app"] != app_name or not tunnels.is_running(entry):
+        return None
+    port = int(entry["local_port"])
+    if cf.wait_for_tunnel(port, engine.handshake, timeout=5) is None:
+        click.echo(f"SSH Tunnel for {service_name} is not answering, replacing it")
+        cf.delete_ssh_tunnel(entry["pid"], service_name)
+        return None
+    click.echo(f"Reusing SSH Tunnel with PID {entry['pid']} for {service_name}\n")
+    creds = engine.credentials(service_name, key_name, port)
+    return (creds, entry["pid"])
+
+
+def end_session(app_name: str) -> None:
+    entry = sess.find(app_name)
+    if entry is None:
+        raise click.ClickException(f"No session for app {app_name}")
+    cf.check_cf_cli()
+    cf.delete_ssh_tunnels(list(entry["services"]))
+    for service_name, svc in entry["services"].items():
+        cf.delete_service_key(svc["key"], service_name)
+    cf.delete_app(app_name)
+    sess.forget(app_name)
+
+
+def start_session_use(app_name: str) -> None:
+    """
+    Hold the session for this run and start a detached reaper, which tears
+    it down once it has been idle for its timeout even if no other run
+    comes along
+    """
+    sess.hold(app_name)
+    token = uuid.uuid4().hex
+    sess.claim(app_name, token)
+    cmd = [sys.executable, "-c", REAPER, app_name, token]
+    with open(sess.log_file(app_name), "ab") as log:
+        utils.run_async(cmd, new_session=True, stdout=log, stderr=log)
+
+
+def reap_session(app_name: str, token: str) -> None:
+    """
+    Sleep until the session has been idle for its timeout and end it, unless
+    it was ended, a later run handed it to another reaper or a run holds it
+    """
+    while True:
+        entry = sess.find(app_name)
+        if entry is None or entry.get("reaper") != token:
+            return
+        wait = sess.remaining(entry)
+        if sess.in_use(entry):
+            time.sleep(max(wait, sess.POLL))
+        elif wait > 0:
+            time.sleep(wait)
+        else:
+            click.echo(f"Session for {app_name} has been idle too long, removing it")
+            end_session(app_name)
+            return
+
+
+def list_sessions() -> dict:
+    end_expired_sessions()
+    return sess.list_all()
+
+
+def end_expired_sessions() -> None:
+    for app_name in sess.expired():
+        click.echo(f"Session for {app_name} has been idle too long, removing it")
+        end_session(app_name)
 
 
 def cleanup(
     service_name: str, pid: int = 0, app_name: str = "ssh-app", key_name: str = "key"
 ) -> None:
     cf.check_cf_cli()
-    if pid != 0:
-        cf.delete_ssh_tunnel(pid)
+    # without a pid the tunnel recorded for the service is closed
+    cf.delete_ssh_tunnel(pid, service_name)
     cf.delete_service_key(key_name, service_name)
     cf.delete_app(app_name)
 
 
+def list_tunnels(stop: bool = False) -> dict:
+    tunnels.prune()
+    running = tunnels.list_all()
+    if stop:
+        for service_name, entry in running.items():
+            cf.delete_ssh_tunnel(entry["pid"], service_name)
+    return running
+
+
+@metrics.recorded("export", service="service_name")
 def export_from_svc(
     service_name: str,
     engine_type: str = None,
@@ -77,21 +528,40 @@ def export_from_svc(
     app_name: str = "ssh-app",
     do_setup: bool = True,
     do_teardown: bool = True,
+    jobs: int = 1,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+    codec: Codec = None,
+    resume: bool = False,
+    incremental: bool = False,
+    shards: tuple = (),
 ) -> None:
 
     if engine_type is None:
         engine_type = find_engine_type(service_name)
 
     engine = get_engine_handler(engine_type)
+    jobs = resolve_jobs(service_name, jobs)
 
     click.echo(f"Checking Prerequisites for {engine_type}")
-    engine.prerequisites()
+    with metrics.phase("prerequisites"):
+        engine.prerequisites()
+    if codec is not None:
+        codec.check()
     click.echo("Prerequisites present\n")
     # either push app and create key, or reuse existing setup and key
-    if do_setup:
+    if session:
+        # a session keeps the app and tunnel up for later runs
+        do_teardown = False
+    if do_setup or session:
         click.echo("Configuring CF space for SSH to Service")
         creds, pid = setup(
-            service_name, app_name=app_name, key_name=service_key, engine=engine
+            service_name,
+            app_name=app_name,
+            key_name=service_key,
+            engine=engine,
+            session=session,
+            idle_timeout=idle_timeout,
         )
         click.echo("Config complete\n")
     else:
@@ -100,19 +570,61 @@ def export_from_svc(
         pid = 0
         click.echo("Credentials ready\n")
 
-    click.echo("Performing export")
-    engine.export_svc(service_name, creds, backup_file, options, ignore_defaults)
-    # backup_db(service_name, creds, engine_type, backup_file, options)
-    click.echo("Export completed\n")
-
-    if do_teardown:
-        click.echo("Removing config for SSH to Database")
-        cleanup(service_name, pid)
-        click.echo("Removal complete\n")
+    try:
+        sizes = table_sizes(engine, creds)
+        preflight_export(
+            engine,
+            service_name,
+            sizes,
+            backup_file,
+            options,
+            ignore_defaults,
+            jobs,
+            codec,
+            resume or incremental or bool(shards),
+            resume or incremental,
+        )
+        click.echo("Performing export")
+        total = export_total(
+            engine,
+            sizes,
+            options,
+            ignore_defaults,
+            jobs,
+            codec,
+            resume or incremental or bool(shards),
+        )
+        with metrics.phase("dump", service_name) as phase, progress.track(
+            f"export {service_name}", backup_file, sizes, total
+        ):
+            engine.export_svc(
+                service_name,
+                creds,
+                backup_file,
+                options,
+                ignore_defaults,
+                jobs,
+                codec,
+                resume,
+                incremental,
+                shards,
+            )
+            phase.bytes = progress.path_size(backup_file)
+        # backup_db(service_name, creds, engine_type, backup_file, options)
+        click.echo("Export completed\n")
+    finally:
+        if session:
+            sess.release(app_name)
+        # a failed export must not leave the tunnel behind
+        if do_teardown:
+            click.echo("Removing config for SSH to Database")
+            cleanup(service_name, pid, app_name, service_key)
+            click.echo("Removal complete\n")
 
     click.echo(f"Export file of {service_name} can be found in {backup_file}")
 
 
+@metrics.recorded("import", service="service_name")
 def import_to_svc(
     service_name: str,
     engine_type: str = None,
@@ -123,21 +635,37 @@ def import_to_svc(
     app_name: str = "ssh-app",
     do_setup: bool = True,
     do_cleanup: bool = True,
+    jobs: int = 1,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+    resume: bool = False,
+    split: bool = False,
 ) -> None:
 
     if engine_type is None:
         engine_type = find_engine_type(service_name)
 
     engine = get_engine_handler(engine_type)
+    jobs = resolve_jobs(service_name, jobs)
 
     click.echo(f"Checking Prerequisites for {engine_type}")
-    engine.prerequisites()
+    with metrics.phase("prerequisites"):
+        engine.prerequisites()
     click.echo("Prerequisites present\n")
+    # needs no tunnel, so a dump that will not fit is caught before setup
+    preflight_import(engine, service_name, backup_file)
     # either push app and create key, or reuse existing setup and key
-    if do_setup:
+    if session:
+        do_cleanup = False
+    if do_setup or session:
         click.echo("Configuring CF space for SSH to Database")
         creds, pid = setup(
-            service_name, app_name=app_name, key_name=service_key, engine=engine
+            service_name,
+            app_name=app_name,
+            key_name=service_key,
+            engine=engine,
+            session=session,
+            idle_timeout=idle_timeout,
         )
         click.echo("Config complete\n")
     else:
@@ -146,16 +674,34 @@ def import_to_svc(
         pid = 0
         click.echo("Credentials ready\n")
 
-    click.echo("Performing import")
-    engine.import_svc(service_name, creds, backup_file, options, ignore_defaults)
-    click.echo("Import completed\n")
-
-    if do_cleanup:
-        click.echo("Removing config for SSH to Database")
-        cleanup(service_name, pid)
-        click.echo("Removal complete\n")
+    try:
+        click.echo("Performing import")
+        total = progress.path_size(backup_file)
+        with metrics.phase("restore", service_name) as phase, progress.track(
+            f"import {service_name}", total=total
+        ):
+            phase.bytes = total
+            engine.import_svc(
+                service_name,
+                creds,
+                backup_file,
+                options,
+                ignore_defaults,
+                jobs,
+                resume,
+                split,
+            )
+        click.echo("Import completed\n")
+    finally:
+        if session:
+            sess.release(app_name)
+        if do_cleanup:
+            click.echo("Removing config for SSH to Database")
+            cleanup(service_name, pid, app_name, service_key)
+            click.echo("Removal complete\n")
 
 
+@metrics.recorded("clone", source="src_service", destination="dst_service")
 def clone(
     src_service: str,
     dst_service: str,
@@ -166,43 +712,408 @@ def clone(
     ignore_defaults: bool = False,
     service_key: str = "key",
     app_name: str = "ssh-app",
+    stream: bool = False,
+    jobs: int = 1,
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+    codec: Codec = None,
+    resume: bool = False,
+    multiplex: bool = False,
+    split: bool = False,
 ) -> None:
 
     if engine_type is None:
         engine_type = find_engine_type(src_service)
+    if stream and resume:
+        raise click.ClickException("Streamed clones can not be resumed")
 
     engine = get_engine_handler(engine_type)
 
     click.echo(f"Checking Prerequisites for {engine_type}")
-    engine.prerequisites()
+    with metrics.phase("prerequisites"):
+        engine.prerequisites()
+    if codec is not None and stream:
+        click.echo("A streamed clone writes no file, --compress is ignored")
+    elif codec is not None:
+        codec.check()
     click.echo("Prerequisites present\n")
 
-    # First Backup source
-    click.echo(f"Setting up CF space for SSH to {src_service}")
-    creds, pid = setup(
-        src_service, app_name=app_name, key_name=service_key, engine=engine
-    )
-    click.echo("Setup complete\n")
+    jobs = resolve_jobs(dst_service, jobs)
 
-    click.echo(f"Performing exprot of {src_service}")
-    engine.export_svc(src_service, creds, backup_file, backup_options, ignore_defaults)
-    click.echo("Export completed\n")
+    if stream:
+        stream_clone(
+            src_service,
+            dst_service,
+            engine,
+            backup_options,
+            restore_options,
+            ignore_defaults,
+            service_key,
+            app_name,
+            session,
+            idle_timeout,
+            multiplex,
+            jobs,
+        )
+        return
 
-    click.echo(f"Cleaning up SSH for {src_service}")
-    cleanup(src_service, pid)
-    click.echo("Cleanup complete\n")
+    try:
+        click.echo(f"Setting up CF space for SSH to {src_service} and {dst_service}")
+        # one app push serves both tunnels, kept up until the import is done
+        setups = steps.run(
+            setup_services_async(
+                [(src_service, None, engine), (dst_service, None, engine)],
+                app_name,
+                service_key,
+                session=session,
+                idle_timeout=idle_timeout,
+                multiplex=multiplex,
+            )
+        )
+        src_creds, _ = setups[src_service]
+        dst_creds, _ = setups[dst_service]
+        click.echo("Setup complete\n")
 
-    # Now restore to destination
-    click.echo(f"Setting up CF space for SSH to {dst_service}")
-    creds, pid = setup(
-        dst_service, app_name=app_name, key_name=service_key, engine=engine
-    )
-    click.echo("Setup complete\n")
+        sizes = table_sizes(engine, src_creds)
+        preflight_export(
+            engine,
+            src_service,
+            sizes,
+            backup_file,
+            backup_options,
+            ignore_defaults,
+            jobs,
+            codec,
+            resume,
+            resume,
+        )
+        preflight_clone(engine, src_service, src_creds, dst_service)
+        click.echo(f"Performing exprot of {src_service}")
+        total = export_total(
+            engine, sizes, backup_options, ignore_defaults, jobs, codec, resume
+        )
+        with metrics.phase("dump", src_service) as phase, progress.track(
+            f"export {src_service}", backup_file, sizes, total
+        ):
+            engine.export_svc(
+                src_service,
+                src_creds,
+                backup_file,
+                backup_options,
+                ignore_defaults,
+                jobs,
+                codec,
+                resume,
+            )
+            phase.bytes = progress.path_size(backup_file)
+        click.echo("Export completed\n")
+
+        click.echo(f"Performing import to {dst_service}")
+        total = progress.path_size(backup_file)
+        with metrics.phase("restore", dst_service) as phase, progress.track(
+            f"import {dst_service}", total=total
+        ):
+            phase.bytes = total
+            engine.import_svc(
+                dst_service,
+                dst_creds,
+                backup_file,
+                restore_options,
+                ignore_defaults,
+                jobs,
+                resume,
+                split,
+            )
+        click.echo("Import Completed\n")
+    finally:
+        if session:
+            sess.release(app_name)
+        else:
+            teardown_services([src_service, dst_service], app_name, service_key)
 
-    click.echo(f"Performing import to {dst_service}")
-    engine.import_svc(dst_service, creds, backup_file, restore_options, ignore_defaults)
-    click.echo("Import Completed\n")
 
-    click.echo(f"Cleaning up SSH for {dst_service}")
-    cleanup(dst_service, pid)
+def stream_clone(
+    src_service: str,
+    dst_service: str,
+    engine: Engine,
+    backup_options: str = "",
+    restore_options: str = "",
+    ignore_defaults: bool = False,
+    service_key: str = "key",
+    app_name: str = "ssh-app",
+    session: bool = False,
+    idle_timeout: int = sess.IDLE_TIMEOUT,
+    multiplex: bool = False,
+    jobs: int = 1,
+) -> None:
+    """
+    Clone by piping the export client directly into the import client,
+    both tunnels are kept up for the duration and no local file is written.
+    """
+    try:
+        click.echo(f"Setting up CF space for SSH to {src_service} and {dst_service}")
+        # both keys and tunnels are set up concurrently through one app
+        setups = steps.run(
+            setup_services_async(
+                [(src_service, None, engine), (dst_service, None, engine)],
+                app_name,
+                service_key,
+                session=session,
+                idle_timeout=idle_timeout,
+                multiplex=multiplex,
+            )
+        )
+        src_creds, _ = setups[src_service]
+        dst_creds, _ = setups[dst_service]
+        click.echo("Setup complete\n")
+
+        preflight_clone(engine, src_service, src_creds, dst_service)
+        click.echo(f"Streaming {src_service} to {dst_service}")
+        label = f"stream {src_service} to {dst_service}"
+        sizes = table_sizes(engine, src_creds)
+        with metrics.phase("stream", src_service) as phase, progress.track(
+            label, sizes=sizes
+        ):
+            counter = progress.counter()
+            if metrics.enabled():
+                counter = phase.counter(counter)
+            engine.stream(
+                src_creds,
+                dst_creds,
+                backup_options,
+                restore_options,
+                ignore_defaults,
+                jobs,
+                counter,
+            )
+        click.echo("Stream completed\n")
+    finally:
+        # a session keeps both tunnels for later runs
+        if session:
+            sess.release(app_name)
+        else:
+            teardown_services([src_service, dst_service], app_name, service_key)
+
+
+def teardown_services(services: list, app_name: str, key_name: str) -> None:
+    """
+    Close the tunnels of the services by name, so whatever part of the setup
+    finished is removed, then delete their keys and the app concurrently.
+    Every step is attempted even when another fails, and the failures are
+    raised together at the end.
+    """
+    click.echo(f"Cleaning up SSH for {' and '.join(services)}")
+    cf.check_cf_cli()
+    failures = []
+
+    def attempt(name: str, fn: Callable) -> Callable:
+        def step() -> None:
+            try:
+                fn()
+            except click.ClickException as e:
+                failures.append((name, e))
+
+        return step
+
+    graph = Graph()
+    # together, so a multiplexed cf ssh is not restarted for each service
+    graph.add("tunnels", attempt("tunnels", lambda: cf.delete_ssh_tunnels(services)))
+    for service_name in services:
+        graph.add(
+            f"key:{service_name}",
+            attempt(
+                f"key {service_name}",
+                lambda x=service_name: cf.delete_service_key(key_name, x),
+            ),
+            after=["tunnels"],
+        )
+    delete_app = attempt(f"app {app_name}", lambda: cf.delete_app(app_name))
+    graph.add("app", delete_app, after=["tunnels"])
+    steps.run(graph.run())
+    if failures:
+        for name, e in failures:
+            click.secho(f"{name}: {e.format_message()}", fg="red")
+        raise click.ClickException(
+            f"{len(failures)} cleanup steps failed, remove what is left by hand"
+        )
     click.echo("Cleanup complete\n")
+
+
+@metrics.recorded("batch", action="action")
+def batch(
+    action: str,
+    services: list,
+    pattern: str = None,
+    directory: str = ".",
+    engine_type: str = None,
+    options: str = "",
+    ignore_defaults: bool = False,
+    service_key: str = "key",
+    app_name: str = "ssh-app",
+    workers: int = 4,
+    jobs: int = 1,
+    multiplex: bool = False,
+) -> dict:
+    """
+    Export or import many services through one pushed app, each service
+    gets its own tunnel and the transfers run concurrently. With multiplex
+    every service is forwarded by one cf ssh, set up before the transfers
+    start and closed after the last one.
+    """
+    cf.check_cf_cli()
+    services = list(services)
+    if pattern is not None:
+        services.extend(
+            x for x in cf.list_services() if fnmatch(x, pattern) and x not in services
+        )
+    if not services:
+        raise click.ClickException("No services matched")
+
+    engines = {}
+    for service_name in services:
+        name = engine_type or find_engine_type(service_name)
+        engines[service_name] = get_engine_handler(name)
+    for engine in {type(e): e for e in engines.values()}.values():
+        engine.prerequisites()
+
+    results = {}
+    shared = {}
+    # estimated bytes of the exports running, taken out of the free space
+    reserved = [0]
+    reserve_lock = threading.Lock()
+
+    def run(service_name: str) -> None:
+        engine = engines[service_name]
+        backup_file = path.join(directory, f"{service_name}.sql")
+        start = time.monotonic()
+        pid = 0
+        try:
+            if multiplex:
+                # closing one forward would restart the others, so they all
+                # stay up until every transfer is done
+                creds, _ = shared[service_name]
+            else:
+                # each tunnel reserves its own free port, so they come up
+                # concurrently
+                creds, pid = setup(
+                    service_name,
+                    app_name=app_name,
+                    key_name=service_key,
+                    engine=engine,
+                    push_app=False,
+                )
+            svc_jobs = resolve_jobs(service_name, jobs)
+            if action == "export":
+                sizes = table_sizes(engine, creds)
+                # checked and reserved together, so exports starting at the
+                # same time do not each count on the same free space
+                with reserve_lock:
+                    needed = preflight_export(
+                        engine,
+                        service_name,
+                        sizes,
+                        backup_file,
+                        options,
+                        ignore_defaults,
+                        svc_jobs,
+                        reserved=reserved[0],
+                    )
+                    reserved[0] += needed
+                total = export_total(engine, sizes, options, ignore_defaults, svc_jobs)
+                try:
+                    with metrics.phase("dump", service_name) as phase, progress.track(
+                        f"export {service_name}", backup_file, sizes, total
+                    ):
+                        engine.export_svc(
+                            service_name,
+                            creds,
+                            backup_file,
+                            options,
+                            ignore_defaults,
+                            svc_jobs,
+                        )
+                        phase.bytes = progress.path_size(backup_file)
+                finally:
+                    with reserve_lock:
+                        reserved[0] -= needed
+            else:
+                preflight_import(engine, service_name, backup_file)
+                total = progress.path_size(backup_file)
+                with metrics.phase("restore", service_name) as phase, progress.track(
+                    f"import {service_name}", total=total
+                ):
+                    phase.bytes = total
+                    engine.import_svc(
+                        service_name,
+                        creds,
+                        backup_file,
+                        options,
+                        ignore_defaults,
+                        svc_jobs,
+                    )
+            results[service_name] = {"status": "ok", "file": backup_file}
+        except Exception as e:
+            if isinstance(e, click.ClickException):
+                error = e.format_message()
+            else:
+                error = str(e)
+            results[service_name] = {
+                "status": "failed",
+                "file": backup_file,
+                "error": error,
+            }
+        results[service_name]["seconds"] = round(time.monotonic() - start, 1)
+        if not multiplex:
+            # a setup that failed part way has no pid but may have left its
+            # tunnel or key behind, both are found by the service name
+            for cleanup in [
+                lambda: cf.delete_ssh_tunnel(pid, service_name),
+                lambda: cf.delete_service_key(service_key, service_name),
+            ]:
+                try:
+                    cleanup()
+                except click.ClickException as e:
+                    click.echo(
+                        f"Cleanup of {service_name} failed: {e.format_message()}"
+                    )
+
+    cf.push_app(app_name)
+    try:
+        cf.enable_ssh(app_name)
+        pending = services
+        if multiplex:
+            setups = [(x, None, engines[x]) for x in services]
+            try:
+                shared.update(
+                    steps.run(
+                        setup_services_async(
+                            setups,
+                            app_name,
+                            service_key,
+                            push_app=False,
+                            multiplex=True,
+                        )
+                    )
+                )
+            except click.ClickException as e:
+                # one cf ssh forwards every service, so none of them can run
+                for service_name in services:
+                    results[service_name] = {
+                        "status": "failed",
+                        "file": path.join(directory, f"{service_name}.sql"),
+                        "error": e.format_message(),
+                        "seconds": 0.0,
+                    }
+                pending = []
+        # run_parallel carries the metrics and progress context to the workers
+        run_parallel(run, pending, workers)
+    finally:
+        try:
+            if multiplex:
+                # best effort, the app goes even when a tunnel or key does not
+                teardown_services(services, app_name, service_key)
+            else:
+                cf.delete_app(app_name)
+        except click.ClickException as e:
+            click.echo(f"Cleanup failed: {e.format_message()}")
+    return {x: results[x] for x in services}
@@ -0,0 +1,25 @@
+import os
+import stat
+from cg_manage_rds.cmds import cache
+
+
+def test_cache_ttl(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    cache.put("key:space:db-one:key", {"password": "secret"}, ttl=60)
+    cache.put("plan:space:db-one", "micro-psql", ttl=-1)
+    assert cache.get("key:space:db-one:key") == {"password": "secret"}
+    # expired entries are never returned
+    assert cache.get("plan:space:db-one") is None
+    # credentials are only readable by the user
+    mode = os.stat(tmp_path / cache.STATE_FILE).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+    assert cache.delete("key:space:db-one:ke") is False
+    assert cache.invalidate("key:space:db-one:") == 1
+    assert cache.get("key:space:db-one:key") is None
+
+
+def test_cache_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    monkeypatch.setattr(cache, "ENABLED", False)
+    cache.put("plan:space:db-one", "micro-psql", ttl=60)
+    assert cache.get("plan:space:db-one") is None
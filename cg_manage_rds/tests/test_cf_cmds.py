@@ -1,3 +1,5 @@
+import socket
+from cg_manage_rds.cmds import cache
 from cg_manage_rds.cmds import cf_cmds
 
 
@@ -20,3 +22,50 @@ def test_validate_cf_cli_version():
     )
     assert version.major == 9
     assert (is_valid) is False
+
+
+def test_wait_for_tunnel():
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        # a listening port is ready without a probe
+        assert cf_cmds.wait_for_tunnel(port, timeout=1) is not None
+        # a probe that is never satisfied times out
+        assert cf_cmds.wait_for_tunnel(port, lambda s: False, timeout=0.5) is None
+    # nothing listening times out
+    assert cf_cmds.wait_for_tunnel(port, timeout=0.5) is None
+
+
+def test_parse_services():
+    result = """Getting service instances in org sandbox / space dev as user...
+
+name        offering   plan         bound apps   last operation     broker       upgrade available
+db-one      aws-rds    micro-psql                create succeeded   aws-broker
+db-two      aws-rds    small-mysql  web          create succeeded   aws-broker
+bucket      s3         basic                     create succeeded   s3-broker
+"""
+    assert cf_cmds.parse_services(result) == ["db-one", "db-two"]
+    assert cf_cmds.parse_services("No service instances found.") == []
+
+
+def test_delete_service_key_without_target(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    monkeypatch.setattr(cf_cmds, "run_sync", lambda cmd: (0, "", "OK"))
+    cache.put("plan:space:db-two", "micro-psql", ttl=60)
+    # with no space targeted there is no key to invalidate, not every key
+    monkeypatch.setattr(cf_cmds, "target", lambda: "")
+    cf_cmds.delete_service_key("key", "db-one")
+    assert cache.get("plan:space:db-two") == "micro-psql"
+
+
+def test_delete_service_key_keeps_similar_keys(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    monkeypatch.setattr(cf_cmds, "run_sync", lambda cmd: (0, "", "OK"))
+    monkeypatch.setattr(cf_cmds, "target", lambda: "space")
+    for name in ["key", "key2", "key-old"]:
+        cache.put(cf_cmds.cache_key("key", "db-one", name), {"name": name}, ttl=60)
+    cf_cmds.delete_service_key("key", "db-one")
+    assert cache.get(cf_cmds.cache_key("key", "db-one", "key")) is None
+    assert cache.get(cf_cmds.cache_key("key", "db-one", "key2")) == {"name": "key2"}
+    assert cache.get(cf_cmds.cache_key("key", "db-one", "key-old")) is not None
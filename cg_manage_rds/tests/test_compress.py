@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+import pytest
+from cg_manage_rds.cmds import compress
+from cg_manage_rds.cmds import progress
+
+
+@pytest.mark.skipif(shutil.which("gzip") is None, reason="gzip not installed")
+def test_gzip_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(progress, "JSON_FILE", str(tmp_path / "progress.jsonl"))
+    backup_file = str(tmp_path / "db_backup.sql.gz")
+    codec = compress.Codec("gzip", level=1)
+    dump = [sys.executable, "-c", "print('CREATE TABLE t (id int);')"]
+    compress.export_to(dump, codec, backup_file)
+    detected = compress.detect(backup_file)
+    assert detected.name == "gzip"
+    assert compress.peek(detected, backup_file, 6) == b"CREATE"
+    # an import counts the compressed bytes, like the size of the file
+    load = [sys.executable, "-c", "import sys; sys.stdin.read()"]
+    with progress.track("import", total=os.path.getsize(backup_file)) as p:
+        compress.import_from(detected, backup_file, load)
+    assert p.bytes() == os.path.getsize(backup_file)
+
+
+def test_detect_plain_file(tmp_path):
+    backup_file = tmp_path / "db_backup.sql"
+    backup_file.write_text("CREATE TABLE t (id int);")
+    assert compress.detect(str(backup_file)) is None
+
+
+def test_compress_cmd():
+    assert compress.Codec("zstd", 3, 4).compress_cmd() == [
+        "zstd",
+        "-q",
+        "-c",
+        "-3",
+        "-T4",
+    ]
+    assert compress.Codec("lz4").decompress_cmd("f.lz4") == [
+        "lz4",
+        "-q",
+        "-d",
+        "-c",
+        "f.lz4",
+    ]
@@ -0,0 +1,41 @@
+import asyncio
+import time
+import pytest
+from cg_manage_rds.cmds.graph import Graph
+
+
+def test_independent_steps_overlap():
+    graph = Graph()
+    order = []
+    graph.add("push", lambda: time.sleep(0.3) or order.append("push"))
+    graph.add("key", lambda: time.sleep(0.3) or "creds")
+    graph.add(
+        "tunnel",
+        lambda: order.append("tunnel") or graph.results["key"],
+        after=["push", "key"],
+    )
+    start = time.monotonic()
+    results = asyncio.run(graph.run())
+    assert time.monotonic() - start < 0.55
+    assert order == ["push", "tunnel"]
+    assert results["tunnel"] == "creds"
+
+
+def test_failure_cancels_dependents():
+    graph = Graph()
+    ran = []
+
+    def fail():
+        raise RuntimeError("push failed")
+
+    graph.add("push", fail)
+    graph.add("key", lambda: ran.append("key"))
+    graph.add("tunnel", lambda: ran.append("tunnel"), after=["push", "key"])
+    with pytest.raises(RuntimeError):
+        asyncio.run(graph.run())
+    assert "tunnel" not in ran
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        Graph().add("tunnel", lambda: None, after=["push"])
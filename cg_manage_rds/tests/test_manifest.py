@@ -0,0 +1,49 @@
+import os
+import click
+import pytest
+from cg_manage_rds.cmds import manifest
+
+
+def test_checkpoint_resume(tmp_path):
+    backup = str(tmp_path / "dump")
+    ran = []
+    checkpoint = manifest.Checkpoint(backup, "export")
+    checkpoint.run("data:a", ran.append, "a")
+    assert "data:a" in checkpoint
+    # a resumed run skips finished units
+    checkpoint = manifest.Checkpoint(backup, "export", resume=True)
+    checkpoint.run("data:a", ran.append, "a")
+    checkpoint.run("data:b", ran.append, "b")
+    assert ran == ["a", "b"]
+    # phases are tracked apart, and a fresh run starts over
+    assert "data:a" not in manifest.Checkpoint(backup, "import", resume=True)
+    assert "data:a" not in manifest.Checkpoint(backup, "export")
+
+
+def test_chain(tmp_path):
+    chain = str(tmp_path / "nightly")
+    link, previous = manifest.next_link(chain)
+    assert previous is None
+    os.makedirs(link)
+    dump = {
+        "data": {"a": "data/00000.dump", "b": "data/00001.dump"},
+        "fingerprints": {"a": "1:0:0", "b": "5:0:0"},
+    }
+    manifest.write(link, dump)
+    # nothing to import until the first export has finished
+    with pytest.raises(click.ClickException):
+        manifest.resolve(chain)
+    manifest.add_link(chain, link)
+    assert manifest.resolve(chain) == (link, dump)
+
+    second, previous = manifest.next_link(chain)
+    assert previous == (link, dump)
+    # only a was left alone, its file is taken from the first export
+    reused = manifest.unchanged(second, previous, {"a": "1:0:0", "b": "7:2:0"})
+    assert reused == {"a": os.path.join("..", "0000", "data", "00000.dump")}
+
+
+def test_chain_refuses_other_dumps(tmp_path):
+    (tmp_path / "manifest.json").write_text('{"format": "cg-manage-rds/pgsql-tables"}')
+    with pytest.raises(click.ClickException):
+        manifest.next_link(str(tmp_path))
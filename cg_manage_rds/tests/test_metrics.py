@@ -0,0 +1,55 @@
+import json
+import click
+import pytest
+from cg_manage_rds.cmds import metrics
+
+
+@metrics.timed("service_key")
+def make_key(key_name, service_name):
+    if key_name == "bad":
+        raise click.ClickException("no such service")
+
+
+@metrics.recorded("export", service="service_name")
+def export(service_name, key_name="key"):
+    make_key(key_name, service_name)
+    with metrics.phase("dump", service_name) as phase:
+        phase.bytes = 42
+    make_key(key_name, service_name)
+
+
+def test_report(tmp_path, monkeypatch):
+    report, prom = tmp_path / "run.json", tmp_path / "run.prom"
+    monkeypatch.setattr(metrics, "JSON_FILE", str(report))
+    monkeypatch.setattr(metrics, "PROMETHEUS_FILE", str(prom))
+    export("db")
+    run = json.loads(report.read_text())
+    assert run["labels"] == {"service": "db"}
+    assert [p["name"] for p in run["phases"]] == ["service_key", "dump", "service_key"]
+    assert run["phases"][1]["bytes"] == 42
+    text = prom.read_text()
+    assert (
+        'cg_manage_rds_phase_runs{command="export",phase="service_key",service="db"} 2'
+        in text
+    )
+    assert (
+        'cg_manage_rds_phase_bytes{command="export",phase="dump",service="db"} 42'
+        in text
+    )
+    assert 'cg_manage_rds_run_success{command="export",service="db"} 1' in text
+
+
+def test_failed_phase(tmp_path, monkeypatch):
+    report = tmp_path / "run.json"
+    monkeypatch.setattr(metrics, "JSON_FILE", str(report))
+    with pytest.raises(click.ClickException):
+        export("db", "bad")
+    run = json.loads(report.read_text())
+    assert run["status"] == "failed"
+    assert run["phases"][0]["error"] == "no such service"
+
+
+def test_nothing_recorded_when_disabled(tmp_path):
+    # no run, so phases are timed against nothing and nothing is written
+    export("db")
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,88 @@
+import click
+import pytest
+from cg_manage_rds.cmds.mysql import MySql
+
+SCHEMA = """DROP TABLE IF EXISTS `orders`;
+CREATE TABLE `orders` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `ref` varchar(20) NOT NULL,
+  `customer_id` int DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ref` (`ref`),
+  KEY `customer_id` (`customer_id`),
+  CONSTRAINT `orders_fk` FOREIGN KEY (`customer_id`) REFERENCES `customers` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+CREATE TABLE `log` (
+  `seq` int NOT NULL AUTO_INCREMENT,
+  `msg` text,
+  KEY `seq` (`seq`)
+) ENGINE=InnoDB;
+"""
+
+
+def test_split_schema():
+    pre, keys, fks = MySql().split_schema(SCHEMA)
+    assert "UNIQUE KEY" not in pre
+    assert "CONSTRAINT" not in pre
+    assert "  PRIMARY KEY (`id`)\n) ENGINE=InnoDB" in pre
+    assert keys["orders"] == (
+        "ALTER TABLE `orders` ADD UNIQUE KEY `ref` (`ref`),"
+        " ADD KEY `customer_id` (`customer_id`);"
+    )
+    assert fks["orders"].startswith("ALTER TABLE `orders` ADD CONSTRAINT `orders_fk`")
+    # the only key on an auto increment column has to stay
+    assert "  KEY `seq` (`seq`)\n) ENGINE=InnoDB;" in pre
+    assert "log" not in keys
+
+
+def test_defer_keys(tmp_path):
+    dump = tmp_path / "dump.sql"
+    data = "INSERT INTO `orders` VALUES (1,'a\\xff',NULL);\n"
+    dump.write_bytes(
+        b"-- MySQL dump\n" + SCHEMA.encode() + data.encode() + b"\xff\xfe\n"
+    )
+    keys, fks = {}, {}
+    out = b"".join(MySql().defer_keys(str(dump), keys, fks))
+    assert b"UNIQUE KEY" not in out and b"CONSTRAINT" not in out
+    # everything outside CREATE TABLE passes through byte for byte
+    assert out.startswith(b"-- MySQL dump\nDROP TABLE IF EXISTS `orders`;\n")
+    assert out.endswith(data.encode() + b"\xff\xfe\n")
+    assert set(keys) == {"orders"} and set(fks) == {"orders"}
+
+
+def test_batch_commits():
+    lines = [
+        b"CREATE TABLE `a` (\n",
+        b"  `id` int\n",
+        b");\n",
+        b"INSERT INTO `a` VALUES (1),(2);\n",
+        b"DELIMITER ;;\n",
+        b"/*!50003 CREATE*/ /*!50003 TRIGGER t AFTER INSERT ON a FOR EACH ROW BEGIN\n",
+        b"INSERT INTO log VALUES (1);\n",
+        b"END */;;\n",
+        b"DELIMITER ;\n",
+        b"INSERT INTO `a` VALUES (3);\n",
+    ]
+    out = list(MySql().batch_commits(lines, size=10))
+    commits = [i for i, x in enumerate(out) if x == b"COMMIT;\n"]
+    # after each complete insert, never inside the trigger, and at the end
+    assert [out[i - 1] for i in commits[:-1]] == [lines[3], lines[9]]
+    assert commits[-1] == len(out) - 1
+    assert b"".join(x for x in out if x != b"COMMIT;\n") == b"".join(lines)
+
+
+def test_tab_tables(tmp_path):
+    for name in ["a.sql", "a.txt", "b.sql", "b.txt", "v.sql", "notes.txt"]:
+        (tmp_path / name).write_text("")
+    assert MySql().tab_tables(str(tmp_path)) == ["a", "b"]
+    assert MySql().tab_tables(str(tmp_path / "a.sql")) == []
+
+
+def test_import_unknown_directory(tmp_path):
+    (tmp_path / "notes.txt").write_text("")
+    with pytest.raises(click.ClickException, match="mysqldump --tab"):
+        MySql().import_svc("db", {"db_name": "db"}, str(tmp_path))
+    # the manifest of a postgres export is not one to import either
+    (tmp_path / "manifest.json").write_text('{"format": "cg-manage-rds/pgsql-tables"}')
+    with pytest.raises(click.ClickException, match="not a mysql dump"):
+        MySql().import_svc("db", {"db_name": "db"}, str(tmp_path))
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import click
+import pytest
+from cg_manage_rds import commands
+from cg_manage_rds.cmds.engine import Engine
+from cg_manage_rds.cmds.pgcopy import PgCopy
+
+
+def test_engine():
+    engine = commands.get_engine_handler("pgcopy")
+    assert isinstance(engine, PgCopy)
+    assert isinstance(engine, Engine)
+
+
+def test_setval():
+    pg = PgCopy()
+    values = pg._sequence_values(
+        "public.orders_id_seq\t1042\tt\n" 'public."O\'Brien_seq"\t1\tf\n'
+    )
+    assert values == {
+        "public.orders_id_seq": ("1042", True),
+        'public."O\'Brien_seq"': ("1", False),
+    }
+    assert pg.setval('public."O\'Brien_seq"', "1", False) == (
+        "SELECT pg_catalog.setval('public.\"O''Brien_seq\"', 1, false);"
+    )
+
+
+def test_stream_pipes_export_into_import(capsys):
+    class Piped(PgCopy):
+        # the default stream of the Engine, with commands that exist here
+        stream = Engine.stream
+
+        def stream_export_cmd(self, creds, options=None, ignore=False):
+            return ["echo", creds["uri"]]
+
+        def stream_import_cmd(self, creds, options=None, ignore=False):
+            return [creds["uri"]]
+
+    counted = []
+    Piped().stream({"uri": "rows"}, {"uri": "cat"}, counter=counted.append)
+    assert sum(counted) == len("rows\n")
+    # the default stream is one pipe, so more jobs are not used
+    Piped().stream({"uri": "rows"}, {"uri": "cat"}, jobs=4)
+    assert "--jobs is ignored" in capsys.readouterr().out
+    with pytest.raises(click.ClickException):
+        Piped().stream({"uri": "rows"}, {"uri": "false"})
+
+
+CLIENT = """
+import json, os, sys
+
+name, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(json.dumps([name] + args) + "\\n")
+uri = args[args.index("-d") + 1]
+sql = " ".join(args[i + 1] for i, a in enumerate(args) if a == "-c")
+if name == "pg_dump":
+    print("archive")
+elif name == "pg_restore" or "FROM STDIN" in sql:
+    sys.stdin.read()
+elif name == "psql" and not sql:
+    # the session holding the snapshot
+    for line in sys.stdin:
+        if line.startswith("SELECT"):
+            print("00000003-0000001B-1", flush=True)
+elif "extconfig" in sql:
+    print("public.spatial_ref_sys\\tsrid, srtext\\tWHERE srid > 32767")
+elif "pg_largeobject_metadata" in sql:
+    print("t")
+elif "relkind = 'r'" in sql:
+    print("public.orders\\tpublic\\torders\\tid, total\\tt")
+    # a column of an array of an enum of its own
+    print("public.tickets\\tpublic\\ttickets\\tid, states\\tf")
+    if uri == "src":
+        print("public.users\\tpublic\\tusers\\tid, name\\tt")
+elif "pg_sequences" in sql:
+    print("public.orders_id_seq\\t42\\tt")
+elif "TO STDOUT" in sql:
+    print("rows")
+"""
+
+
+@pytest.mark.skipif(os.name != "posix", reason="executable client shims")
+def test_stream_order(tmp_path, monkeypatch):
+    log = tmp_path / "calls.log"
+    for name in ["psql", "pg_dump", "pg_restore"]:
+        shim = tmp_path / name
+        shim.write_text(f"#!{sys.executable}\n" + CLIENT.format(log=str(log)))
+        shim.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    PgCopy().stream({"uri": "src"}, {"uri": "dst"})
+
+    calls = [json.loads(x) for x in log.read_text().splitlines()]
+    steps = []
+    for call in calls:
+        text = " ".join(call)
+        if "--section=" in text:
+            assert "--snapshot=00000003-0000001B-1" in call
+            steps.append(call[0] + " " + text.split("--section=")[1].split()[0])
+        elif "COPY" in text:
+            # both ends of a pipe start together, in either order
+            steps.append("copy")
+        elif "setval" in text:
+            steps.append("setval")
+    assert steps == [
+        "pg_dump pre-data",
+        *["copy"] * 6,
+        "pg_dump data",
+        "setval",
+        "pg_dump post-data",
+    ]
+    # only the tables the schema pass created, with the source's columns on
+    # both sides, read as of the snapshot the schema was dumped with
+    copies = [c for c in calls if "COPY" in " ".join(c)]
+    assert sorted(c[-1] if c[-1] != "COMMIT" else c[-3] for c in copies) == [
+        "COPY (SELECT srid, srtext FROM public.spatial_ref_sys WHERE srid > 32767)"
+        " TO STDOUT (FORMAT text)",
+        "COPY public.orders (id, total) FROM STDIN (FORMAT binary)",
+        "COPY public.orders (id, total) TO STDOUT (FORMAT binary)",
+        "COPY public.spatial_ref_sys (srid, srtext) FROM STDIN (FORMAT text)",
+        "COPY public.tickets (id, states) FROM STDIN (FORMAT text)",
+        "COPY public.tickets (id, states) TO STDOUT (FORMAT text)",
+    ]
+    # the large objects come from a data pass without any table
+    blobs = next(c for c in calls if "--section=data" in c)
+    assert blobs[-3:] == ["-b", "-T", "*.*"]
+    copy_out = next(c for c in copies if c[-1] == "COMMIT")
+    assert "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'" in copy_out
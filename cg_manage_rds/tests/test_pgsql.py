@@ -0,0 +1,107 @@
+import os
+import click
+import pytest
+from cg_manage_rds.cmds.pgsql import PgSql
+
+
+def test_dump_format():
+    pg = PgSql()
+    assert pg._dump_format(["-O", "-c"]) == "p"
+    assert pg._dump_format(["-F", "t"]) == "t"
+    assert pg._dump_format(["-Fc"]) == "c"
+    assert pg._dump_format(["--format=directory"]) == "d"
+    assert pg._strip_format(["-F", "t", "-O", "--format=c", "-Fd"]) == ["-O"]
+
+
+def test_stream_export_cmd():
+    pg = PgSql()
+    creds = {"uri": "src"}
+    assert pg.stream_export_cmd(creds)[-1] == "-Z0"
+    cmd = pg.stream_export_cmd(creds, "-Ft -Z 5 -n app", ignore=True)
+    assert cmd == ["pg_dump", "-d", "src", "-Fc", "-Z", "5", "-n", "app"]
+    cmd = pg.stream_export_cmd(creds, "--compress=zstd", ignore=True)
+    assert cmd == ["pg_dump", "-d", "src", "-Fc", "--compress=zstd"]
+
+
+def test_archive_tables():
+    listing = (
+        ";\n"
+        "; Archive created at 2024-03-18 12:00:00 UTC\n"
+        ";\n"
+        "215; 1259 16386 TABLE public orders app\n"
+        # an entry without an owner ends in a space
+        "216; 1259 16390 TABLE sales line_items \n"
+        "3290; 0 16386 TABLE DATA public orders app\n"
+        "3120; 2606 16394 CONSTRAINT public orders orders_pkey app\n"
+    )
+    assert PgSql().archive_tables(listing) == [
+        ("public", "orders"),
+        ("sales", "line_items"),
+    ]
+
+
+def test_foreign_keys():
+    found = (
+        "ALTER TABLE public.items DROP CONSTRAINT IF EXISTS items_order_fkey;\t\n"
+        "ALTER TABLE audit.log DROP CONSTRAINT IF EXISTS log_order_fkey;\t"
+        "ALTER TABLE audit.log ADD CONSTRAINT log_order_fkey "
+        "FOREIGN KEY (order_id) REFERENCES public.orders(id);"
+    )
+    drops, adds = PgSql()._foreign_keys(found)
+    assert len(drops) == 2
+    # only the keys of tables outside the archive are added back
+    assert adds == [
+        "ALTER TABLE audit.log ADD CONSTRAINT log_order_fkey "
+        "FOREIGN KEY (order_id) REFERENCES public.orders(id);"
+    ]
+
+
+def test_key_ranges():
+    bounds = [f"'{x}'" for x in range(0, 101, 10)]
+    assert PgSql().key_ranges('"id"', bounds, 4) == [
+        "\"id\" < '20'",
+        "\"id\" >= '20' AND \"id\" < '50'",
+        "\"id\" >= '50' AND \"id\" < '70'",
+        "\"id\" >= '70'",
+    ]
+    # never more ranges than buckets, and none without a histogram
+    assert len(PgSql().key_ranges("id", bounds, 500)) == 10
+    assert PgSql().key_ranges("id", ["'1'", "'1'", "'2'"], 3) == [
+        "id < '1'",
+        "id >= '1'",
+    ]
+    assert PgSql().key_ranges("id", ["'1'", "'9'"], 3) == []
+    assert PgSql().key_ranges("id", [], 3) == []
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell script psql shim")
+def test_snapshot(tmp_path, monkeypatch):
+    log = tmp_path / "session.log"
+    psql = tmp_path / "psql"
+    psql.write_text(
+        "#!/bin/sh\n"
+        "while read line; do\n"
+        f'  echo "$line" >> "{log}"\n'
+        '  case "$line" in SELECT*) echo 00000003-0000001B-1;; esac\n'
+        "done\n"
+    )
+    psql.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    with PgSql().snapshot({"uri": "src"}) as name:
+        assert name == "00000003-0000001B-1"
+        assert "COMMIT" not in log.read_text()
+    # the session is held open for the block and ended after it
+    assert log.read_text().split("\n")[-2] == "COMMIT;"
+
+    psql.write_text("#!/bin/sh\necho 'connection refused' >&2\nexit 2\n")
+    with pytest.raises(click.ClickException, match="connection refused"):
+        with PgSql().snapshot({"uri": "src"}):
+            pass
+
+
+def test_count_tables():
+    dump = {"shards": {"public.events": [{}, {}, {}], "public.logs": [{}, {}]}}
+    assert PgSql()._count_tables(["public.users"], dump, 4) == (
+        "3 tables with 4 jobs, 2 of them in 5 ranges"
+    )
+    assert PgSql()._count_tables(["public.users"], {}, 1) == "1 tables with 1 jobs"
@@ -0,0 +1,66 @@
+import click
+import pytest
+from cg_manage_rds import commands
+from cg_manage_rds.cmds import preflight
+from cg_manage_rds.cmds.compress import Codec
+from cg_manage_rds.cmds.pgsql import PgSql
+
+
+def test_dump_estimate():
+    sizes = {"a": 600, "b": 400}
+    assert preflight.dump_estimate(sizes, False) == 1000
+    assert preflight.dump_estimate(sizes, True) == 350
+    assert preflight.dump_estimate(sizes, True, Codec("zstd")) == 250
+
+
+def test_dump_compressed():
+    pg = PgSql()
+    assert not pg.dump_compressed(None)
+    assert pg.dump_compressed("-Fc")
+    assert not pg.dump_compressed("-Fc -Z 0")
+    assert not pg.dump_compressed("-Fd --compress=none")
+    assert pg.dump_compressed(None, jobs=4)
+    assert pg.dump_compressed(None, tables=True)
+
+
+def test_export_total():
+    # progress counts the bytes written, so the total is the dump estimate
+    pg = PgSql()
+    sizes = {"a": 600, "b": 400}
+    assert commands.export_total(pg, {}, None, False, 1) is None
+    assert commands.export_total(pg, sizes, None, False, 1) == 1000
+    assert commands.export_total(pg, sizes, "-Fc", False, 1) == 350
+    assert commands.export_total(pg, sizes, None, False, 1, tables=True) == 350
+    assert commands.export_total(pg, sizes, None, False, 1, Codec("zstd")) == 250
+
+
+def test_restore_estimate(tmp_path):
+    plain = tmp_path / "db.sql"
+    plain.write_bytes(b"x" * 700)
+    assert preflight.restore_estimate(str(plain), False) == 700
+    gz = tmp_path / "db.sql.gz"
+    gz.write_bytes(b"\x1f\x8b" + b"x" * 298)
+    assert preflight.restore_estimate(str(gz), False) == 1000
+
+
+def test_check_local(tmp_path, monkeypatch):
+    monkeypatch.setattr(preflight, "free_space", lambda f: 1000)
+    out = str(tmp_path / "new" / "db.sql")
+    preflight.check_local(out, 500)
+    with pytest.raises(click.ClickException, match="--preflight false"):
+        preflight.check_local(out, 1500)
+    # the output being replaced frees its space
+    preflight.check_local(out, 1500, reclaimed=600)
+    # exports running alongside it take their share first
+    with pytest.raises(click.ClickException):
+        preflight.check_local(out, 500, reserved=600)
+
+
+def test_free_space_of_missing_directory(tmp_path):
+    assert preflight.free_space(str(tmp_path / "a" / "b" / "db.sql")) > 0
+
+
+def test_plan_storage():
+    assert preflight.plan_storage("medium-gp-psql") == 100 * 1024**3
+    assert preflight.plan_storage("2xlarge-gp-mysql") == 2048 * 1024**3
+    assert preflight.plan_storage("custom") is None
@@ -0,0 +1,36 @@
+import json
+import sys
+from cg_manage_rds.cmds import progress
+from cg_manage_rds.cmds import utils
+
+
+def test_sample_rate_and_eta(tmp_path):
+    out = tmp_path / "dump.sql"
+    out.write_bytes(b"x" * 100)
+    p = progress.Progress("export db", str(out), {"a": 600, "b": 400})
+    sample = p.sample(now=p.started + 10)
+    assert sample["bytes"] == 100
+    assert sample["percent"] == 10.0
+    assert sample["rate"] == 10
+    assert sample["eta"] == 90
+    # nothing written since the last sample
+    sample = p.sample(now=p.started + 20)
+    assert sample["stalled"] == 10
+
+
+def test_pipeline_counts_bytes(tmp_path, monkeypatch):
+    records = tmp_path / "progress.jsonl"
+    monkeypatch.setattr(progress, "JSON_FILE", str(records))
+    cmds = [
+        [sys.executable, "-c", "import sys; sys.stdout.write('x' * 300000)"],
+        [sys.executable, "-c", "import sys; print(len(sys.stdin.read()))"],
+    ]
+    with progress.track("stream", sizes={"t": 300000}) as p:
+        code, result, _ = utils.run_pipeline(cmds, counter=progress.counter())
+        progress.table_done("t")
+    assert code == 0
+    assert result == "300000"
+    assert p.bytes() == 300000
+    events = [json.loads(x) for x in records.read_text().splitlines()]
+    assert [e["event"] for e in events] == ["start", "table", "done"]
+    assert events[-1]["bytes"] == 300000
@@ -0,0 +1,13 @@
+from cg_manage_rds.cmds import session
+
+
+def test_session_expiry(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    entry = session.touch("ssh-app", "db-one", "key", idle_timeout=10)
+    assert entry["services"] == {"db-one": {"key": "key"}}
+    assert session.expired() == {}
+    # ten idle minutes later the session is due for teardown
+    assert not session.is_expired(entry, entry["last_used"] + 599)
+    assert session.is_expired(entry, entry["last_used"] + 601)
+    session.forget("ssh-app")
+    assert session.find("ssh-app") is None
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import click
+import pytest
+from cg_manage_rds import commands
+from cg_manage_rds.cmds import cf_cmds, preflight, session, tunnels
+from cg_manage_rds.cmds.compress import Codec
+from cg_manage_rds.cmds.pgsql import PgSql
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="shell script cf shim")
+
+FAKE_CF = os.path.join(
+    os.path.dirname(__file__), "..", "..", "benchmarks", "fake_cf.py"
+)
+
+
+def postgres_stub() -> int:
+    # answers the SSLRequest the pgsql handshake sends
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                conn.recv(8)
+                conn.sendall(b"N")
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def fake_cf(tmp_path, monkeypatch, cf_version: str, names: list) -> None:
+    shim = tmp_path / "cf"
+    shim.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_CF}" "$@"\n')
+    shim.chmod(0o755)
+    target = f"127.0.0.1:{postgres_stub()}"
+    services = {
+        name: {
+            "plan": "micro-psql",
+            "host": f"{name}.rds.internal",
+            "port": 5432,
+            "db_name": name,
+            "username": "user",
+            "password": "secret",
+            "target": target,
+        }
+        for name in names
+    }
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("CF_HOME", str(tmp_path))
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path / "state"))
+    monkeypatch.setenv("FAKE_CF_VERSION", cf_version)
+    monkeypatch.setenv("FAKE_CF_SERVICES", json.dumps(services))
+    monkeypatch.setattr(cf_cmds, "CF_VERSION_PASSED", False)
+    monkeypatch.setattr(commands.cache, "ENABLED", False)
+
+
+@pytest.mark.parametrize("cf_version", ["7", "8"])
+def test_setup_and_cleanup(tmp_path, monkeypatch, cf_version):
+    fake_cf(tmp_path, monkeypatch, cf_version, ["db"])
+    creds, pid = commands.setup("db", "pgsql")
+    assert creds["username"] == "user"
+    assert creds["local_port"] == 65432
+    assert tunnels.find("db")["pid"] == pid
+    commands.cleanup("db")
+    assert tunnels.find("db") is None
+    assert json.loads((tmp_path / "fake-cf.json").read_text()) == {
+        "apps": {},
+        "keys": {},
+    }
+
+
+def test_idle_session_is_reaped(tmp_path, monkeypatch):
+    fake_cf(tmp_path, monkeypatch, "8", ["db"])
+    # a timeout of about a second
+    commands.setup("db", "pgsql", session=True, idle_timeout=0.02)
+    assert session.find("ssh-app")["users"] == [os.getpid()]
+    # held while the run uses it, then left idle with no later run
+    session.release("ssh-app")
+    deadline = time.monotonic() + 30
+    while session.find("ssh-app") is not None and time.monotonic() < deadline:
+        time.sleep(0.2)
+    assert session.find("ssh-app") is None
+    assert tunnels.find("db") is None
+    assert json.loads((tmp_path / "fake-cf.json").read_text()) == {
+        "apps": {},
+        "keys": {},
+    }
+
+
+def test_stream_clone_ignores_compress(monkeypatch, capsys):
+    monkeypatch.setattr(PgSql, "prerequisites", lambda self: None)
+    streamed = []
+    monkeypatch.setattr(commands, "stream_clone", lambda *a: streamed.append(a))
+    commands.clone("src", "dst", "pgsql", stream=True, codec=Codec("zstd"))
+    assert len(streamed) == 1
+    assert "--compress is ignored" in capsys.readouterr().out
+
+
+def test_setup_two_services(tmp_path, monkeypatch):
+    fake_cf(tmp_path, monkeypatch, "8", ["src", "dst"])
+    engine = commands.get_engine_handler("pgsql")
+    setups = asyncio.run(
+        commands.setup_services_async([("src", None, engine), ("dst", None, engine)])
+    )
+    try:
+        # both default to the same local port, so one reserves the next
+        ports = sorted(creds["local_port"] for creds, _ in setups.values())
+        assert ports == [65432, 65433]
+    finally:
+        commands.cleanup("dst")
+        commands.cleanup("src")
+    assert tunnels.list_all() == {}
+
+
+def test_clone_pushes_once(tmp_path, monkeypatch):
+    fake_cf(tmp_path, monkeypatch, "8", ["src", "dst"])
+    pushes = []
+    push_app = cf_cmds.push_app
+    monkeypatch.setattr(cf_cmds, "push_app", lambda *a: pushes.append(push_app(*a)))
+    ports = {}
+
+    def transfer(service_name, creds, *args):
+        # both tunnels are up for the whole transfer
+        assert set(tunnels.list_all()) == {"src", "dst"}
+        ports[service_name] = creds["local_port"]
+
+    pgsql = PgSql
+    monkeypatch.setattr(pgsql, "prerequisites", lambda self: None)
+    # no client to size the databases with
+    monkeypatch.setattr(preflight, "ENABLED", False)
+    monkeypatch.setattr(pgsql, "export_svc", lambda self, *a: transfer(*a))
+    monkeypatch.setattr(pgsql, "import_svc", lambda self, *a: transfer(*a))
+    commands.clone("src", "dst", "pgsql", backup_file=str(tmp_path / "db.sql"))
+    assert len(pushes) == 1
+    assert sorted(ports.values()) == [65432, 65433]
+    assert tunnels.list_all() == {}
+    assert json.loads((tmp_path / "fake-cf.json").read_text()) == {
+        "apps": {},
+        "keys": {},
+    }
+
+
+def test_multiplexed_tunnels(tmp_path, monkeypatch):
+    fake_cf(tmp_path, monkeypatch, "8", ["one", "two", "three"])
+    engine = commands.get_engine_handler("pgsql")
+    names = ["one", "two", "three"]
+    setups = asyncio.run(
+        commands.setup_services_async(
+            [(x, None, engine) for x in names], multiplex=True
+        )
+    )
+    try:
+        pids = {pid for _, pid in setups.values()}
+        assert len(pids) == 1
+        # closing one forward restarts cf ssh with the others
+        cf_cmds.delete_ssh_tunnel(0, "one")
+        remaining = tunnels.list_all()
+        assert set(remaining) == {"two", "three"}
+        assert {e["pid"] for e in remaining.values()} != pids
+        for creds, _ in [setups["two"], setups["three"]]:
+            port = int(creds["local_port"])
+            assert cf_cmds.wait_for_tunnel(port, engine.handshake, timeout=5)
+    finally:
+        commands.teardown_services(names, "ssh-app", "key")
+    assert tunnels.list_all() == {}
+
+
+def test_teardown_is_best_effort(monkeypatch):
+    calls = []
+
+    def fail(*args):
+        raise click.ClickException("cf is gone")
+
+    monkeypatch.setattr(cf_cmds, "check_cf_cli", lambda: None)
+    monkeypatch.setattr(cf_cmds, "delete_ssh_tunnels", fail)
+    monkeypatch.setattr(cf_cmds, "delete_service_key", lambda k, x: calls.append(x))
+    monkeypatch.setattr(cf_cmds, "delete_app", lambda x: calls.append(x))
+    with pytest.raises(click.ClickException, match="1 cleanup steps failed"):
+        commands.teardown_services(["one", "two"], "ssh-app", "key")
+    # the keys and the app are still deleted when closing the tunnels fails
+    assert sorted(calls) == ["one", "ssh-app", "two"]
+
+
+def test_batch_multiplex_setup_failure(tmp_path, monkeypatch):
+    torn_down = []
+
+    async def fail(*args, **kwargs):
+        raise click.ClickException("cf ssh exited")
+
+    monkeypatch.setattr(cf_cmds, "check_cf_cli", lambda: None)
+    monkeypatch.setattr(cf_cmds, "push_app", lambda x: None)
+    monkeypatch.setattr(cf_cmds, "enable_ssh", lambda x: None)
+    monkeypatch.setattr(PgSql, "prerequisites", lambda self: None)
+    monkeypatch.setattr(commands, "setup_services_async", fail)
+    monkeypatch.setattr(commands, "teardown_services", lambda *a: torn_down.append(a))
+    results = commands.batch(
+        "export",
+        ["one", "two"],
+        directory=str(tmp_path),
+        engine_type="pgsql",
+        multiplex=True,
+    )
+    # each service reports the failed setup rather than batch raising it
+    assert {x["status"] for x in results.values()} == {"failed"}
+    assert results["one"]["error"] == "cf ssh exited"
+    assert torn_down == [(["one", "two"], "ssh-app", "key")]
+
+
+def test_batch_cleans_up_failed_setup(tmp_path, monkeypatch):
+    deleted = []
+
+    def fail(*args, **kwargs):
+        raise click.ClickException("tunnel did not come up")
+
+    monkeypatch.setattr(cf_cmds, "check_cf_cli", lambda: None)
+    monkeypatch.setattr(cf_cmds, "push_app", lambda x: None)
+    monkeypatch.setattr(cf_cmds, "enable_ssh", lambda x: None)
+    monkeypatch.setattr(cf_cmds, "delete_app", lambda x: None)
+    monkeypatch.setattr(cf_cmds, "delete_ssh_tunnel", lambda pid, x: None)
+    monkeypatch.setattr(
+        cf_cmds, "delete_service_key", lambda key, x: deleted.append((key, x))
+    )
+    monkeypatch.setattr(PgSql, "prerequisites", lambda self: None)
+    monkeypatch.setattr(commands, "setup", fail)
+    results = commands.batch(
+        "export", ["one"], directory=str(tmp_path), engine_type="pgsql"
+    )
+    assert results["one"]["status"] == "failed"
+    # the key made before the tunnel failed is still deleted
+    assert deleted == [("key", "one")]
+
+
+def test_failed_setup_closes_opened_tunnels(monkeypatch):
+    closed = []
+
+    def add_credential_steps(graph, service_name, engine_type, engine, key_name):
+        def creds():
+            if service_name == "bad":
+                # fails only once the other service's tunnel is up
+                deadline = time.monotonic() + 5
+                while "tunnel:good" not in graph.results:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+                raise click.ClickException("no such service")
+            return {}
+
+        graph.add(f"creds:{service_name}", creds)
+
+    def add_port_step(graph, service_name, exclude_ports):
+        graph.add(f"port:{service_name}", lambda: None, after=[f"creds:{service_name}"])
+
+    def add_tunnel_step(graph, service_name, app_name, key_name, ready):
+        graph.add(
+            f"tunnel:{service_name}",
+            lambda: ({}, 42),
+            after=[f"port:{service_name}"],
+        )
+
+    monkeypatch.setattr(cf_cmds, "check_cf_cli", lambda: None)
+    monkeypatch.setattr(cf_cmds, "delete_ssh_tunnels", closed.extend)
+    monkeypatch.setattr(commands, "add_credential_steps", add_credential_steps)
+    monkeypatch.setattr(commands, "add_port_step", add_port_step)
+    monkeypatch.setattr(commands, "add_tunnel_step", add_tunnel_step)
+    services = [("good", None, None), ("bad", None, None)]
+    with pytest.raises(click.ClickException):
+        asyncio.run(commands.setup_services_async(services, push_app=False))
+    assert closed == ["good"]
@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import pytest
+from cg_manage_rds.cmds import cache, cf_cmds, tools
+
+# modules the cli imports on top of click to print the help, about 60 on
+# python 3.13, so only a real regression like an eager import of asyncio
+# or an engine trips it; counted rather than timed so a slow machine can not
+MODULE_BUDGET = 80
+
+
+def python(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+
+def test_engines_are_imported_lazily():
+    result = python(
+        "import sys, cg_manage_rds.cli; "
+        "print(' '.join(m for m in ['asyncio', 'cg_manage_rds.cmds.pgsql', "
+        "'cg_manage_rds.cmds.mysql'] if m in sys.modules))"
+    )
+    assert result.stdout.strip() == ""
+
+
+def imported(code: str) -> set:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # "import time: self [us] | cumulative | module", one line per module
+    return {
+        line.rsplit("|", 1)[1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "|" in line
+    } - {"package"}
+
+
+def test_startup_imports():
+    cli = imported(
+        "from cg_manage_rds.cli import main\n"
+        "main(['--help'], standalone_mode=False)\n"
+    )
+    added = cli - imported("import click")
+    assert "cg_manage_rds.commands" in added
+    assert "asyncio" not in added
+    assert len(added) < MODULE_BUDGET, sorted(added)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell script cf shim")
+def test_cf_version_is_cached(tmp_path, monkeypatch):
+    calls = tmp_path / "calls"
+    shim = tmp_path / "cf"
+    shim.write_text(
+        f'#!/bin/sh\necho "$@" >> "{calls}"\n'
+        'echo "cf version 8.7.10+5b7ce3c.2024-03-18"\n'
+    )
+    shim.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path / "state"))
+    monkeypatch.setattr(cache, "ENABLED", True)
+    for _ in range(2):
+        monkeypatch.setattr(cf_cmds, "CF_VERSION_PASSED", False)
+        cf_cmds.check_cf_cli()
+    assert cf_cmds.CF_VERSION == 8
+    assert calls.read_text().splitlines() == ["--version"]
+    # a replaced binary is asked again
+    shim.write_text(shim.read_text() + "\n")
+    assert "8.7.10" in tools.version("cf")
+    assert len(calls.read_text().splitlines()) == 2
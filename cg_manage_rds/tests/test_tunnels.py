@@ -0,0 +1,57 @@
+import os
+import socket
+import sys
+import subprocess
+import pytest
+from cg_manage_rds.cmds import tunnels
+from cg_manage_rds.cmds.utils import locked_state, run_async
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="posix process groups")
+
+
+def test_stop_tunnel(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    # stand in for cf ssh, the trailing ssh argument lets ps identify it
+    cmd = [sys.executable, "-c", "import time; time.sleep(60)", "ssh"]
+    proc = run_async(
+        cmd, new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    entry = {"pid": proc.pid, "pgid": proc.pid}
+    assert tunnels.is_running(entry)
+    assert tunnels.stop(entry, grace=1)
+    assert not tunnels.is_running(entry)
+    # stopping again is a no-op
+    assert not tunnels.stop(entry)
+
+
+def test_pid_reuse_is_not_killed():
+    # our own pid is alive but not in a tunnel's process group
+    entry = {"pid": os.getpid(), "pgid": -1}
+    assert not tunnels.is_running(entry)
+    assert not tunnels.stop(entry)
+
+
+def test_reserve_port(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    with socket.socket() as busy:
+        busy.bind(("127.0.0.1", 0))
+        busy.listen()
+        taken = busy.getsockname()[1]
+        # bound by someone else, so the next port is picked
+        port = tunnels.reserve_port("a", taken)
+        assert port != taken
+    # reserved by a, so b gets another one until a releases it
+    other = tunnels.reserve_port("b", port)
+    assert other != port
+    tunnels.release_port(port)
+    assert tunnels.reserve_port("c", port) == port
+
+
+def test_reservation_of_dead_process_is_dropped(tmp_path, monkeypatch):
+    monkeypatch.setenv("CG_MANAGE_RDS_HOME", str(tmp_path))
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    port = tunnels.reserve_port("a", 40000)
+    with locked_state(tunnels.PORTS_FILE) as reserved:
+        reserved[str(port)]["pid"] = proc.pid
+    assert tunnels.reserve_port("b", port) == port
@@ -0,0 +1,81 @@
+import sys
+from cg_manage_rds.cmds import utils
+
+
+def test_run_pipeline():
+    # output of the first stage is fed to the second
+    code, result, _ = utils.run_pipeline(
+        [
+            [sys.executable, "-c", "print('hello')"],
+            [sys.executable, "-c", "import sys; print(sys.stdin.read().upper())"],
+        ]
+    )
+    assert code == 0
+    assert result == "HELLO"
+    # a failing stage is reported and stops the pipeline
+    code, result, _ = utils.run_pipeline(
+        [
+            [sys.executable, "-c", "import time; time.sleep(30)"],
+            [sys.executable, "-c", "import sys; sys.exit('restore failed')"],
+        ]
+    )
+    assert code == 1
+    assert "restore failed" in result
+
+
+def test_run_pipeline_chunks():
+    # chunks go into the first stage and are what is counted
+    counted = []
+    code, result, _ = utils.run_pipeline(
+        [
+            [sys.executable, "-c", "import sys; print(sys.stdin.read() * 2)"],
+            [sys.executable, "-c", "import sys; print(sys.stdin.read().upper())"],
+        ],
+        counter=counted.append,
+        chunks=iter([b"ab", b"c"]),
+    )
+    assert code == 0
+    assert result == "ABCABC"
+    assert sum(counted) == 3
+
+
+def test_run_feed():
+    counted = []
+    chunks = (f"line {i}\n".encode() for i in range(3))
+    script = "import sys; print(len(sys.stdin.read().splitlines()))"
+    code, result, _ = utils.run_feed(
+        [sys.executable, "-c", script], chunks, counted.append
+    )
+    assert code == 0
+    assert result == "3"
+    assert sum(counted) == 21
+    code, result, _ = utils.run_feed(
+        [sys.executable, "-c", "import sys; sys.exit('load failed')"], iter([b"x"])
+    )
+    assert code == 1
+    assert "load failed" in result
+
+
+def test_auto_jobs(monkeypatch):
+    monkeypatch.setattr(utils.os, "cpu_count", lambda: 16)
+    assert utils.auto_jobs("micro-psql") == 2
+    assert utils.auto_jobs("large-gp-psql") == 4
+    assert utils.auto_jobs("xlarge-psql-redundant") == 8
+    # local cores cap the number of jobs
+    monkeypatch.setattr(utils.os, "cpu_count", lambda: 3)
+    assert utils.auto_jobs("xlarge-psql") == 3
+
+
+def test_run_sync_large_output():
+    # more than a pipe buffer on both streams must not deadlock
+    script = "import sys; sys.stderr.write('e' * 200000); print('o' * 200000)"
+    code, result, _ = utils.run_sync([sys.executable, "-c", script])
+    assert code == 0
+    assert result == "o" * 200000
+
+
+def test_output_buffer_keeps_tail():
+    buf = utils.OutputBuffer(limit=10)
+    for chunk in [b"0123456789", b"abcdef", b"XYZ"]:
+        buf.feed(chunk)
+    assert buf.text() == "9abcdefXYZ"